@@ -30,12 +30,14 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from shop_bot.bot import keyboards
 from shop_bot.modules import mwshark_api
 from shop_bot.data_manager.database import (
-    get_user, add_new_key, get_user_keys, update_user_stats,
-    register_user_if_not_exists, get_next_key_number, get_key_by_id,
-    update_key_info, set_trial_used, set_terms_agreed, get_setting,
-    get_all_plans, get_plan_by_id, log_transaction, get_referral_count,
-    add_to_referral_balance, create_pending_transaction, get_all_users,
-    set_referral_balance, set_referral_balance_all
+    get_setting,
+    async_get_user, async_add_new_key, async_get_user_keys, async_update_user_stats,
+    async_register_user_if_not_exists, async_get_next_key_number, async_get_key_by_id,
+    async_update_key_info, async_set_trial_used, async_set_terms_agreed, async_get_all_plans,
+    async_get_plan_by_id, async_log_transaction, async_get_referral_count,
+    async_add_to_referral_balance, async_create_pending_transaction, async_iter_users, async_create_payment_intent,
+    async_transition_payment_intent,
+    async_set_referral_balance, async_set_referral_balance_all, async_get_user_latest_expiry
 )
 
 from shop_bot.config import (
@@ -83,8 +85,8 @@ def is_valid_email(email: str) -> bool:
 
 async def show_main_menu(message: types.Message, edit_message: bool = False):
     user_id = message.chat.id
-    user_db_data = get_user(user_id)
-    user_keys = get_user_keys(user_id)
+    user_db_data = await async_get_user(user_id)
+    user_keys = await async_get_user_keys(user_id)
 
     trial_available = not (user_db_data and user_db_data.get('trial_used'))
     is_admin = str(user_id) == ADMIN_ID
@@ -105,7 +107,7 @@ def registration_required(f):
     @wraps(f)
     async def decorated_function(event: types.Update, *args, **kwargs):
         user_id = event.from_user.id
-        user_data = get_user(user_id)
+        user_data = await async_get_user(user_id)
         if user_data:
             return await f(event, *args, **kwargs)
         else:
@@ -135,8 +137,8 @@ def get_user_router() -> Router:
             except (IndexError, ValueError):
                 logger.warning(f"Invalid referral code: {command.args}")
 
-        register_user_if_not_exists(user_id, username, referrer_id)
-        user_data = get_user(user_id)
+        await async_register_user_if_not_exists(user_id, username, referrer_id)
+        user_data = await async_get_user(user_id)
 
         if user_data and user_data.get('agreed_to_terms'):
             await message.answer(
@@ -151,7 +153,7 @@ def get_user_router() -> Router:
         channel_url = get_setting("channel_url")
 
         if not channel_url or not terms_url or not privacy_url:
-            set_terms_agreed(user_id)
+            await async_set_terms_agreed(user_id)
             await show_main_menu(message)
             return
 
@@ -159,7 +161,7 @@ def get_user_router() -> Router:
         show_welcome_screen = (is_subscription_forced and channel_url) or (terms_url and privacy_url)
 
         if not show_welcome_screen:
-            set_terms_agreed(user_id)
+            await async_set_terms_agreed(user_id)
             await show_main_menu(message)
             return
 
@@ -238,8 +240,8 @@ def get_user_router() -> Router:
     async def profile_handler_callback(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
-        user_keys = get_user_keys(user_id)
+        user_db_data = await async_get_user(user_id)
+        latest_expiry_ts = await async_get_user_latest_expiry(user_id)
 
         if not user_db_data:
             await callback.answer("Не удалось получить данные профиля.", show_alert=True)
@@ -249,14 +251,11 @@ def get_user_router() -> Router:
         total_spent = user_db_data.get('total_spent', 0)
         total_months = user_db_data.get('total_months', 0)
         now = datetime.now()
-        active_keys = [key for key in user_keys if datetime.fromisoformat(key['expiry_date']) > now]
 
-        if active_keys:
-            latest_key = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']))
-            latest_expiry_date = datetime.fromisoformat(latest_key['expiry_date'])
-            time_left = latest_expiry_date - now
+        if latest_expiry_ts and latest_expiry_ts > now.timestamp():
+            time_left = datetime.fromtimestamp(latest_expiry_ts) - now
             vpn_status_text = get_vpn_active_text(time_left.days, time_left.seconds // 3600)
-        elif user_keys:
+        elif latest_expiry_ts is not None:
             vpn_status_text = VPN_INACTIVE_TEXT
         else:
             vpn_status_text = VPN_NO_DATA_TEXT
@@ -371,12 +370,11 @@ def get_user_router() -> Router:
 
         await state.clear()
 
-        users = get_all_users()
         sent_count = 0
         failed_count = 0
         banned_count = 0
 
-        for user in users:
+        async for user in async_iter_users():
             user_id = user['telegram_id']
             if user.get('is_banned'):
                 banned_count += 1
@@ -411,11 +409,11 @@ def get_user_router() -> Router:
     async def referral_program_handler(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_data = get_user(user_id)
+        user_data = await async_get_user(user_id)
         bot_username = (await callback.bot.get_me()).username
 
         referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        referral_count = get_referral_count(user_id)
+        referral_count = await async_get_referral_count(user_id)
         balance = float(user_data.get('referral_balance', 0) or 0)
 
         text = (
@@ -445,7 +443,7 @@ def get_user_router() -> Router:
     @registration_required
     async def process_withdraw_details(message: types.Message, state: FSMContext):
         user_id = message.from_user.id
-        user = get_user(user_id)
+        user = await async_get_user(user_id)
         balance = float(user.get('referral_balance', 0) or 0)
         details = message.text.strip()
 
@@ -473,13 +471,13 @@ def get_user_router() -> Router:
             return
         try:
             user_id = int(message.text.split("_")[-1])
-            user = get_user(user_id)
+            user = await async_get_user(user_id)
             balance = float(user.get('referral_balance', 0) or 0)
             if balance < 100:
                 await message.answer("Баланс менее 100 руб.")
                 return
-            set_referral_balance(user_id, 0)
-            set_referral_balance_all(user_id, 0)
+            await async_set_referral_balance(user_id, 0)
+            await async_set_referral_balance_all(user_id, 0)
             await message.answer(f"✅ Выплата {balance:.2f} RUB подтверждена.")
             await message.bot.send_message(user_id, f"✅ Заявка на {balance:.2f} RUB одобрена.")
         except Exception as e:
@@ -537,7 +535,7 @@ def get_user_router() -> Router:
     @registration_required
     async def manage_keys_handler(callback: types.CallbackQuery):
         await callback.answer()
-        user_keys = get_user_keys(callback.from_user.id)
+        user_keys = await async_get_user_keys(callback.from_user.id)
         await callback.message.edit_text(
             "Ваши ключи:" if user_keys else "У вас пока нет ключей.",
             reply_markup=keyboards.create_keys_management_keyboard(user_keys)
@@ -547,7 +545,7 @@ def get_user_router() -> Router:
     @registration_required
     async def trial_period_handler(callback: types.CallbackQuery, state: FSMContext):
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
+        user_db_data = await async_get_user(user_id)
 
         if user_db_data and user_db_data.get('trial_used'):
             await callback.answer("Вы уже использовали пробный период.", show_alert=True)
@@ -577,7 +575,7 @@ def get_user_router() -> Router:
                 )
                 return
 
-            set_trial_used(user_id)
+            await async_set_trial_used(user_id)
 
             subscription = result.get('subscription', {})
             subscription_uuid = subscription.get('uuid', '')
@@ -597,7 +595,7 @@ def get_user_router() -> Router:
                         telegram=get_setting("branding_telegram")
                     )
 
-            new_key_id = add_new_key(user_id=user_id, subscription_link=subscription_link, expiry_timestamp_ms=expiry_ms, subscription_uuid=subscription_uuid)
+            new_key_id = await async_add_new_key(user_id=user_id, subscription_link=subscription_link, expiry_timestamp_ms=expiry_ms, subscription_uuid=subscription_uuid)
 
             await callback.message.delete()
             final_text = get_purchase_success_text("создан", 1, expiry_date, subscription_link)
@@ -624,7 +622,7 @@ def get_user_router() -> Router:
             return
             
         user_id = callback.from_user.id
-        key_data = get_key_by_id(key_id)
+        key_data = await async_get_key_by_id(key_id)
 
         if not key_data or key_data['user_id'] != user_id:
             await callback.message.edit_text("❌ Ключ не найден.")
@@ -632,10 +630,10 @@ def get_user_router() -> Router:
 
         try:
             subscription_link = key_data.get('subscription_link', '')
-            expiry_date = datetime.fromisoformat(key_data['expiry_date'])
+            expiry_date = datetime.fromtimestamp(key_data['expiry_ts'])
             created_date = datetime.fromisoformat(key_data['created_date'])
 
-            all_user_keys = get_user_keys(user_id)
+            all_user_keys = await async_get_user_keys(user_id)
             key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), 0)
 
             final_text = get_key_info_text(key_number, expiry_date, created_date, subscription_link)
@@ -659,7 +657,7 @@ def get_user_router() -> Router:
             return
             
         await callback.answer("Генерирую QR-код...")
-        key_data = get_key_by_id(key_id)
+        key_data = await async_get_key_by_id(key_id)
 
         if not key_data or key_data['user_id'] != callback.from_user.id:
             return
@@ -723,7 +721,7 @@ def get_user_router() -> Router:
     @registration_required
     async def buy_new_key_handler(callback: types.CallbackQuery):
         await callback.answer()
-        plans = get_all_plans()
+        plans = await async_get_all_plans()
         if not plans:
             await callback.message.edit_text("❌ Нет доступных тарифов.", reply_markup=keyboards.create_back_to_menu_keyboard())
             return
@@ -739,12 +737,12 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Неверный формат ключа.")
             return
 
-        key_data = get_key_by_id(key_id)
+        key_data = await async_get_key_by_id(key_id)
         if not key_data or key_data['user_id'] != callback.from_user.id:
             await callback.message.edit_text("❌ Ключ не найден.")
             return
 
-        plans = get_all_plans()
+        plans = await async_get_all_plans()
         if not plans:
             await callback.message.edit_text("❌ Нет доступных тарифов.", reply_markup=keyboards.create_back_to_menu_keyboard())
             return
@@ -828,8 +826,8 @@ def get_user_router() -> Router:
     async def create_yookassa_payment_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Создаю ссылку...")
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        user_data = await async_get_user(callback.from_user.id)
+        plan = await async_get_plan_by_id(data.get('plan_id'))
 
         if not plan:
             await callback.message.answer("Ошибка выбора тарифа.")
@@ -867,21 +865,23 @@ def get_user_router() -> Router:
                     }]
                 }
 
+            metadata = {
+                "user_id": user_id, "days": days, "price": float(price_rub),
+                "action": action, "key_id": key_id, "plan_id": data.get('plan_id'),
+                "customer_email": customer_email, "payment_method": "YooKassa"
+            }
             payment_payload = {
                 "amount": {"value": price_str, "currency": "RUB"},
                 "confirmation": {"type": "redirect", "return_url": f"https://t.me/{TELEGRAM_BOT_USERNAME}"},
                 "capture": True,
                 "description": f"Подписка на {days} дн.",
-                "metadata": {
-                    "user_id": user_id, "days": days, "price": float(price_rub),
-                    "action": action, "key_id": key_id, "plan_id": data.get('plan_id'),
-                    "customer_email": customer_email, "payment_method": "YooKassa"
-                }
+                "metadata": metadata
             }
             if receipt:
                 payment_payload['receipt'] = receipt
 
             payment = Payment.create(payment_payload, uuid.uuid4())
+            await async_create_payment_intent("yookassa", payment.id, metadata, user_id, float(price_rub))
             await state.clear()
             await callback.message.edit_text(
                 "Нажмите для оплаты:",
@@ -897,8 +897,8 @@ def get_user_router() -> Router:
     async def create_cryptobot_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Создаю счет...")
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        user_data = await async_get_user(callback.from_user.id)
+        plan = await async_get_plan_by_id(data.get('plan_id'))
 
         cryptobot_token = get_setting('cryptobot_token')
         if not cryptobot_token or len(cryptobot_token) < 10:
@@ -941,8 +941,7 @@ def get_user_router() -> Router:
             if not invoice or not invoice.pay_url:
                 raise Exception("Invoice creation failed")
 
-            from shop_bot.data_manager.database import create_pending_cryptobot_invoice
-            create_pending_cryptobot_invoice(str(invoice.invoice_id), json.dumps(metadata))
+            await async_create_payment_intent("cryptobot", invoice.invoice_id, metadata, user_id, float(price_rub), poll=True)
 
             await callback.message.edit_text("Нажмите для оплаты:", reply_markup=keyboards.create_payment_keyboard(invoice.pay_url))
             await state.clear()
@@ -956,8 +955,8 @@ def get_user_router() -> Router:
     async def create_heleket_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Создаю счет...")
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
-        user_data = get_user(callback.from_user.id)
+        plan = await async_get_plan_by_id(data.get('plan_id'))
+        user_data = await async_get_user(callback.from_user.id)
 
         if not plan:
             await callback.message.edit_text("❌ Ошибка тарифа.")
@@ -989,8 +988,8 @@ def get_user_router() -> Router:
     async def create_platega_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Создаю счет...")
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
-        user_data = get_user(callback.from_user.id)
+        plan = await async_get_plan_by_id(data.get('plan_id'))
+        user_data = await async_get_user(callback.from_user.id)
 
         if not plan:
             await callback.message.edit_text("❌ Ошибка тарифа.")
@@ -1024,7 +1023,7 @@ def get_user_router() -> Router:
 
 async def process_successful_onboarding(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Доступ предоставлен.")
-    set_terms_agreed(callback.from_user.id)
+    await async_set_terms_agreed(callback.from_user.id)
     await state.clear()
     await callback.message.delete()
     await callback.message.answer("Приятного использования!", reply_markup=keyboards.main_reply_keyboard)
@@ -1053,8 +1052,8 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         plan_id = metadata.get('plan_id')
         payment_method = metadata.get('payment_method', 'Unknown')
 
-        user_info = get_user(user_id)
-        plan_info = get_plan_by_id(plan_id)
+        user_info = await async_get_user(user_id)
+        plan_info = await async_get_plan_by_id(plan_id)
 
         username = user_info.get('username', 'N/A') if user_info else 'N/A'
         plan_name = plan_info.get('plan_name', 'N/A') if plan_info else 'N/A'
@@ -1104,6 +1103,7 @@ async def _create_heleket_payment_request(user_id: int, price: float, days: int,
         "Content-Type": "application/json",
     }
 
+    await async_create_payment_intent("heleket", order_id, metadata, user_id, float(price))
     try:
         async with aiohttp.ClientSession() as session:
             async with session.post("https://api.heleket.com/v1/payment", json=payload, headers=headers) as response:
@@ -1111,10 +1111,10 @@ async def _create_heleket_payment_request(user_id: int, price: float, days: int,
                 if response.status == 200 and result.get("result", {}).get("url"):
                     return result["result"]["url"]
                 logger.error(f"Heleket API Error: {response.status}, {result}")
-                return None
     except Exception as e:
         logger.error(f"Heleket request failed: {e}", exc_info=True)
-        return None
+    await async_transition_payment_intent("heleket", order_id, "failed")
+    return None
 
 
 def _generate_heleket_signature(data, api_key: str) -> str:
@@ -1162,8 +1162,8 @@ async def _create_platega_payment(user_id: int, price: float, days: int, state_d
             async with session.post("https://app.platega.io/transaction/process", json=payload, headers=headers) as response:
                 result = await response.json()
                 if response.status == 200 and result.get("redirect"):
-                    from shop_bot.data_manager.database import create_pending_platega_transaction
-                    create_pending_platega_transaction(result.get("transactionId"), json.dumps(metadata))
+                    await async_create_payment_intent("platega", result.get("transactionId"), metadata, user_id,
+                                                      float(price), poll=True)
                     return result
                 logger.error(f"Platega API Error: {response.status}, {result}")
                 return None
@@ -1172,7 +1172,7 @@ async def _create_platega_payment(user_id: int, price: float, days: int, state_d
         return None
 
 
-async def check_platega_payment_status(transaction_id: str) -> dict | None:
+async def check_platega_payment_status(transaction_id: str, session: aiohttp.ClientSession | None = None) -> dict | None:
     merchant_id = get_setting("platega_merchant_id")
     secret_key = get_setting("platega_secret_key")
 
@@ -1184,15 +1184,20 @@ async def check_platega_payment_status(transaction_id: str) -> dict | None:
         "X-Secret": secret_key
     }
 
+    owns_session = session is None
+    if owns_session:
+        session = aiohttp.ClientSession()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://app.platega.io/transaction/{transaction_id}", headers=headers) as response:
-                if response.status == 200:
-                    return await response.json()
-                return None
+        async with session.get(f"https://app.platega.io/transaction/{transaction_id}", headers=headers) as response:
+            if response.status == 200:
+                return await response.json()
+            return None
     except Exception as e:
         logger.error(f"Platega status check failed: {e}")
         return None
+    finally:
+        if owns_session:
+            await session.close()
 
 
 async def get_usdt_rub_rate() -> Decimal | None:
@@ -1247,7 +1252,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                             telegram=get_setting("branding_telegram")
                         )
         elif action == "extend":
-            key_data = get_key_by_id(key_id)
+            key_data = await async_get_key_by_id(key_id)
             if not key_data or not key_data.get('subscription_uuid'):
                 await processing_message.edit_text("❌ UUID подписки не найден.")
                 return
@@ -1268,11 +1273,11 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         subscription_link = subscription.get('link', '')
 
         if action == "new":
-            key_id = add_new_key(user_id, subscription_link, expiry_ms, subscription_uuid)
+            key_id = await async_add_new_key(user_id, subscription_link, expiry_ms, subscription_uuid)
         elif action == "extend":
-            update_key_info(key_id, subscription_link, expiry_ms, subscription_uuid)
+            await async_update_key_info(key_id, subscription_link, expiry_ms, subscription_uuid)
 
-        user_data = get_user(user_id)
+        user_data = await async_get_user(user_id)
         referrer_id = user_data.get('referred_by') if user_data else None
 
         if referrer_id:
@@ -1280,7 +1285,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             reward = (Decimal(str(price)) * percentage / 100).quantize(Decimal("0.01"))
 
             if float(reward) > 0:
-                add_to_referral_balance(referrer_id, float(reward))
+                await async_add_to_referral_balance(referrer_id, float(reward))
                 try:
                     referrer_username = user_data.get('username', 'пользователь')
                     await bot.send_message(
@@ -1291,12 +1296,12 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                     logger.warning(f"Referral notification failed for {referrer_id}: {e}")
 
         months_approx = max(1, days // 30)
-        update_user_stats(user_id, price, months_approx)
+        await async_update_user_stats(user_id, price, months_approx)
 
-        user_info = get_user(user_id)
+        user_info = await async_get_user(user_id)
         internal_payment_id = str(uuid.uuid4())
         log_username = user_info.get('username', 'N/A') if user_info else 'N/A'
-        plan_info = get_plan_by_id(plan_id)
+        plan_info = await async_get_plan_by_id(plan_id)
 
         log_metadata = json.dumps({
             "plan_id": plan_id,
@@ -1304,7 +1309,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             "customer_email": customer_email
         })
 
-        log_transaction(
+        await async_log_transaction(
             username=log_username, transaction_id=None, payment_id=internal_payment_id,
             user_id=user_id, status='paid', amount_rub=float(price),
             amount_currency=None, currency_name=None,
@@ -1313,7 +1318,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
 
         await processing_message.delete()
 
-        all_user_keys = get_user_keys(user_id)
+        all_user_keys = await async_get_user_keys(user_id)
         key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), len(all_user_keys))
 
         final_text = get_purchase_success_text(
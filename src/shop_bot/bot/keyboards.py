@@ -149,9 +149,10 @@ def create_payment_keyboard(payment_url: str) -> InlineKeyboardMarkup:
 def create_keys_management_keyboard(keys: list) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     if keys:
+        now = datetime.now()
         for i, key in enumerate(keys):
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            status_icon = "✅" if expiry_date > datetime.now() else "❌"
+            expiry_date = datetime.fromtimestamp(key['expiry_ts'])
+            status_icon = "✅" if expiry_date > now else "❌"
             button_text = f"{status_icon} Ключ #{i+1} (до {expiry_date.strftime('%d.%m.%Y')})"
             key_id = key.get('key_id')
             if key_id:
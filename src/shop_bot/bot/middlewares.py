@@ -1,7 +1,7 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery
-from shop_bot.data_manager.database import get_user
+from shop_bot.data_manager.database import async_get_user
 
 
 class BanMiddleware(BaseMiddleware):
@@ -15,7 +15,7 @@ class BanMiddleware(BaseMiddleware):
         if not user:
             return await handler(event, data)
 
-        user_data = get_user(user.id)
+        user_data = await async_get_user(user.id)
         if user_data and user_data.get('is_banned') == 1:
             ban_message = "Вы заблокированы и не можете использовать этого бота."
             if isinstance(event, CallbackQuery):
@@ -1,5 +1,4 @@
 import logging
-import json
 import asyncio
 from datetime import datetime
 from enum import Enum
@@ -66,26 +65,26 @@ SUPPORT_CATEGORIES = {
 }
 
 
-def get_ticket_status(user_id: int) -> Optional[str]:
-    return database.get_support_ticket_status(user_id)
+async def get_ticket_status(user_id: int) -> Optional[str]:
+    return await database.async_get_support_ticket_status(user_id)
 
 
-def set_ticket_status(user_id: int, status: TicketStatus):
-    database.update_support_ticket_status(user_id, status.value)
+async def set_ticket_status(user_id: int, status: TicketStatus):
+    await database.async_update_support_ticket_status(user_id, status.value)
 
 
-def get_ticket_priority(user_id: int) -> Optional[str]:
-    return database.get_support_ticket_priority(user_id)
+async def get_ticket_priority(user_id: int) -> Optional[str]:
+    return await database.async_get_support_ticket_priority(user_id)
 
 
-def set_ticket_priority(user_id: int, priority: TicketPriority):
-    database.update_support_ticket_priority(user_id, priority.value)
+async def set_ticket_priority(user_id: int, priority: TicketPriority):
+    await database.async_update_support_ticket_priority(user_id, priority.value)
 
 
 async def get_user_summary(user_id: int, username: str, category: str = None) -> str:
-    keys = database.get_user_keys(user_id)
-    latest_transaction = database.get_latest_transaction(user_id)
-    user_data = database.get_user(user_id)
+    keys = await database.async_get_user_keys(user_id)
+    latest_transaction = await database.async_get_latest_transaction(user_id)
+    user_data = await database.async_get_user(user_id)
     now = datetime.now()
 
     summary_parts = [
@@ -120,7 +119,7 @@ async def get_user_summary(user_id: int, username: str, category: str = None) ->
         expired_keys = []
         for key in keys:
             try:
-                expiry = datetime.fromisoformat(key['expiry_date'].replace(' ', 'T'))
+                expiry = datetime.fromtimestamp(key['expiry_ts'])
                 if expiry > now:
                     days_left = (expiry - now).days
                     active_keys.append((key, expiry, days_left))
@@ -146,8 +145,7 @@ async def get_user_summary(user_id: int, username: str, category: str = None) ->
 
     if latest_transaction:
         try:
-            metadata = json.loads(latest_transaction.get('metadata', '{}'))
-            plan_name = metadata.get('plan_name', 'N/A')
+            plan_name = latest_transaction.get('plan_name') or 'N/A'
             price = latest_transaction.get('amount_rub', 0)
             status = latest_transaction.get('status', 'N/A')
             date = latest_transaction.get('created_date', '').split(' ')[0]
@@ -218,12 +216,12 @@ def get_support_router() -> Router:
         await state.clear()
         user_id = message.from_user.id
 
-        thread_id = database.get_support_thread_id(user_id)
+        thread_id = await database.async_get_support_thread_id(user_id)
 
         if thread_id:
-            status = get_ticket_status(user_id)
+            status = await get_ticket_status(user_id)
             if status == TicketStatus.CLOSED.value:
-                database.delete_support_thread(user_id)
+                await database.async_delete_support_thread(user_id)
                 thread_id = None
 
         if thread_id:
@@ -282,12 +280,12 @@ def get_support_router() -> Router:
             return
 
         try:
-            database.add_support_thread(user_id, thread_id, category)
-            set_ticket_status(user_id, TicketStatus.OPEN)
+            await database.async_add_support_thread(user_id, thread_id, category)
+            await set_ticket_status(user_id, TicketStatus.OPEN)
             if category in ["payment", "refund"]:
-                set_ticket_priority(user_id, TicketPriority.HIGH)
+                await set_ticket_priority(user_id, TicketPriority.HIGH)
             else:
-                set_ticket_priority(user_id, TicketPriority.NORMAL)
+                await set_ticket_priority(user_id, TicketPriority.NORMAL)
         except Exception as e:
             logger.error(f"Failed to save thread to DB: {e}")
 
@@ -329,7 +327,7 @@ def get_support_router() -> Router:
             return
 
         user_id = message.from_user.id
-        thread_id = database.get_support_thread_id(user_id)
+        thread_id = await database.async_get_support_thread_id(user_id)
 
         if not thread_id or not SUPPORT_GROUP_ID:
             await message.answer(
@@ -337,9 +335,9 @@ def get_support_router() -> Router:
             )
             return
 
-        status = get_ticket_status(user_id)
+        status = await get_ticket_status(user_id)
         if status == TicketStatus.CLOSED.value:
-            database.delete_support_thread(user_id)
+            await database.async_delete_support_thread(user_id)
             await message.answer(
                 "🔒 Ваш тикет был закрыт.\n"
                 "Нажмите /start для нового обращения."
@@ -348,7 +346,7 @@ def get_support_router() -> Router:
 
         try:
             if status == TicketStatus.WAITING_USER.value:
-                set_ticket_status(user_id, TicketStatus.IN_PROGRESS)
+                await set_ticket_status(user_id, TicketStatus.IN_PROGRESS)
 
             await bot.copy_message(
                 chat_id=SUPPORT_GROUP_ID,
@@ -357,11 +355,11 @@ def get_support_router() -> Router:
                 message_thread_id=thread_id
             )
 
-            database.increment_ticket_messages(user_id)
+            await database.async_increment_ticket_messages(user_id)
 
         except TelegramBadRequest as e:
             if "thread not found" in str(e).lower() or "message thread not found" in str(e).lower():
-                database.delete_support_thread(user_id)
+                await database.async_delete_support_thread(user_id)
                 await message.answer(
                     "⚠️ Тикет был удалён.\n"
                     "Нажмите /start для нового обращения."
@@ -375,13 +373,13 @@ def get_support_router() -> Router:
     @support_router.message(F.chat.id == SUPPORT_GROUP_ID, F.message_thread_id, Command("close"))
     async def close_ticket_command(message: types.Message, bot: Bot):
         thread_id = message.message_thread_id
-        user_id = database.get_user_id_by_thread(thread_id)
+        user_id = await database.async_get_user_id_by_thread(thread_id)
 
         if not user_id:
             await message.reply("❌ Пользователь не найден.")
             return
 
-        set_ticket_status(user_id, TicketStatus.CLOSED)
+        await set_ticket_status(user_id, TicketStatus.CLOSED)
 
         try:
             await bot.send_message(
@@ -405,7 +403,7 @@ def get_support_router() -> Router:
     @support_router.message(F.chat.id == SUPPORT_GROUP_ID, F.message_thread_id, Command("priority"))
     async def set_priority_command(message: types.Message, bot: Bot):
         thread_id = message.message_thread_id
-        user_id = database.get_user_id_by_thread(thread_id)
+        user_id = await database.async_get_user_id_by_thread(thread_id)
 
         if not user_id:
             await message.reply("❌ Пользователь не найден.")
@@ -429,13 +427,13 @@ def get_support_router() -> Router:
             return
 
         priority = priority_map[priority_str]
-        set_ticket_priority(user_id, priority)
+        await set_ticket_priority(user_id, priority)
         await message.reply(f"{PRIORITY_EMOJI[priority]} Приоритет изменён на: {priority_str.upper()}")
 
     @support_router.message(F.chat.id == SUPPORT_GROUP_ID, F.message_thread_id, Command("note"))
     async def add_note_command(message: types.Message):
         thread_id = message.message_thread_id
-        user_id = database.get_user_id_by_thread(thread_id)
+        user_id = await database.async_get_user_id_by_thread(thread_id)
 
         if not user_id:
             await message.reply("❌ Пользователь не найден.")
@@ -447,19 +445,19 @@ def get_support_router() -> Router:
             return
 
         note_text = args[1]
-        database.add_ticket_note(user_id, note_text, message.from_user.username or "Admin")
+        await database.async_add_ticket_note(user_id, note_text, message.from_user.username or "Admin")
         await message.reply(f"📝 Заметка добавлена:\n<i>{note_text}</i>", parse_mode=ParseMode.HTML)
 
     @support_router.message(F.chat.id == SUPPORT_GROUP_ID, F.message_thread_id, Command("info"))
     async def show_user_info(message: types.Message, bot: Bot):
         thread_id = message.message_thread_id
-        user_id = database.get_user_id_by_thread(thread_id)
+        user_id = await database.async_get_user_id_by_thread(thread_id)
 
         if not user_id:
             await message.reply("❌ Пользователь не найден.")
             return
 
-        user_data = database.get_user(user_id)
+        user_data = await database.async_get_user(user_id)
         if not user_data:
             await message.reply("❌ Данные пользователя не найдены.")
             return
@@ -474,7 +472,7 @@ def get_support_router() -> Router:
         action = action.replace("ticket_", "")
         user_id = int(user_id_str)
 
-        current_status = get_ticket_status(user_id)
+        current_status = await get_ticket_status(user_id)
 
         if current_status in [TicketStatus.CLOSED.value, TicketStatus.RESOLVED.value]:
             if action in ["wait", "urgent"]:
@@ -485,7 +483,7 @@ def get_support_router() -> Router:
             if current_status == TicketStatus.RESOLVED.value:
                 await callback.answer("Уже решён", show_alert=False)
                 return
-            set_ticket_status(user_id, TicketStatus.RESOLVED)
+            await set_ticket_status(user_id, TicketStatus.RESOLVED)
             await callback.answer("✅ Решено")
             try:
                 await bot.send_message(
@@ -501,7 +499,7 @@ def get_support_router() -> Router:
             if current_status == TicketStatus.CLOSED.value:
                 await callback.answer("Уже закрыт", show_alert=False)
                 return
-            set_ticket_status(user_id, TicketStatus.CLOSED)
+            await set_ticket_status(user_id, TicketStatus.CLOSED)
             await callback.answer("🔒 Закрыт")
             try:
                 await bot.send_message(
@@ -513,7 +511,7 @@ def get_support_router() -> Router:
                 )
             except:
                 pass
-            thread_id = database.get_support_thread_id(user_id)
+            thread_id = await database.async_get_support_thread_id(user_id)
             if thread_id:
                 try:
                     await bot.close_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=thread_id)
@@ -529,7 +527,7 @@ def get_support_router() -> Router:
             if current_status == TicketStatus.WAITING_USER.value:
                 await callback.answer("Уже ожидает", show_alert=False)
                 return
-            set_ticket_status(user_id, TicketStatus.WAITING_USER)
+            await set_ticket_status(user_id, TicketStatus.WAITING_USER)
             await callback.answer("⏳ Ожидание")
             try:
                 await bot.send_message(
@@ -541,11 +539,11 @@ def get_support_router() -> Router:
                 pass
 
         elif action == "urgent":
-            current_priority = get_ticket_priority(user_id)
+            current_priority = await get_ticket_priority(user_id)
             if current_priority == TicketPriority.URGENT.value:
                 await callback.answer("Уже срочный", show_alert=False)
                 return
-            set_ticket_priority(user_id, TicketPriority.URGENT)
+            await set_ticket_priority(user_id, TicketPriority.URGENT)
             await callback.answer("🔴 Срочно")
 
         try:
@@ -560,7 +558,7 @@ def get_support_router() -> Router:
         rating = int(callback.data.replace("rate_", ""))
         user_id = callback.from_user.id
 
-        database.save_support_rating(user_id, rating)
+        await database.async_save_support_rating(user_id, rating)
 
         stars = "⭐" * rating
         await callback.answer(f"Спасибо за оценку! {stars}")
@@ -571,7 +569,7 @@ def get_support_router() -> Router:
             parse_mode=ParseMode.HTML
         )
 
-        thread_id = database.get_support_thread_id(user_id)
+        thread_id = await database.async_get_support_thread_id(user_id)
         if thread_id and SUPPORT_GROUP_ID:
             try:
                 await callback.bot.send_message(
@@ -586,7 +584,7 @@ def get_support_router() -> Router:
     @support_router.message(F.chat.id == SUPPORT_GROUP_ID, F.message_thread_id)
     async def from_admin_to_user(message: types.Message, bot: Bot):
         thread_id = message.message_thread_id
-        user_id = database.get_user_id_by_thread(thread_id)
+        user_id = await database.async_get_user_id_by_thread(thread_id)
 
         if message.from_user.id == bot.id:
             return
@@ -597,9 +595,9 @@ def get_support_router() -> Router:
         if not user_id:
             return
 
-        status = get_ticket_status(user_id)
+        status = await get_ticket_status(user_id)
         if status == TicketStatus.OPEN.value:
-            set_ticket_status(user_id, TicketStatus.IN_PROGRESS)
+            await set_ticket_status(user_id, TicketStatus.IN_PROGRESS)
 
         try:
             await bot.copy_message(
@@ -26,6 +26,19 @@ class BotController:
         self.support_dp = None
         self.support_task = None
         self.support_is_running = False
+        database.add_settings_listener(self._on_setting_changed)
+
+    def _on_setting_changed(self, key: str, value: str):
+        if not self.shop_is_running:
+            return
+        if key == "yookassa_shop_id":
+            Configuration.account_id = value
+        elif key == "yookassa_secret_key":
+            Configuration.secret_key = value
+        elif key == "admin_telegram_id":
+            handlers.ADMIN_ID = value
+        elif key == "telegram_bot_username":
+            handlers.TELEGRAM_BOT_USERNAME = value
 
     def set_loop(self, loop: asyncio.AbstractEventLoop):
         self._loop = loop
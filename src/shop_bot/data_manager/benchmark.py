@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+
+def _measure(name: str, count: int, op: Callable[[int], None]) -> Dict:
+    latencies = []
+    started = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        op(i)
+        latencies.append(time.perf_counter() - t)
+    return _summary(name, count, time.perf_counter() - started, latencies)
+
+
+def _summary(name: str, count: int, elapsed: float, latencies: List[float]) -> Dict:
+    latencies.sort()
+    return {
+        "name": name,
+        "ops_per_sec": count / elapsed if elapsed else 0.0,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def _measure_threads(name: str, threads: int, per_thread: int, op: Callable[[int], None]) -> Dict:
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(offset: int):
+        local = []
+        for i in range(per_thread):
+            t = time.perf_counter()
+            op(offset + i)
+            local.append(time.perf_counter() - t)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(n * per_thread,)) for n in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return _summary(name, threads * per_thread, time.perf_counter() - started, latencies)
+
+
+async def _measure_async(name: str, count: int, op) -> Dict:
+    latencies = []
+
+    async def one(i: int):
+        t = time.perf_counter()
+        await op(i)
+        latencies.append(time.perf_counter() - t)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return _summary(name, count, time.perf_counter() - started, latencies)
+
+
+def run_workload(ops: int, threads: int) -> List[Dict]:
+    from shop_bot.data_manager import database
+
+    database.initialize_db()
+    expiry_ms = int((time.time() + 30 * 86400) * 1000)
+    results = [
+        _measure("register_user", ops, lambda i: database.register_user_if_not_exists(i + 1, f"user{i}", None)),
+        _measure("add_new_key", ops, lambda i: database.add_new_key(i + 1, "link", expiry_ms, f"uuid-{i}")),
+        _measure("log_transaction", ops, lambda i: database.log_transaction(
+            f"user{i}", None, f"bench-{i}", i + 1, "paid", 100.0, None, None, "Benchmark", "{}")),
+        _measure("update_setting", ops, lambda i: database.update_setting("about_text", f"text {i}")),
+        _measure("get_user", ops, lambda i: database.get_user(i + 1)),
+        _measure("get_user_keys", ops, lambda i: database.get_user_keys(i + 1)),
+        _measure("get_transactions_page", max(ops // 10, 1), lambda i: database.get_transactions_page(per_page=15)),
+        _measure_threads("register_user_threads", threads, ops // threads or 1,
+                         lambda i: database.register_user_if_not_exists(ops + i + 1, f"thread{i}", None)),
+        asyncio.run(_measure_async("async_add_new_key", ops, lambda i: database.async_add_new_key(
+            i + 1, "link", expiry_ms, f"async-{i}"))),
+    ]
+    database.close_connection()
+    return results
+
+
+def _run_profile(profile: str, ops: int, threads: int, commit_window_ms: str) -> List[Dict]:
+    with tempfile.TemporaryDirectory(prefix=f"shopbot-bench-{profile}-") as data_dir:
+        env = dict(os.environ, DB_PROFILE=profile, DATA_DIR=data_dir, DB_COMMIT_WINDOW_MS=commit_window_ms)
+        output = subprocess.run(
+            [sys.executable, "-m", "shop_bot.data_manager.benchmark", "--worker",
+             "--ops", str(ops), "--threads", str(threads)],
+            env=env, check=True, capture_output=True, text=True,
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    from shop_bot.data_manager.database import STORAGE_PROFILES
+
+    parser = argparse.ArgumentParser(description="Compare database storage profiles on this disk")
+    parser.add_argument("--profiles", nargs="+", default=list(STORAGE_PROFILES), choices=list(STORAGE_PROFILES))
+    parser.add_argument("--ops", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_workload(args.ops, args.threads)))
+        return
+
+    commit_modes = {"group commit": os.environ.get("DB_COMMIT_WINDOW_MS", "3"), "direct commit": "0"}
+    results = {
+        profile: {mode: _run_profile(profile, args.ops, args.threads, window_ms) for mode, window_ms in commit_modes.items()}
+        for profile in args.profiles
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for profile, modes in results.items():
+        settings = ", ".join(f"{k}={v}" for k, v in STORAGE_PROFILES[profile].items())
+        for mode, rows in modes.items():
+            print(f"\n[{profile}] {mode} (DB_COMMIT_WINDOW_MS={commit_modes[mode]}) {settings}")
+            print(f"{'operation':<30}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+            for row in rows:
+                print(f"{row['name']:<30}{row['ops_per_sec']:>12.0f}{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
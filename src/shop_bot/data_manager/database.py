@@ -1,12 +1,22 @@
+import asyncio
+import gzip
+import heapq
 import sqlite3
-import aiosqlite
 import json
 import logging
 import os
+import queue
 import re
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import partial, wraps
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from types import MappingProxyType
+from typing import Optional, List, Dict, Any, AsyncIterator, Callable, Iterator, Mapping, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -40,96 +50,324 @@ DB_FILE = DATA_DIR / "data.db"
 OLD_DB_FILE = Path("/app/project") / "users.db"
 OLD_DATA_DB = Path("/app/project") / "data.db"
 
-_sync_conn: Optional[sqlite3.Connection] = None
-
+STORAGE_PROFILES = {
+    "safe": {
+        "synchronous": "FULL",
+        "cache_size": -8000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "wal_autocheckpoint": 1000,
+    },
+    "balanced": {
+        "synchronous": "NORMAL",
+        "cache_size": -32000,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "wal_autocheckpoint": 1000,
+    },
+    "fast": {
+        "synchronous": "OFF",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "wal_autocheckpoint": 4000,
+    },
+}
+STORAGE_PROFILE = os.environ.get("DB_PROFILE", "safe").lower()
+if STORAGE_PROFILE not in STORAGE_PROFILES:
+    logger.warning(f"Unknown DB_PROFILE '{STORAGE_PROFILE}', falling back to 'safe'")
+    STORAGE_PROFILE = "safe"
+
+BACKUP_DIR = DATA_DIR / "backups"
+BACKUP_KEEP = int(os.environ.get("DB_BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.environ.get("DB_BACKUP_PAGES_PER_STEP", "256"))
+
+READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "4"))
+COMMIT_WINDOW_SECONDS = int(os.environ.get("DB_COMMIT_WINDOW_MS", "3")) / 1000
+
+_write_conn: Optional[sqlite3.Connection] = None
+_write_lock = threading.RLock()
+_read_local = threading.local()
+_write_local = threading.local()
+_idle_read_conns: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+
+_settings_cache: Optional[Mapping[str, str]] = None
+_settings_lock = threading.Lock()
+_settings_write_lock = threading.Lock()
+_settings_listeners: List[Callable[[str, str], None]] = []
+
+_db_executor = ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix="db")
 
 def _ensure_data_dir():
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     if OLD_DATA_DB.exists() and not DB_FILE.exists():
-        import shutil
         shutil.copy(OLD_DATA_DB, DB_FILE)
         logger.info(f"Migrated data.db from {OLD_DATA_DB} to {DB_FILE}")
 
 
-def get_sync_conn() -> sqlite3.Connection:
-    global _sync_conn
-    if _sync_conn is None:
-        _ensure_data_dir()
-        _sync_conn = sqlite3.connect(str(DB_FILE), check_same_thread=False, timeout=30)
-        _sync_conn.row_factory = sqlite3.Row
-        _sync_conn.execute("PRAGMA journal_mode=WAL")
-        _sync_conn.execute("PRAGMA synchronous=FULL")
-        _sync_conn.execute("PRAGMA busy_timeout=30000")
-        _sync_conn.set_trace_callback(lambda stmt: logger.debug(f"SQL: {stmt[:100]}"))
-    return _sync_conn
+def _connect(read_only: bool = False) -> sqlite3.Connection:
+    _ensure_data_dir()
+    conn = sqlite3.connect(str(DB_FILE), check_same_thread=False, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if not read_only:
+        conn.isolation_level = None
+        conn.execute("PRAGMA journal_mode=WAL")
+    for pragma, value in STORAGE_PROFILES[STORAGE_PROFILE].items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+    conn.execute("PRAGMA busy_timeout=30000")
+    if read_only:
+        conn.execute("PRAGMA query_only=ON")
+    conn.set_trace_callback(lambda stmt: logger.debug(f"SQL: {stmt[:100]}"))
+    return conn
 
 
-def close_connection():
-    global _sync_conn
-    if _sync_conn:
-        _sync_conn.close()
-        _sync_conn = None
+class _ThreadReadConnection:
+    __slots__ = ("conn",)
 
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
 
-async def get_async_conn() -> aiosqlite.Connection:
-    _ensure_data_dir()
-    conn = await aiosqlite.connect(str(DB_FILE), timeout=30)
-    conn.row_factory = aiosqlite.Row
-    await conn.execute("PRAGMA journal_mode=WAL")
-    await conn.execute("PRAGMA synchronous=FULL")
-    return conn
+    def __del__(self):
+        if self.conn is None:
+            return
+        try:
+            _idle_read_conns.put_nowait(self.conn)
+        except Exception:
+            self.conn.close()
 
 
-def cleanup_duplicate_settings():
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT key FROM bot_settings")
-    keys = [row[0] for row in cursor.fetchall()]
-    for key in keys:
-        cursor.execute("SELECT value FROM bot_settings WHERE key = ? AND value IS NOT NULL AND value != '' ORDER BY rowid DESC LIMIT 1", (key,))
-        row = cursor.fetchone()
-        val = row[0] if row else ""
-        conn.execute("DELETE FROM bot_settings WHERE key = ?", (key,))
-        conn.execute("INSERT INTO bot_settings (key, value) VALUES (?, ?)", (key, val))
-    conn.commit()
-    logger.info("Duplicate settings cleaned up")
+def get_read_conn() -> sqlite3.Connection:
+    holder = getattr(_read_local, "holder", None)
+    if holder is None:
+        try:
+            conn = _idle_read_conns.get_nowait()
+        except queue.Empty:
+            conn = _connect(read_only=True)
+        holder = _read_local.holder = _ThreadReadConnection(conn)
+    return holder.conn
 
 
-def initialize_db():
-    migrate_from_old_db()
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    
+def get_sync_conn() -> sqlite3.Connection:
+    global _write_conn
+    with _write_lock:
+        if _write_conn is None:
+            _write_conn = _connect()
+        return _write_conn
+
+
+class _GroupCommitter:
+    def __init__(self, window: float, retries: int = 3):
+        self.window = window
+        self.retries = retries
+        self._batch: Optional[Future] = None
+        self._opened_at = 0.0
+        self._arriving = 0
+        self._arriving_lock = threading.Lock()
+
+    def arrive(self):
+        with self._arriving_lock:
+            self._arriving += 1
+
+    def join(self) -> Tuple[sqlite3.Connection, Future]:
+        with self._arriving_lock:
+            self._arriving -= 1
+        conn = get_sync_conn()
+        if self._batch is None:
+            conn.execute("BEGIN IMMEDIATE")
+            self._batch = Future()
+            self._opened_at = time.monotonic()
+        return conn, self._batch
+
+    def release(self):
+        if self._arriving and time.monotonic() - self._opened_at < self.window:
+            return
+        self.flush()
+
+    def flush(self):
+        # A batch commits or fails as a whole: if COMMIT cannot be retried, every write that joined it is rolled
+        # back, including writers whose savepoints were already released, and each of them gets the exception.
+        with _write_lock:
+            batch, self._batch = self._batch, None
+            if batch is None:
+                return
+            for attempt in range(1, self.retries + 1):
+                try:
+                    _write_conn.execute("COMMIT")
+                    break
+                except Exception as e:
+                    if attempt < self.retries and isinstance(e, sqlite3.OperationalError) and _write_conn.in_transaction:
+                        logger.warning(f"Group commit attempt {attempt} failed, retrying: {e}")
+                        time.sleep(0.01 * attempt)
+                        continue
+                    logger.error(f"Group commit failed, rolling back the batch: {e}")
+                    if _write_conn.in_transaction:
+                        _write_conn.execute("ROLLBACK")
+                    batch.set_exception(e)
+                    return
+        batch.set_result(None)
+
+
+_group_commit = _GroupCommitter(COMMIT_WINDOW_SECONDS)
+
+
+@contextmanager
+def _write_transaction():
+    depth = getattr(_write_local, "depth", 0)
+    if not depth:
+        _group_commit.arrive()
+    with _write_lock:
+        if depth:
+            conn = get_sync_conn()
+        else:
+            conn, batch = _group_commit.join()
+        _write_local.depth = depth + 1
+        conn.execute("SAVEPOINT write_op")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK TO write_op")
+            conn.execute("RELEASE write_op")
+            raise
+        else:
+            conn.execute("RELEASE write_op")
+        finally:
+            _write_local.depth = depth
+            if not depth:
+                _group_commit.release()
+    if depth:
+        return
+    pending = getattr(_write_local, "pending", None)
+    if pending is not None:
+        pending.append(batch)
+    else:
+        batch.result()
+
+
+@contextmanager
+def _durable_write_transaction():
+    pending, _write_local.pending = getattr(_write_local, "pending", None), None
+    try:
+        with _write_transaction() as conn:
+            yield conn
+    finally:
+        _write_local.pending = pending
+
+
+def close_connection():
+    global _write_conn
+    _group_commit.flush()
+    with _write_lock:
+        if _write_conn:
+            _write_conn.close()
+            _write_conn = None
+    holder = getattr(_read_local, "holder", None)
+    if holder is not None:
+        holder.conn.close()
+        holder.conn = None
+        del _read_local.holder
+    while True:
+        try:
+            _idle_read_conns.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+_backup_lock = threading.Lock()
+_last_backup: Optional[Dict] = None
+
+
+def list_backups() -> List[Dict]:
+    if not BACKUP_DIR.exists():
+        return []
+    backups = []
+    for path in sorted(BACKUP_DIR.glob("data-*.db.gz"), reverse=True):
+        stat = path.stat()
+        backups.append({
+            "file": path.name,
+            "path": path,
+            "size": stat.st_size,
+            "created_at": datetime.fromtimestamp(stat.st_mtime),
+        })
+    return backups
+
+
+def get_last_backup() -> Optional[Dict]:
+    return _last_backup
+
+
+def backup_database() -> Dict:
+    global _last_backup
+    with _backup_lock:
+        _ensure_data_dir()
+        BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+        started = time.monotonic()
+        name = f"data-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+        snapshot = BACKUP_DIR / f"{name}.tmp"
+        archive = BACKUP_DIR / f"{name}.gz"
+        source = _connect(read_only=True)
+        target = sqlite3.connect(str(snapshot))
+        try:
+            source.execute("BEGIN")
+            page_count = source.execute("PRAGMA page_count").fetchone()[0]
+            page_size = source.execute("PRAGMA page_size").fetchone()[0]
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP)
+        finally:
+            source.close()
+            target.close()
+        try:
+            partial = BACKUP_DIR / f"{name}.gz.part"
+            with open(snapshot, "rb") as src, gzip.open(partial, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(partial, archive)
+        finally:
+            snapshot.unlink(missing_ok=True)
+
+        for old in list_backups()[max(BACKUP_KEEP, 1):]:
+            old["path"].unlink(missing_ok=True)
+
+        _last_backup = {
+            "file": archive.name,
+            "size": archive.stat().st_size,
+            "db_size": page_count * page_size,
+            "duration": time.monotonic() - started,
+            "created_at": datetime.now(),
+        }
+    logger.info(f"Database backup {archive.name}: {_last_backup['db_size']} -> {_last_backup['size']} bytes "
+                f"in {_last_backup['duration']:.2f}s")
+    return _last_backup
+
+
+def _migrate_base_schema(cursor: sqlite3.Cursor):
     cursor.execute('''CREATE TABLE IF NOT EXISTS users (
         telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
         total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
         agreed_to_terms BOOLEAN DEFAULT 0, registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         is_banned BOOLEAN DEFAULT 0, referred_by INTEGER,
         referral_balance REAL DEFAULT 0, referral_balance_all REAL DEFAULT 0)''')
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS vpn_keys (
         key_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
         subscription_link TEXT, expiry_date TIMESTAMP, created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         subscription_uuid TEXT)''')
-    
+
     cursor.execute("PRAGMA table_info(vpn_keys)")
     columns = [col[1] for col in cursor.fetchall()]
     if 'subscription_uuid' not in columns:
         cursor.execute("ALTER TABLE vpn_keys ADD COLUMN subscription_uuid TEXT")
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS transactions (
         transaction_id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT,
         payment_id TEXT UNIQUE, user_id INTEGER NOT NULL, status TEXT NOT NULL,
         amount_rub REAL NOT NULL, amount_currency REAL, currency_name TEXT,
         payment_method TEXT, metadata TEXT, created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT NOT NULL DEFAULT '')''')
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS support_threads (
         user_id INTEGER PRIMARY KEY, thread_id INTEGER NOT NULL,
         category TEXT, status TEXT DEFAULT 'open', priority TEXT DEFAULT 'normal',
         created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
+
     cursor.execute("PRAGMA table_info(support_threads)")
     st_columns = [col[1] for col in cursor.fetchall()]
     if 'category' not in st_columns:
@@ -140,19 +378,19 @@ def initialize_db():
         cursor.execute("ALTER TABLE support_threads ADD COLUMN priority TEXT DEFAULT 'normal'")
     if 'created_date' not in st_columns:
         cursor.execute("ALTER TABLE support_threads ADD COLUMN created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS plans (
         plan_id INTEGER PRIMARY KEY AUTOINCREMENT, plan_name TEXT NOT NULL,
         days INTEGER NOT NULL, price REAL NOT NULL)''')
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS platega_pending (
         transaction_id TEXT PRIMARY KEY, metadata TEXT NOT NULL,
         created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS cryptobot_pending (
         invoice_id TEXT PRIMARY KEY, metadata TEXT NOT NULL,
         created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
+
     defaults = {
         "panel_login": "admin", 
         "panel_password": "admin", 
@@ -194,32 +432,431 @@ def initialize_db():
         "linux_url": "https://telegra.ph/Instrukciya-Linux-11-09",
         "setup_completed": "false"
     }
-    
+
     for key, value in defaults.items():
         cursor.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
-    
-    conn.commit()
-    _hydrate_setup_flag_if_configured()
-    cleanup_duplicate_settings()
-    logger.info(f"Database initialized at {DB_FILE}")
 
+    cursor.execute("SELECT key FROM bot_settings GROUP BY key HAVING COUNT(*) > 1")
+    for (key,) in cursor.fetchall():
+        cursor.execute("SELECT value FROM bot_settings WHERE key = ? AND value IS NOT NULL AND value != '' ORDER BY rowid DESC LIMIT 1", (key,))
+        row = cursor.fetchone()
+        cursor.execute("DELETE FROM bot_settings WHERE key = ?", (key,))
+        cursor.execute("INSERT INTO bot_settings (key, value) VALUES (?, ?)", (key, row[0] if row else ""))
+
+    _hydrate_setup_flag_if_configured(cursor)
+
+
+def _migrate_secondary_indexes(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users(registration_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users(referred_by)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_banned ON users(telegram_id) WHERE is_banned = 1")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_id ON vpn_keys(user_id, key_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_date ON vpn_keys(expiry_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_created_date ON vpn_keys(created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_created_date ON transactions(created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_threads_thread_id ON support_threads(thread_id)")
+
+
+def _migrate_expiry_epoch(cursor: sqlite3.Cursor):
+    cursor.execute("ALTER TABLE vpn_keys ADD COLUMN expiry_ts INTEGER")
+    cursor.execute("SELECT key_id, expiry_date FROM vpn_keys WHERE expiry_date IS NOT NULL")
+    backfill = []
+    for key_id, expiry_date in cursor.fetchall():
+        try:
+            backfill.append((int(datetime.fromisoformat(str(expiry_date)).timestamp()), key_id))
+        except ValueError:
+            logger.warning(f"Key {key_id} has unparseable expiry_date {expiry_date!r}, leaving expiry_ts empty")
+    cursor.executemany("UPDATE vpn_keys SET expiry_ts = ? WHERE key_id = ?", backfill)
+    cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_expiry_date")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_ts ON vpn_keys(expiry_ts)")
+
+
+STATS_COUNTER_QUERIES = {
+    "users": "SELECT COUNT(*) FROM users",
+    "banned_users": "SELECT COUNT(*) FROM users WHERE is_banned = 1",
+    "total_spent": "SELECT COALESCE(SUM(total_spent), 0) FROM users",
+    "keys": "SELECT COUNT(*) FROM vpn_keys",
+    "transactions": "SELECT COUNT(*) FROM transactions",
+    "transactions_amount": "SELECT COALESCE(SUM(amount_rub), 0) FROM transactions",
+    "archived_transactions": "SELECT COUNT(*) FROM transactions_archive",
+    "archived_transactions_amount": "SELECT COALESCE(SUM(amount_rub), 0) FROM transactions_archive",
+}
+
+
+def _recompute_stats_counters(cursor: sqlite3.Cursor, names: Optional[tuple] = None) -> Dict[str, tuple]:
+    cursor.execute("SELECT name, value FROM stats_counters")
+    stored = {row[0]: row[1] for row in cursor.fetchall()}
+    drift = {}
+    for name in names or STATS_COUNTER_QUERIES:
+        query = STATS_COUNTER_QUERIES[name]
+        cursor.execute(query)
+        actual = cursor.fetchone()[0] or 0
+        if name not in stored or abs(stored[name] - actual) > 1e-6:
+            drift[name] = (stored.get(name), actual)
+            cursor.execute("INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)", (name, actual))
+    return drift
+
+
+def _migrate_stats_counters(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS stats_counters (name TEXT PRIMARY KEY, value REAL NOT NULL DEFAULT 0)")
+    _recompute_stats_counters(cursor, ("users", "banned_users", "total_spent", "keys", "transactions", "transactions_amount"))
+
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'users' THEN 1
+            WHEN 'banned_users' THEN NEW.is_banned = 1
+            ELSE COALESCE(NEW.total_spent, 0) END
+        WHERE name IN ('users', 'banned_users', 'total_spent');
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - CASE name
+            WHEN 'users' THEN 1
+            WHEN 'banned_users' THEN OLD.is_banned = 1
+            ELSE COALESCE(OLD.total_spent, 0) END
+        WHERE name IN ('users', 'banned_users', 'total_spent');
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_stats_update AFTER UPDATE OF is_banned, total_spent ON users BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'banned_users' THEN (NEW.is_banned = 1) - (OLD.is_banned = 1)
+            ELSE COALESCE(NEW.total_spent, 0) - COALESCE(OLD.total_spent, 0) END
+        WHERE name IN ('banned_users', 'total_spent');
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_stats_insert AFTER INSERT ON vpn_keys BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'keys';
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_stats_delete AFTER DELETE ON vpn_keys BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'keys';
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_transactions_stats_insert AFTER INSERT ON transactions BEGIN
+        UPDATE stats_counters SET value = value + CASE name WHEN 'transactions' THEN 1 ELSE NEW.amount_rub END
+        WHERE name IN ('transactions', 'transactions_amount');
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_transactions_stats_delete AFTER DELETE ON transactions BEGIN
+        UPDATE stats_counters SET value = value - CASE name WHEN 'transactions' THEN 1 ELSE OLD.amount_rub END
+        WHERE name IN ('transactions', 'transactions_amount');
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_transactions_stats_update AFTER UPDATE OF amount_rub ON transactions BEGIN
+        UPDATE stats_counters SET value = value + NEW.amount_rub - OLD.amount_rub WHERE name = 'transactions_amount';
+    END""")
+
+    cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_expiry_ts")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_user ON vpn_keys(expiry_ts, user_id)")
+
+
+def _rebuild_daily_rollups(cursor: sqlite3.Cursor, transaction_tables: tuple = ("transactions",)):
+    transactions = " UNION ALL ".join(
+        f"SELECT created_date, amount_rub, payment_method, status FROM {table}" for table in transaction_tables
+    )
+    cursor.execute("DELETE FROM daily_rollups")
+    cursor.execute("DELETE FROM daily_payment_methods")
+    cursor.execute("""INSERT INTO daily_rollups (day, signups)
+                      SELECT date(registration_date), COUNT(*) FROM users
+                      WHERE registration_date IS NOT NULL GROUP BY 1""")
+    cursor.execute("""INSERT INTO daily_rollups (day, keys_issued)
+                      SELECT date(created_date), COUNT(*) FROM vpn_keys WHERE created_date IS NOT NULL GROUP BY 1
+                      ON CONFLICT(day) DO UPDATE SET keys_issued = excluded.keys_issued""")
+    cursor.execute(f"""INSERT INTO daily_rollups (day, payments, revenue)
+                      SELECT date(created_date), COUNT(*), SUM(amount_rub) FROM ({transactions})
+                      WHERE status = 'paid' AND created_date IS NOT NULL GROUP BY 1
+                      ON CONFLICT(day) DO UPDATE SET payments = excluded.payments, revenue = excluded.revenue""")
+    cursor.execute(f"""INSERT INTO daily_payment_methods (day, payment_method, payments, revenue)
+                      SELECT date(created_date), COALESCE(payment_method, 'Unknown'), COUNT(*), SUM(amount_rub)
+                      FROM ({transactions}) WHERE status = 'paid' AND created_date IS NOT NULL GROUP BY 1, 2""")
+
+
+def _migrate_daily_rollups(cursor: sqlite3.Cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS daily_rollups (
+        day TEXT PRIMARY KEY, signups INTEGER NOT NULL DEFAULT 0, keys_issued INTEGER NOT NULL DEFAULT 0,
+        payments INTEGER NOT NULL DEFAULT 0, revenue REAL NOT NULL DEFAULT 0)""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS daily_payment_methods (
+        day TEXT NOT NULL, payment_method TEXT NOT NULL, payments INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0, PRIMARY KEY (day, payment_method))""")
+    _rebuild_daily_rollups(cursor)
+
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_rollup_insert AFTER INSERT ON users
+        WHEN NEW.registration_date IS NOT NULL BEGIN
+        INSERT INTO daily_rollups (day, signups) VALUES (date(NEW.registration_date), 1)
+            ON CONFLICT(day) DO UPDATE SET signups = signups + 1;
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_rollup_insert AFTER INSERT ON vpn_keys
+        WHEN NEW.created_date IS NOT NULL BEGIN
+        INSERT INTO daily_rollups (day, keys_issued) VALUES (date(NEW.created_date), 1)
+            ON CONFLICT(day) DO UPDATE SET keys_issued = keys_issued + 1;
+    END""")
+    for name, event, condition in (
+        ("trg_transactions_rollup_insert", "AFTER INSERT ON transactions", "NEW.status = 'paid'"),
+        ("trg_transactions_rollup_paid", "AFTER UPDATE OF status ON transactions",
+         "NEW.status = 'paid' AND OLD.status IS NOT 'paid'"),
+    ):
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {name} {event}
+            WHEN {condition} AND NEW.created_date IS NOT NULL BEGIN
+            INSERT INTO daily_rollups (day, payments, revenue) VALUES (date(NEW.created_date), 1, NEW.amount_rub)
+                ON CONFLICT(day) DO UPDATE SET payments = payments + 1, revenue = revenue + excluded.revenue;
+            INSERT INTO daily_payment_methods (day, payment_method, payments, revenue)
+                VALUES (date(NEW.created_date), COALESCE(NEW.payment_method, 'Unknown'), 1, NEW.amount_rub)
+                ON CONFLICT(day, payment_method) DO UPDATE SET payments = payments + 1, revenue = revenue + excluded.revenue;
+        END""")
+
+
+def _create_users_fts(cursor: sqlite3.Cursor) -> bool:
+    try:
+        cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, telegram_id, content='users', content_rowid='telegram_id', tokenize='trigram')""")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 trigram index unavailable, user search will use LIKE: {e}")
+        return False
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, telegram_id) VALUES (NEW.telegram_id, NEW.username, NEW.telegram_id);
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, telegram_id) VALUES ('delete', OLD.telegram_id, OLD.username, OLD.telegram_id);
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF username ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, telegram_id) VALUES ('delete', OLD.telegram_id, OLD.username, OLD.telegram_id);
+        INSERT INTO users_fts (rowid, username, telegram_id) VALUES (NEW.telegram_id, NEW.username, NEW.telegram_id);
+    END""")
+    return True
+
+
+def _migrate_users_fts(cursor: sqlite3.Cursor):
+    _create_users_fts(cursor)
+
+
+def _migrate_users_sort_indexes(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_total_spent ON users(total_spent)")
 
-def _hydrate_setup_flag_if_configured():
+
+TRANSACTION_COLUMNS = ("transaction_id, username, payment_id, user_id, status, amount_rub, amount_currency, "
+                       "currency_name, payment_method, metadata, created_date")
+
+
+def _migrate_transactions_archive(cursor: sqlite3.Cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS transactions_archive (
+        transaction_id INTEGER PRIMARY KEY, username TEXT, payment_id TEXT, user_id INTEGER NOT NULL,
+        status TEXT NOT NULL, amount_rub REAL NOT NULL, amount_currency REAL, currency_name TEXT,
+        payment_method TEXT, metadata TEXT, created_date TIMESTAMP, archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_archive_created_date ON transactions_archive(created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_archive_user_created ON transactions_archive(user_id, created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_archive_payment_id ON transactions_archive(payment_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_pending ON transactions(created_date) WHERE status = 'pending'")
+    _recompute_stats_counters(cursor, ("archived_transactions", "archived_transactions_amount"))
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_transactions_archive_stats_insert AFTER INSERT ON transactions_archive BEGIN
+        UPDATE stats_counters SET value = value + CASE name WHEN 'archived_transactions' THEN 1 ELSE NEW.amount_rub END
+        WHERE name IN ('archived_transactions', 'archived_transactions_amount');
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_transactions_archive_stats_delete AFTER DELETE ON transactions_archive BEGIN
+        UPDATE stats_counters SET value = value - CASE name WHEN 'archived_transactions' THEN 1 ELSE OLD.amount_rub END
+        WHERE name IN ('archived_transactions', 'archived_transactions_amount');
+    END""")
+    cursor.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES ('transactions_archive_days', '365')")
+
+
+def _migrate_transaction_metadata_columns(cursor: sqlite3.Cursor):
+    promoted = {
+        "plan_id": "CAST(json_extract(metadata, '$.plan_id') AS INTEGER)",
+        "plan_name": "json_extract(metadata, '$.plan_name')",
+        "customer_email": "json_extract(metadata, '$.customer_email')",
+        "host_name": "json_extract(metadata, '$.host_name')",
+    }
+    for table in ("transactions", "transactions_archive"):
+        existing = {row[1] for row in cursor.execute(f"PRAGMA table_xinfo({table})").fetchall()}
+        for column, expression in promoted.items():
+            if column not in existing:
+                cursor.execute(f"""ALTER TABLE {table} ADD COLUMN {column}
+                                   GENERATED ALWAYS AS (CASE WHEN json_valid(metadata) THEN {expression} END) VIRTUAL""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_plan_created ON transactions(plan_id, created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_customer_email ON transactions(customer_email)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_archive_plan_created ON transactions_archive(plan_id, created_date)")
+
+
+def _migrate_payment_intents(cursor: sqlite3.Cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS payment_intents (
+        intent_id INTEGER PRIMARY KEY, provider TEXT NOT NULL, external_id TEXT NOT NULL, user_id INTEGER,
+        amount_rub REAL, metadata TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0, next_check_at INTEGER, created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL, UNIQUE (provider, external_id))""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payment_intents_state_check ON payment_intents(state, next_check_at)")
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    for provider, table, id_column in (("platega", "platega_pending", "transaction_id"),
+                                       ("cryptobot", "cryptobot_pending", "invoice_id")):
+        cursor.execute(f"""INSERT OR IGNORE INTO payment_intents
+                           (provider, external_id, user_id, metadata, next_check_at, created_at, updated_at)
+                           SELECT '{provider}', {id_column},
+                                  CASE WHEN json_valid(metadata) THEN json_extract(metadata, '$.user_id') END, metadata,
+                                  {now}, COALESCE(CAST(strftime('%s', created_date) AS INTEGER), {now}), {now}
+                           FROM {table}""")
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute(f"""INSERT OR IGNORE INTO payment_intents
+                       (provider, external_id, user_id, amount_rub, metadata, created_at, updated_at)
+                       SELECT 'ton', payment_id, user_id, amount_rub, COALESCE(metadata, '{{}}'),
+                              COALESCE(CAST(strftime('%s', created_date) AS INTEGER), {now}), {now}
+                       FROM transactions WHERE status = 'pending' AND payment_id IS NOT NULL""")
+
+
+def _migrate_key_notifications(cursor: sqlite3.Cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS key_notifications (
+        key_id INTEGER NOT NULL, mark INTEGER NOT NULL, sent_at INTEGER NOT NULL,
+        PRIMARY KEY (key_id, mark)) WITHOUT ROWID""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_notifications_expiry AFTER UPDATE OF expiry_ts ON vpn_keys
+        WHEN NEW.expiry_ts IS NOT OLD.expiry_ts BEGIN
+        DELETE FROM key_notifications WHERE key_id = NEW.key_id;
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_notifications_delete AFTER DELETE ON vpn_keys BEGIN
+        DELETE FROM key_notifications WHERE key_id = OLD.key_id;
+    END""")
+
+
+def _migrate_expiry_ts_required(cursor: sqlite3.Cursor):
+    cursor.execute("SELECT key_id, expiry_date FROM vpn_keys WHERE expiry_ts IS NULL")
+    for key_id, expiry_date in cursor.fetchall():
+        logger.warning(f"Key {key_id} has no usable expiry ({expiry_date!r}), marking it as expired")
+    cursor.execute("UPDATE vpn_keys SET expiry_ts = 0 WHERE expiry_ts IS NULL")
+    for name, event in (("trg_vpn_keys_expiry_required_insert", "BEFORE INSERT ON vpn_keys"),
+                        ("trg_vpn_keys_expiry_required_update", "BEFORE UPDATE OF expiry_ts ON vpn_keys")):
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {name} {event}
+            WHEN NEW.expiry_ts IS NULL BEGIN
+            SELECT RAISE(ABORT, 'vpn_keys.expiry_ts may not be NULL');
+        END""")
+
+
+def _payment_rollup_delta(row: str, sign: str) -> str:
+    return f"""INSERT INTO daily_rollups (day, payments, revenue)
+            SELECT date({row}.created_date), {sign}1, {sign}{row}.amount_rub
+            WHERE {row}.status = 'paid' AND {row}.created_date IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET payments = payments + excluded.payments, revenue = revenue + excluded.revenue;
+        INSERT INTO daily_payment_methods (day, payment_method, payments, revenue)
+            SELECT date({row}.created_date), COALESCE({row}.payment_method, 'Unknown'), {sign}1, {sign}{row}.amount_rub
+            WHERE {row}.status = 'paid' AND {row}.created_date IS NOT NULL
+            ON CONFLICT(day, payment_method) DO UPDATE SET payments = payments + excluded.payments,
+                                                           revenue = revenue + excluded.revenue;"""
+
+
+def _create_payment_rollup_triggers(cursor: sqlite3.Cursor, delta: Callable[[str, str], str], update_columns: str):
+    for table in ("transactions", "transactions_archive"):
+        for action, event, body in (
+            ("insert", "AFTER INSERT", delta("NEW", "+")),
+            ("delete", "AFTER DELETE", delta("OLD", "-")),
+            ("update", f"AFTER UPDATE OF {update_columns}", delta("OLD", "-") + delta("NEW", "+")),
+        ):
+            cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_rollup_{action}")
+            cursor.execute(f"""CREATE TRIGGER trg_{table}_rollup_{action} {event} ON {table} BEGIN
+        {body}
+    END""")
+
+
+def _migrate_daily_rollup_triggers(cursor: sqlite3.Cursor):
+    cursor.execute("DROP TRIGGER IF EXISTS trg_transactions_rollup_paid")
+    _create_payment_rollup_triggers(cursor, _payment_rollup_delta, "status, amount_rub, created_date, payment_method")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_users_rollup_delete AFTER DELETE ON users
+        WHEN OLD.registration_date IS NOT NULL BEGIN
+        UPDATE daily_rollups SET signups = signups - 1 WHERE day = date(OLD.registration_date);
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_rollup_delete AFTER DELETE ON vpn_keys
+        WHEN OLD.created_date IS NOT NULL BEGIN
+        UPDATE daily_rollups SET keys_issued = keys_issued - 1 WHERE day = date(OLD.created_date);
+    END""")
+    _rebuild_daily_rollups(cursor, ("transactions", "transactions_archive"))
+
+
+def _plan_revenue_rollup_delta(row: str, sign: str) -> str:
+    return _payment_rollup_delta(row, sign) + f"""
+        INSERT INTO daily_plan_revenue (day, plan_id, plan_name, payments, revenue)
+            SELECT date({row}.created_date), COALESCE({row}.plan_id, 0), COALESCE({row}.plan_name, ''),
+                   {sign}1, {sign}{row}.amount_rub
+            WHERE {row}.status = 'paid' AND {row}.created_date IS NOT NULL
+            ON CONFLICT(day, plan_id, plan_name) DO UPDATE SET payments = payments + excluded.payments,
+                                                               revenue = revenue + excluded.revenue;"""
+
+
+def _rebuild_plan_revenue(cursor: sqlite3.Cursor):
+    cursor.execute("DELETE FROM daily_plan_revenue")
+    cursor.execute("""INSERT INTO daily_plan_revenue (day, plan_id, plan_name, payments, revenue)
+                      SELECT date(created_date), COALESCE(plan_id, 0), COALESCE(plan_name, ''), COUNT(*), SUM(amount_rub)
+                      FROM (SELECT created_date, plan_id, plan_name, amount_rub, status FROM transactions
+                            UNION ALL
+                            SELECT created_date, plan_id, plan_name, amount_rub, status FROM transactions_archive)
+                      WHERE status = 'paid' AND created_date IS NOT NULL GROUP BY 1, 2, 3""")
+
+
+def _migrate_plan_revenue_rollups(cursor: sqlite3.Cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS daily_plan_revenue (
+        day TEXT NOT NULL, plan_id INTEGER NOT NULL, plan_name TEXT NOT NULL, payments INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0, PRIMARY KEY (day, plan_id, plan_name)) WITHOUT ROWID""")
+    _create_payment_rollup_triggers(cursor, _plan_revenue_rollup_delta,
+                                    "status, amount_rub, created_date, payment_method, metadata")
+    _rebuild_plan_revenue(cursor)
+
+
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _migrate_base_schema,
+    _migrate_secondary_indexes,
+    _migrate_expiry_epoch,
+    _migrate_stats_counters,
+    _migrate_daily_rollups,
+    _migrate_users_fts,
+    _migrate_users_sort_indexes,
+    _migrate_transactions_archive,
+    _migrate_transaction_metadata_columns,
+    _migrate_payment_intents,
+    _migrate_key_notifications,
+    _migrate_expiry_ts_required,
+    _migrate_daily_rollup_triggers,
+    _migrate_plan_revenue_rollups,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def _get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def initialize_db():
+    migrate_from_old_db()
+    if _get_schema_version(get_read_conn()) != SCHEMA_VERSION:
+        _apply_migrations()
+    _ensure_users_fts()
+
+
+def _ensure_users_fts():
+    global _users_fts_available
+    _users_fts_available = None
+    if _has_users_fts(get_read_conn().cursor()):
+        return
+    with _write_transaction() as conn:
+        _users_fts_available = _create_users_fts(conn.cursor())
+    if _users_fts_available:
+        logger.info("Created the missing users_fts search index")
+
+
+def _apply_migrations():
+    with _write_transaction() as conn:
+        cursor = conn.cursor()
+        version = _get_schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"Database schema version {version} is newer than supported {SCHEMA_VERSION}")
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Applying database migration {number}: {migration.__name__}")
+            migration(cursor)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    invalidate_settings_cache()
+    logger.info(f"Database at {DB_FILE} migrated from version {version} to {SCHEMA_VERSION}")
+
+
+def _hydrate_setup_flag_if_configured(cursor: sqlite3.Cursor):
     """
     Backfill the setup_completed flag for existing installations that already
     have all critical settings in place to avoid forcing the new wizard.
     """
-    try:
-        settings = get_all_settings()
-        required = ["mwshark_api_key", "telegram_bot_token", "telegram_bot_username", "admin_telegram_id"]
-        default_creds = settings.get("panel_login") == "admin" and settings.get("panel_password") == "admin"
-        already_configured = all(settings.get(k) for k in required) and not default_creds
-        setup_completed = settings.get("setup_completed")
-        if already_configured and setup_completed != "true":
-            update_setting("setup_completed", "true")
-            logger.info("Setup flag auto-enabled for existing configured installation.")
-    except Exception as e:
-        logger.error(f"Failed to hydrate setup flag: {e}")
+    cursor.execute("SELECT key, value FROM bot_settings")
+    settings = {row[0]: row[1] for row in cursor.fetchall()}
+    required = ["mwshark_api_key", "telegram_bot_token", "telegram_bot_username", "admin_telegram_id"]
+    default_creds = settings.get("panel_login") == "admin" and settings.get("panel_password") == "admin"
+    already_configured = all(settings.get(k) for k in required) and not default_creds
+    if already_configured and settings.get("setup_completed") != "true":
+        cursor.execute("UPDATE bot_settings SET value = 'true' WHERE key = 'setup_completed'")
+        logger.info("Setup flag auto-enabled for existing configured installation.")
 
 
 def migrate_from_old_db():
@@ -227,7 +864,6 @@ def migrate_from_old_db():
         return
     logger.info(f"Migrating from {OLD_DB_FILE} to {DB_FILE}")
     try:
-        import shutil
         _ensure_data_dir()
         shutil.copy(OLD_DB_FILE, DB_FILE)
         OLD_DB_FILE.rename(OLD_DB_FILE.with_suffix('.db.bak'))
@@ -236,52 +872,154 @@ def migrate_from_old_db():
         logger.error(f"Migration error: {e}")
 
 
+def _load_settings() -> Mapping[str, str]:
+    global _settings_cache
+    with _settings_lock:
+        if _settings_cache is None:
+            cursor = get_read_conn().cursor()
+            cursor.execute("SELECT key, value FROM bot_settings")
+            _settings_cache = MappingProxyType({row['key']: row['value'] or '' for row in cursor.fetchall()})
+        return _settings_cache
+
+
+def invalidate_settings_cache():
+    global _settings_cache
+    with _settings_lock:
+        _settings_cache = None
+
+
+def add_settings_listener(callback: Callable[[str, str], None]):
+    _settings_listeners.append(callback)
+
+
 def get_setting(key: str) -> Optional[str]:
-    key = _sanitize_input(key)
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-    result = cursor.fetchone()
-    if result is None:
-        return None
-    return result[0] or None
+    settings = _settings_cache or _load_settings()
+    return settings.get(key) or None
 
 
 def get_all_settings() -> Dict[str, Any]:
-    conn = get_sync_conn()
-    conn.execute("BEGIN")
-    cursor = conn.cursor()
-    cursor.execute("SELECT key, value FROM bot_settings")
-    result = {}
-    for row in cursor.fetchall():
-        result[row['key']] = row['value'] or ''
-    conn.execute("COMMIT")
-    logger.info(f"get_all_settings returned: {result}")
-    return result
+    return dict(_settings_cache or _load_settings())
+
+
+def update_settings(values: Dict[str, str]):
+    global _settings_cache
+    cleaned = {}
+    for key, value in values.items():
+        key, value = _validate_params(key, value)
+        cleaned[key] = value if value else ""
+    with _settings_write_lock:
+        with _durable_write_transaction() as conn:
+            for key, val in cleaned.items():
+                conn.execute("DELETE FROM bot_settings WHERE key = ?", (key,))
+                conn.execute("INSERT INTO bot_settings (key, value) VALUES (?, ?)", (key, val))
+        with _settings_lock:
+            if _settings_cache is not None:
+                _settings_cache = MappingProxyType({**_settings_cache, **cleaned})
+    for key, val in cleaned.items():
+        for callback in list(_settings_listeners):
+            try:
+                callback(key, val)
+            except Exception as e:
+                logger.error(f"Settings listener error for {key}: {e}")
 
 
 def update_setting(key: str, value: str):
-    key, value = _validate_params(key, value)
-    conn = get_sync_conn()
-    val = value if value else ""
-    conn.execute("DELETE FROM bot_settings WHERE key = ?", (key,))
-    conn.execute("INSERT INTO bot_settings (key, value) VALUES (?, ?)", (key, val))
-    conn.commit()
+    update_settings({key: value})
+
+
+class Record:
+    __slots__ = ()
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return getattr(self, name, default)
+
+    def keys(self) -> List[str]:
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__slots__ and hasattr(self, name)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Record):
+            return NotImplemented
+        return type(self) is type(other) and dict(self) == dict(other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={self[name]!r}" for name in self.keys())
+        return f"{type(self).__name__}({fields})"
+
+
+class User(Record):
+    __slots__ = ("telegram_id", "username", "total_spent", "total_months", "trial_used", "agreed_to_terms",
+                 "registration_date", "is_banned", "referred_by", "referral_balance", "referral_balance_all")
+
+
+class VpnKey(Record):
+    __slots__ = ("key_id", "user_id", "subscription_link", "expiry_date", "created_date", "subscription_uuid",
+                 "expiry_ts")
 
 
-def get_user(telegram_id: int) -> Optional[Dict]:
+class Transaction(Record):
+    __slots__ = ("transaction_id", "username", "payment_id", "user_id", "status", "amount_rub", "amount_currency",
+                 "currency_name", "payment_method", "metadata", "created_date", "archived_at",
+                 "plan_id", "plan_name", "customer_email", "host_name")
+
+
+class Plan(Record):
+    __slots__ = ("plan_id", "plan_name", "days", "price")
+
+
+class PaymentIntent(Record):
+    __slots__ = ("intent_id", "provider", "external_id", "user_id", "amount_rub", "metadata", "state", "attempts",
+                 "next_check_at", "created_at", "updated_at")
+
+
+def _iter_records(cursor: sqlite3.Cursor, record_type: type, batch_size: int = 500) -> Iterator[Record]:
+    cursor.row_factory = None
+    fields = [(index, column[0]) for index, column in enumerate(cursor.description)
+              if column[0] in record_type.__slots__]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            record = record_type.__new__(record_type)
+            for index, name in fields:
+                setattr(record, name, row[index])
+            yield record
+
+
+def _fetch_records(cursor: sqlite3.Cursor, record_type: type) -> list:
+    return list(_iter_records(cursor, record_type))
+
+
+def _fetch_record(cursor: sqlite3.Cursor, record_type: type) -> Optional[Record]:
+    return next(_iter_records(cursor, record_type, 1), None)
+
+
+def get_user(telegram_id: int) -> Optional[User]:
     if not isinstance(telegram_id, int):
         raise ValueError("telegram_id must be integer")
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cursor.fetchone()
-    return dict(row) if row else None
+    return _fetch_record(cursor, User)
 
 
-def get_all_users() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_all_users() -> List[User]:
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
-    return [dict(row) for row in cursor.fetchall()]
+    return _fetch_records(cursor, User)
 
 
 def register_user_if_not_exists(telegram_id: int, username: str, referrer_id: Optional[int]):
@@ -290,207 +1028,219 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id: Op
     username = _sanitize_input(username)
     if referrer_id is not None and not isinstance(referrer_id, int):
         raise ValueError("referrer_id must be integer or None")
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
-    if not cursor.fetchone():
-        cursor.execute("INSERT INTO users (telegram_id, username, registration_date, referred_by) VALUES (?, ?, ?, ?)",
-                       (telegram_id, username, datetime.now(), referrer_id))
-    else:
-        cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
+        if not cursor.fetchone():
+            cursor.execute("INSERT INTO users (telegram_id, username, registration_date, referred_by) VALUES (?, ?, ?, ?)",
+                           (telegram_id, username, datetime.now(), referrer_id))
+        else:
+            cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
 
 
 def ban_user(telegram_id: int):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
 
 
 def unban_user(telegram_id: int):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
 
 
 def set_terms_agreed(telegram_id: int):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
 
 
 def set_trial_used(telegram_id: int):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
 
 
 def reset_trial(telegram_id: int):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET trial_used = 0 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET trial_used = 0 WHERE telegram_id = ?", (telegram_id,))
 
 
 def delete_user(telegram_id: int):
-    conn = get_sync_conn()
-    conn.execute("DELETE FROM vpn_keys WHERE user_id = ?", (telegram_id,))
-    conn.execute("DELETE FROM transactions WHERE user_id = ?", (telegram_id,))
-    conn.execute("DELETE FROM support_threads WHERE user_id = ?", (telegram_id,))
-    conn.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("DELETE FROM vpn_keys WHERE user_id = ?", (telegram_id,))
+        conn.execute("DELETE FROM transactions WHERE user_id = ?", (telegram_id,))
+        conn.execute("DELETE FROM transactions_archive WHERE user_id = ?", (telegram_id,))
+        conn.execute("DELETE FROM support_threads WHERE user_id = ?", (telegram_id,))
+        conn.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
 
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?",
-                 (amount_spent, months_purchased, telegram_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?",
+                     (amount_spent, months_purchased, telegram_id))
 
 
 def reset_user_stats(telegram_id: int):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET total_spent = 0, total_months = 0 WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET total_spent = 0, total_months = 0 WHERE telegram_id = ?", (telegram_id,))
 
 
 def add_to_referral_balance(user_id: int, amount: float):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (amount, user_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (amount, user_id))
 
 
 def set_referral_balance(user_id: int, value: float):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET referral_balance = ? WHERE telegram_id = ?", (value, user_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET referral_balance = ? WHERE telegram_id = ?", (value, user_id))
 
 
 def set_referral_balance_all(user_id: int, value: float):
-    conn = get_sync_conn()
-    conn.execute("UPDATE users SET referral_balance_all = ? WHERE telegram_id = ?", (value, user_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE users SET referral_balance_all = ? WHERE telegram_id = ?", (value, user_id))
 
 
 def get_referral_balance(user_id: int) -> float:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,))
     result = cursor.fetchone()
     return float(result[0]) if result else 0.0
 
 
 def get_referral_count(user_id: int) -> int:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
     return cursor.fetchone()[0] or 0
 
 
-def get_user_keys(user_id: int) -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_user_keys(user_id: int) -> List[VpnKey]:
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
-    return [dict(row) for row in cursor.fetchall()]
+    return _fetch_records(cursor, VpnKey)
+
 
+def get_keys_for_users(user_ids: List[int]) -> Dict[int, List[VpnKey]]:
+    keys = {user_id: [] for user_id in user_ids}
+    if not keys:
+        return keys
+    cursor = get_read_conn().cursor()
+    placeholders = ", ".join("?" * len(keys))
+    cursor.execute(f"SELECT * FROM vpn_keys WHERE user_id IN ({placeholders}) ORDER BY user_id, key_id", tuple(keys))
+    for key in _iter_records(cursor, VpnKey):
+        keys[key.user_id].append(key)
+    return keys
 
-def get_key_by_id(key_id: int) -> Optional[Dict]:
-    cursor = get_sync_conn().cursor()
+
+def get_key_by_id(key_id: int) -> Optional[VpnKey]:
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
-    row = cursor.fetchone()
-    return dict(row) if row else None
+    return _fetch_record(cursor, VpnKey)
 
 
-def get_all_keys() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_all_keys() -> List[VpnKey]:
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM vpn_keys")
-    return [dict(row) for row in cursor.fetchall()]
+    return _fetch_records(cursor, VpnKey)
+
+
+def get_keys_expiring_between(start_ts: int, end_ts: int) -> List[VpnKey]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT * FROM vpn_keys WHERE expiry_ts > ? AND expiry_ts <= ? ORDER BY expiry_ts",
+                   (int(start_ts), int(end_ts)))
+    return _fetch_records(cursor, VpnKey)
+
+
+def get_next_expiry_after(ts: int) -> Optional[int]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT MIN(expiry_ts) FROM vpn_keys WHERE expiry_ts > ?", (int(ts),))
+    return cursor.fetchone()[0]
+
+
+def get_user_latest_expiry(user_id: int) -> Optional[int]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT MAX(expiry_ts) FROM vpn_keys WHERE user_id = ?", (user_id,))
+    return cursor.fetchone()[0]
 
 
 def add_new_key(user_id: int, subscription_link: str, expiry_timestamp_ms: int, subscription_uuid: str = None) -> Optional[int]:
     if not isinstance(user_id, int) or not isinstance(expiry_timestamp_ms, int):
         raise ValueError("Invalid key parameters")
     subscription_link, subscription_uuid = _validate_params(subscription_link, subscription_uuid)
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
-    cursor.execute("INSERT INTO vpn_keys (user_id, subscription_link, expiry_date, subscription_uuid) VALUES (?, ?, ?, ?)",
-                   (user_id, subscription_link, expiry_date, subscription_uuid))
-    conn.commit()
-    return cursor.lastrowid
+    with _write_transaction() as conn:
+        cursor = conn.cursor()
+        expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
+        cursor.execute("INSERT INTO vpn_keys (user_id, subscription_link, expiry_date, expiry_ts, subscription_uuid) VALUES (?, ?, ?, ?, ?)",
+                       (user_id, subscription_link, expiry_date, expiry_timestamp_ms // 1000, subscription_uuid))
+        return cursor.lastrowid
 
 
 def delete_key_by_id(key_id: int):
-    conn = get_sync_conn()
-    conn.execute("DELETE FROM vpn_keys WHERE key_id = ?", (key_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("DELETE FROM vpn_keys WHERE key_id = ?", (key_id,))
 
 
 def delete_user_keys(user_id: int):
-    conn = get_sync_conn()
-    conn.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
 
 
 def update_key_info(key_id: int, subscription_link: str, new_expiry_ms: int, subscription_uuid: str = None):
-    conn = get_sync_conn()
-    expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
-    if subscription_uuid:
-        conn.execute("UPDATE vpn_keys SET subscription_link = ?, expiry_date = ?, subscription_uuid = ? WHERE key_id = ?",
-                     (subscription_link, expiry_date, subscription_uuid, key_id))
-    else:
-        conn.execute("UPDATE vpn_keys SET subscription_link = ?, expiry_date = ? WHERE key_id = ?",
-                     (subscription_link, expiry_date, key_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
+        expiry_ts = int(new_expiry_ms) // 1000
+        if subscription_uuid:
+            conn.execute("UPDATE vpn_keys SET subscription_link = ?, expiry_date = ?, expiry_ts = ?, subscription_uuid = ? WHERE key_id = ?",
+                         (subscription_link, expiry_date, expiry_ts, subscription_uuid, key_id))
+        else:
+            conn.execute("UPDATE vpn_keys SET subscription_link = ?, expiry_date = ?, expiry_ts = ? WHERE key_id = ?",
+                         (subscription_link, expiry_date, expiry_ts, key_id))
 
 
 def update_key_expiry_days(key_id: int, days_delta: int) -> bool:
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT expiry_date FROM vpn_keys WHERE key_id = ?", (key_id,))
-    result = cursor.fetchone()
-    if result:
-        current_expiry = datetime.fromisoformat(str(result[0]))
-        new_expiry = current_expiry + timedelta(days=days_delta)
-        conn.execute("UPDATE vpn_keys SET expiry_date = ? WHERE key_id = ?", (new_expiry, key_id))
-        conn.commit()
-        return True
-    return False
+    with _write_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT expiry_ts FROM vpn_keys WHERE key_id = ?", (key_id,))
+        result = cursor.fetchone()
+        if result and result[0] is not None:
+            new_expiry = datetime.fromtimestamp(result[0]) + timedelta(days=days_delta)
+            conn.execute("UPDATE vpn_keys SET expiry_date = ?, expiry_ts = ? WHERE key_id = ?",
+                         (new_expiry, int(new_expiry.timestamp()), key_id))
+            return True
+        return False
 
 
 def set_key_expiry_date(key_id: int, new_expiry: datetime) -> bool:
-    conn = get_sync_conn()
-    conn.execute("UPDATE vpn_keys SET expiry_date = ? WHERE key_id = ?", (new_expiry, key_id))
-    conn.commit()
-    return True
+    with _write_transaction() as conn:
+        conn.execute("UPDATE vpn_keys SET expiry_date = ?, expiry_ts = ? WHERE key_id = ?",
+                     (new_expiry, int(new_expiry.timestamp()), key_id))
+        return True
 
 
 def get_next_key_number(user_id: int) -> int:
     return len(get_user_keys(user_id)) + 1
 
 
-def get_all_plans() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_all_plans() -> List[Plan]:
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM plans ORDER BY days")
-    return [dict(row) for row in cursor.fetchall()]
+    return _fetch_records(cursor, Plan)
 
 
-def get_plan_by_id(plan_id: int) -> Optional[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_plan_by_id(plan_id: int) -> Optional[Plan]:
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
-    row = cursor.fetchone()
-    return dict(row) if row else None
+    return _fetch_record(cursor, Plan)
 
 
 def create_plan(plan_name: str, days: int, price: float):
     plan_name = _sanitize_input(plan_name)
     if not isinstance(days, int) or not isinstance(price, (int, float)):
         raise ValueError("Invalid plan parameters")
-    conn = get_sync_conn()
-    conn.execute("INSERT INTO plans (plan_name, days, price) VALUES (?, ?, ?)", (plan_name, days, price))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("INSERT INTO plans (plan_name, days, price) VALUES (?, ?, ?)", (plan_name, days, price))
 
 
 def delete_plan(plan_id: int):
-    conn = get_sync_conn()
-    conn.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
 
 
 def log_transaction(username: str, transaction_id: Optional[str], payment_id: Optional[str], user_id: int,
@@ -501,171 +1251,393 @@ def log_transaction(username: str, transaction_id: Optional[str], payment_id: Op
     )
     if not isinstance(user_id, int):
         raise ValueError("user_id must be integer")
-    conn = get_sync_conn()
-    conn.execute("""INSERT INTO transactions (username, payment_id, user_id, status, amount_rub, 
-                    amount_currency, currency_name, payment_method, metadata, created_date)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                 (username, payment_id, user_id, status, amount_rub, amount_currency, currency_name,
-                  payment_method, metadata, datetime.now()))
-    conn.commit()
-
-
-def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata) VALUES (?, ?, ?, ?, ?)",
-                   (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata)))
-    conn.commit()
-    return cursor.lastrowid
-
-
-def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> Optional[Dict]:
-    conn = get_sync_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM transactions WHERE payment_id = ? AND status = 'pending'", (payment_id,))
-    tx = cursor.fetchone()
-    if not tx:
+    with _write_transaction() as conn:
+        conn.execute("""INSERT INTO transactions (username, payment_id, user_id, status, amount_rub, 
+                        amount_currency, currency_name, payment_method, metadata, created_date)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (username, payment_id, user_id, status, amount_rub, amount_currency, currency_name,
+                      payment_method, metadata, datetime.now()))
+
+
+PAYMENT_INTENT_STATES = ("pending", "paid", "canceled", "expired", "failed")
+PAYMENT_POLL_BASE_SECONDS = 60
+PAYMENT_POLL_MAX_SECONDS = 6 * 3600
+
+
+def create_payment_intent(provider: str, external_id: str, metadata: dict, user_id: Optional[int] = None,
+                          amount_rub: Optional[float] = None, poll: bool = False) -> Optional[int]:
+    now = int(time.time())
+    with _write_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""INSERT INTO payment_intents
+                          (provider, external_id, user_id, amount_rub, metadata, next_check_at, created_at, updated_at)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                          ON CONFLICT(provider, external_id) DO UPDATE SET
+                              user_id = excluded.user_id, amount_rub = excluded.amount_rub, metadata = excluded.metadata,
+                              attempts = 0, next_check_at = excluded.next_check_at, updated_at = excluded.updated_at
+                          WHERE payment_intents.state = 'pending'
+                          RETURNING intent_id""",
+                       (provider, str(external_id), user_id, amount_rub, json.dumps(metadata),
+                        now if poll else None, now, now))
+        row = cursor.fetchone()
+    if row is None:
+        logger.warning(f"Payment intent {provider}/{external_id} is already settled, keeping its state")
         return None
-    conn.execute("UPDATE transactions SET status = 'paid', amount_currency = ?, currency_name = 'TON', payment_method = 'TON' WHERE payment_id = ?",
-                 (amount_ton, payment_id))
-    conn.commit()
-    return json.loads(tx['metadata'])
+    return row[0]
 
 
-def create_pending_platega_transaction(transaction_id: str, metadata: str):
-    conn = get_sync_conn()
-    conn.execute("INSERT OR REPLACE INTO platega_pending (transaction_id, metadata) VALUES (?, ?)", (transaction_id, metadata))
-    conn.commit()
+def get_payment_intent(provider: str, external_id: str) -> Optional[PaymentIntent]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT * FROM payment_intents WHERE provider = ? AND external_id = ?", (provider, str(external_id)))
+    return _fetch_record(cursor, PaymentIntent)
 
 
-def get_pending_platega_transaction(transaction_id: str) -> Optional[Dict]:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT metadata FROM platega_pending WHERE transaction_id = ?", (transaction_id,))
-    row = cursor.fetchone()
-    if row:
-        return json.loads(row['metadata'])
-    return None
+def transition_payment_intent(provider: str, external_id: str, state: str,
+                              from_state: str = "pending") -> Optional[Dict]:
+    if state not in PAYMENT_INTENT_STATES:
+        raise ValueError(f"Unknown payment intent state: {state}")
+    with _write_transaction() as conn:
+        row = conn.execute("""UPDATE payment_intents SET state = ?, next_check_at = NULL, updated_at = ?
+                              WHERE provider = ? AND external_id = ? AND state = ?
+                              RETURNING metadata""",
+                           (state, int(time.time()), provider, str(external_id), from_state)).fetchone()
+    if row is None:
+        return None
+    logger.info(f"Payment intent {provider}/{external_id}: {from_state} -> {state}")
+    return json.loads(row[0])
 
 
-def delete_pending_platega_transaction(transaction_id: str):
-    conn = get_sync_conn()
-    conn.execute("DELETE FROM platega_pending WHERE transaction_id = ?", (transaction_id,))
-    conn.commit()
+def claim_payment_intent(provider: str, external_id: Optional[str],
+                         fallback_metadata: Optional[dict] = None) -> Optional[Dict]:
+    if not external_id:
+        return fallback_metadata
+    with _write_transaction() as conn:
+        row = conn.execute("SELECT state FROM payment_intents WHERE provider = ? AND external_id = ?",
+                           (provider, str(external_id))).fetchone()
+        if row is None:
+            if fallback_metadata is None:
+                logger.warning(f"Payment {provider}/{external_id} has no intent and no metadata to process it with")
+                return None
+            now = int(time.time())
+            conn.execute("""INSERT INTO payment_intents
+                            (provider, external_id, user_id, amount_rub, metadata, state, created_at, updated_at)
+                            VALUES (?, ?, ?, ?, ?, 'paid', ?, ?)""",
+                         (provider, str(external_id), fallback_metadata.get("user_id"), fallback_metadata.get("price"),
+                          json.dumps(fallback_metadata), now, now))
+            logger.info(f"Payment {provider}/{external_id} arrived before its intent, recorded it as paid")
+            return fallback_metadata
+        state = row[0]
+        if state == "paid":
+            logger.info(f"Payment {provider}/{external_id} already processed, ignoring repeated notification")
+            return None
+        if state != "pending":
+            logger.warning(f"Payment {provider}/{external_id} confirmed after its intent was {state}, processing it anyway")
+        return transition_payment_intent(provider, external_id, "paid", from_state=state)
 
 
-def get_all_pending_platega_transactions() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT transaction_id, metadata FROM platega_pending")
-    return [{"transaction_id": row['transaction_id'], "metadata": json.loads(row['metadata'])} for row in cursor.fetchall()]
+def get_due_payment_intents(provider: str, limit: int = 500) -> List[PaymentIntent]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("""SELECT * FROM payment_intents WHERE state = 'pending' AND next_check_at <= ? AND provider = ?
+                      ORDER BY next_check_at LIMIT ?""", (int(time.time()), provider, limit))
+    return _fetch_records(cursor, PaymentIntent)
 
 
-def create_pending_cryptobot_invoice(invoice_id: str, metadata: str):
-    conn = get_sync_conn()
-    conn.execute("INSERT OR REPLACE INTO cryptobot_pending (invoice_id, metadata) VALUES (?, ?)", (invoice_id, metadata))
-    conn.commit()
+def reschedule_payment_intents(intent_ids: List[int]):
+    if not intent_ids:
+        return
+    now = int(time.time())
+    with _write_transaction() as conn:
+        conn.execute("""UPDATE payment_intents SET attempts = attempts + 1, updated_at = ?,
+                            next_check_at = ? + MIN(? << MIN(attempts, 16), ?)
+                        WHERE intent_id IN (SELECT value FROM json_each(?)) AND state = 'pending'""",
+                     (now, now, PAYMENT_POLL_BASE_SECONDS, PAYMENT_POLL_MAX_SECONDS, json.dumps(intent_ids)))
+
+
+def expire_payment_intents(older_than_hours: Optional[int] = None) -> int:
+    cutoff = int(time.time()) - (older_than_hours or PENDING_TRANSACTION_TTL_HOURS) * 3600
+    with _write_transaction() as conn:
+        cursor = conn.execute("""UPDATE payment_intents SET state = 'expired', next_check_at = NULL, updated_at = ?
+                                 WHERE state = 'pending' AND created_at < ?""", (int(time.time()), cutoff))
+        expired = cursor.rowcount
+    if expired:
+        logger.info(f"Expired {expired} stale payment intents")
+    return expired
+
+
+def get_payment_intent_stats() -> Dict[str, Dict[str, int]]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT provider, state, COUNT(*) FROM payment_intents GROUP BY provider, state")
+    stats: Dict[str, Dict[str, int]] = {}
+    for provider, state, count in cursor.fetchall():
+        stats.setdefault(provider, {})[state] = count
+    return stats
 
 
-def get_pending_cryptobot_invoice(invoice_id: str) -> Optional[Dict]:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT metadata FROM cryptobot_pending WHERE invoice_id = ?", (invoice_id,))
-    row = cursor.fetchone()
-    if row:
-        return json.loads(row['metadata'])
-    return None
+def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
+    with _write_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata, created_date)
+                          VALUES (?, ?, ?, ?, ?, ?)""",
+                       (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata), datetime.now()))
+        create_payment_intent("ton", payment_id, metadata, user_id, amount_rub)
+        return cursor.lastrowid
 
 
-def delete_pending_cryptobot_invoice(invoice_id: str):
-    conn = get_sync_conn()
-    conn.execute("DELETE FROM cryptobot_pending WHERE invoice_id = ?", (invoice_id,))
-    conn.commit()
+def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> Optional[Dict]:
+    with _write_transaction() as conn:
+        metadata = claim_payment_intent("ton", payment_id)
+        if metadata is None:
+            return None
+        archived = json.dumps([row[0] for row in conn.execute(
+            "SELECT transaction_id FROM transactions_archive WHERE payment_id = ?", (payment_id,)).fetchall()])
+        conn.execute(f"""INSERT INTO transactions ({TRANSACTION_COLUMNS})
+                         SELECT {TRANSACTION_COLUMNS} FROM transactions_archive
+                         WHERE transaction_id IN (SELECT value FROM json_each(?))""", (archived,))
+        conn.execute("DELETE FROM transactions_archive WHERE transaction_id IN (SELECT value FROM json_each(?))", (archived,))
+        conn.execute("UPDATE transactions SET status = 'paid', amount_currency = ?, currency_name = 'TON', payment_method = 'TON' WHERE payment_id = ?",
+                     (amount_ton, payment_id))
+        return metadata
+
+
+def _encode_transaction_cursor(tx: Dict) -> str:
+    return f"{tx['created_date']}_{tx['transaction_id']}"
+
+
+def _decode_transaction_cursor(cursor_value: str) -> tuple:
+    created_date, _, transaction_id = cursor_value.rpartition("_")
+    if not created_date or not transaction_id.isdigit():
+        raise ValueError("Invalid transactions cursor")
+    return created_date, int(transaction_id)
+
+
+def get_transactions_total() -> int:
+    counters = get_stats_counters()
+    return int(counters.get("transactions", 0) + counters.get("archived_transactions", 0))
+
+
+def _archive_newest_created_date(cursor: sqlite3.Cursor) -> Optional[str]:
+    cursor.execute("SELECT MAX(created_date) FROM transactions_archive")
+    return cursor.fetchone()[0]
+
+
+def _fetch_transactions(cursor: sqlite3.Cursor, where: str, params: tuple, descending: bool, limit: int) -> List[Transaction]:
+    columns = "{}, plan_id, customer_email, COALESCE(host_name, 'N/A') AS host_name, COALESCE(plan_name, 'N/A') AS plan_name"
+    direction = "DESC" if descending else "ASC"
+    query = f"SELECT {columns} FROM {{}} {where} ORDER BY created_date {direction}, transaction_id {direction} LIMIT ?"
+    cursor.execute(query.format(TRANSACTION_COLUMNS, "transactions"), (*params, limit))
+    rows = _fetch_records(cursor, Transaction)
+    archive_newest = _archive_newest_created_date(cursor)
+    if archive_newest is None:
+        return rows
+    if descending and len(rows) == limit and rows[-1]['created_date'] > archive_newest:
+        return rows
+    if not descending and params and params[0] > archive_newest:
+        return rows
+    cursor.execute(query.format(TRANSACTION_COLUMNS, "transactions_archive"), (*params, limit))
+    archived = _fetch_records(cursor, Transaction)
+    sort_key = lambda tx: (tx['created_date'] or '', tx['transaction_id'])
+    return list(heapq.merge(rows, archived, key=sort_key, reverse=descending))[:limit]
+
+
+def get_transactions_page(before: Optional[str] = None, after: Optional[str] = None, per_page: int = 15) -> Dict:
+    cursor = get_read_conn().cursor()
+    if after:
+        rows = _fetch_transactions(cursor, "WHERE (created_date, transaction_id) > (?, ?)",
+                                   _decode_transaction_cursor(after), False, per_page + 1)
+        has_prev, has_next = len(rows) > per_page, True
+        rows = rows[:per_page][::-1]
+    else:
+        if before:
+            rows = _fetch_transactions(cursor, "WHERE (created_date, transaction_id) < (?, ?)",
+                                       _decode_transaction_cursor(before), True, per_page + 1)
+        else:
+            rows = _fetch_transactions(cursor, "", (), True, per_page + 1)
+        has_prev, has_next = before is not None, len(rows) > per_page
+        rows = rows[:per_page]
+    return {
+        "transactions": rows,
+        "prev_cursor": _encode_transaction_cursor(rows[0]) if has_prev and rows else None,
+        "next_cursor": _encode_transaction_cursor(rows[-1]) if has_next and rows else None,
+        "total": get_transactions_total(),
+    }
 
 
-def get_all_pending_cryptobot_invoices() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT invoice_id, metadata FROM cryptobot_pending")
-    return [{"invoice_id": row['invoice_id'], "metadata": json.loads(row['metadata'])} for row in cursor.fetchall()]
+PENDING_TRANSACTION_TTL_HOURS = 48
+
+
+def archive_transactions(older_than_days: Optional[int] = None, batch_size: int = 5000) -> int:
+    if older_than_days is None:
+        older_than_days = int(get_setting("transactions_archive_days") or 0)
+    now = datetime.now()
+    cutoff = str(now - timedelta(days=older_than_days)) if older_than_days > 0 else ""
+    pending_cutoff = str(now - timedelta(hours=PENDING_TRANSACTION_TTL_HOURS))
+    moved = 0
+    while True:
+        with _write_transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""SELECT transaction_id FROM transactions
+                              WHERE created_date < ? OR (status = 'pending' AND created_date < ?) LIMIT ?""",
+                           (cutoff, pending_cutoff, batch_size))
+            ids = json.dumps([row[0] for row in cursor.fetchall()])
+            cursor.execute(f"""INSERT INTO transactions_archive ({TRANSACTION_COLUMNS}, archived_at)
+                               SELECT {TRANSACTION_COLUMNS}, ? FROM transactions
+                               WHERE transaction_id IN (SELECT value FROM json_each(?))""", (now, ids))
+            cursor.execute("DELETE FROM transactions WHERE transaction_id IN (SELECT value FROM json_each(?))", (ids,))
+            batch = cursor.rowcount
+        moved += batch
+        if batch < batch_size:
+            break
+    if moved:
+        logger.info(f"Archived {moved} transactions (horizon {older_than_days} days, pending after {PENDING_TRANSACTION_TTL_HOURS}h)")
+    return moved
+
+
+def get_plan_revenue(date_from: Optional[str] = None, date_to: Optional[str] = None) -> List[Dict]:
+    conditions, params = [], {}
+    if date_from:
+        conditions.append("r.day >= date(:date_from)")
+        params["date_from"] = date_from
+    if date_to:
+        conditions.append("r.day <= date(:date_to)")
+        params["date_to"] = date_to
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor = get_read_conn().cursor()
+    cursor.execute(f"""SELECT NULLIF(r.plan_id, 0) AS plan_id,
+                              COALESCE(p.plan_name, MAX(NULLIF(r.plan_name, '')), 'N/A') AS plan_name,
+                              SUM(r.payments) AS payments, SUM(r.revenue) AS revenue
+                       FROM daily_plan_revenue r LEFT JOIN plans p ON p.plan_id = r.plan_id {where}
+                       GROUP BY r.plan_id HAVING SUM(r.payments) > 0 ORDER BY revenue DESC""", params)
+    return [dict(row) for row in cursor.fetchall()]
 
 
-def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple:
-    offset = (page - 1) * per_page
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT COUNT(*) FROM transactions")
-    total = cursor.fetchone()[0]
-    cursor.execute("SELECT * FROM transactions ORDER BY created_date DESC LIMIT ? OFFSET ?", (per_page, offset))
-    transactions = []
-    for row in cursor.fetchall():
-        tx = dict(row)
-        if tx.get('metadata'):
-            try:
-                meta = json.loads(tx['metadata'])
-                tx['host_name'] = meta.get('host_name', 'N/A')
-                tx['plan_name'] = meta.get('plan_name', 'N/A')
-            except:
-                tx['host_name'] = tx['plan_name'] = 'N/A'
+EXPORTS = {
+    "users": {
+        "table": "users", "date_column": "registration_date", "order": "telegram_id",
+        "statuses": {"active": "is_banned = 0", "banned": "is_banned = 1"},
+    },
+    "keys": {
+        "table": "vpn_keys", "date_column": "created_date", "order": "key_id",
+        "statuses": {"active": "expiry_ts > :now", "expired": "expiry_ts <= :now"},
+    },
+    "transactions": {
+        "table": "transactions", "date_column": "created_date", "order": "transaction_id",
+        "statuses": None, "columns": f"{TRANSACTION_COLUMNS}, plan_id, plan_name, customer_email",
+        "archive": "transactions_archive",
+    },
+}
+
+
+def iter_export_rows(kind: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                     status: Optional[str] = None, batch_size: int = 1000) -> Tuple[List[str], Iterator[tuple]]:
+    export = EXPORTS.get(kind)
+    if export is None:
+        raise ValueError(f"Unknown export: {kind}")
+    conditions, params = [], {"now": int(time.time())}
+    if date_from:
+        conditions.append(f"{export['date_column']} >= date(:date_from)")
+        params["date_from"] = date_from
+    if date_to:
+        conditions.append(f"{export['date_column']} < date(:date_to, '+1 day')")
+        params["date_to"] = date_to
+    if status:
+        if export["statuses"] is None:
+            conditions.append("status = :status")
+            params["status"] = _sanitize_input(status)
+        elif status in export["statuses"]:
+            conditions.append(export["statuses"][status])
         else:
-            tx['host_name'] = tx['plan_name'] = 'N/A'
-        transactions.append(tx)
-    return transactions, total
+            raise ValueError(f"Unknown {kind} status: {status}")
+    conditions.append(f"{export['order']} > :after")
+    where = f"WHERE {' AND '.join(conditions)}"
+    cursor = get_read_conn().cursor()
+    query = f"SELECT {export.get('columns', '*')} FROM {export['table']} {where}"
+    if export.get("archive"):
+        cursor.execute(f"SELECT MAX({export['date_column']}) FROM {export['archive']}")
+        archive_newest = cursor.fetchone()[0]
+        if archive_newest is not None and (not date_from or archive_newest >= date_from):
+            query += f" UNION ALL SELECT {export['columns']} FROM {export['archive']} {where}"
+    query += f" ORDER BY {export['order']} LIMIT :limit"
+    cursor.row_factory = None
+
+    def fetch_batch(after: int) -> List[tuple]:
+        cursor.execute(query, {**params, "after": after, "limit": batch_size})
+        return cursor.fetchall()
+
+    first_batch = fetch_batch(-2 ** 63)
+    columns = [column[0] for column in cursor.description]
+    position = columns.index(export["order"])
+
+    def rows() -> Iterator[tuple]:
+        batch = first_batch
+        try:
+            while batch:
+                yield from batch
+                if len(batch) < batch_size:
+                    break
+                batch = fetch_batch(batch[-1][position])
+        finally:
+            cursor.close()
+
+    return columns, rows()
 
 
 def get_recent_transactions(limit: int = 15) -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("""SELECT k.key_id, k.created_date, u.telegram_id, u.username
                       FROM vpn_keys k JOIN users u ON k.user_id = u.telegram_id
                       ORDER BY k.created_date DESC LIMIT ?""", (limit,))
     return [dict(row) for row in cursor.fetchall()]
 
 
-def get_latest_transaction(user_id: int) -> Optional[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_latest_transaction(user_id: int) -> Optional[Transaction]:
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT * FROM transactions WHERE user_id = ? ORDER BY created_date DESC LIMIT 1", (user_id,))
-    row = cursor.fetchone()
-    return dict(row) if row else None
+    tx = _fetch_record(cursor, Transaction)
+    if tx is None:
+        cursor.execute("SELECT * FROM transactions_archive WHERE user_id = ? ORDER BY created_date DESC LIMIT 1", (user_id,))
+        tx = _fetch_record(cursor, Transaction)
+    return tx
 
 
 def add_support_thread(user_id: int, thread_id: int, category: str = None):
-    conn = get_sync_conn()
-    conn.execute("INSERT OR REPLACE INTO support_threads (user_id, thread_id, category) VALUES (?, ?, ?)", (user_id, thread_id, category))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO support_threads (user_id, thread_id, category) VALUES (?, ?, ?)", (user_id, thread_id, category))
 
 
 def get_support_thread_id(user_id: int) -> Optional[int]:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT thread_id FROM support_threads WHERE user_id = ?", (user_id,))
     result = cursor.fetchone()
     return result[0] if result else None
 
 
 def get_support_ticket_status(user_id: int) -> Optional[str]:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT status FROM support_threads WHERE user_id = ?", (user_id,))
     result = cursor.fetchone()
     return result[0] if result else None
 
 
 def update_support_ticket_status(user_id: int, status: str):
-    conn = get_sync_conn()
-    conn.execute("UPDATE support_threads SET status = ? WHERE user_id = ?", (status, user_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE support_threads SET status = ? WHERE user_id = ?", (status, user_id))
 
 
 def get_support_ticket_priority(user_id: int) -> Optional[str]:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT priority FROM support_threads WHERE user_id = ?", (user_id,))
     result = cursor.fetchone()
     return result[0] if result else None
 
 
 def update_support_ticket_priority(user_id: int, priority: str):
-    conn = get_sync_conn()
-    conn.execute("UPDATE support_threads SET priority = ? WHERE user_id = ?", (priority, user_id))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("UPDATE support_threads SET priority = ? WHERE user_id = ?", (priority, user_id))
 
 
 def delete_support_thread(user_id: int):
-    conn = get_sync_conn()
-    conn.execute("DELETE FROM support_threads WHERE user_id = ?", (user_id,))
-    conn.commit()
+    with _write_transaction() as conn:
+        conn.execute("DELETE FROM support_threads WHERE user_id = ?", (user_id,))
 
 
 def increment_ticket_messages(user_id: int):
@@ -681,133 +1653,412 @@ def save_support_rating(user_id: int, rating: int):
 
 
 def get_user_id_by_thread(thread_id: int) -> Optional[int]:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT user_id FROM support_threads WHERE thread_id = ?", (thread_id,))
     result = cursor.fetchone()
     return result[0] if result else None
 
 
+def get_stats_counters() -> Dict[str, float]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT name, value FROM stats_counters")
+    return {row['name']: row['value'] for row in cursor.fetchall()}
+
+
+def get_key_activity_counts() -> Dict[str, int]:
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM vpn_keys WHERE expiry_ts > ?", (int(time.time()),))
+    active_keys, users_with_active_keys = cursor.fetchone()
+    return {
+        'active_keys': active_keys,
+        'expired_keys': int(get_stats_counters().get('keys', 0)) - active_keys,
+        'users_with_active_keys': users_with_active_keys,
+    }
+
+
+def reconcile_stats_counters() -> Dict[str, tuple]:
+    with _write_transaction() as conn:
+        drift = _recompute_stats_counters(conn.cursor())
+    for name, (stored, actual) in drift.items():
+        logger.warning(f"Stats counter '{name}' drifted: stored {stored}, actual {actual}")
+    return drift
+
+
 def get_user_count() -> int:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT COUNT(*) FROM users")
-    return cursor.fetchone()[0] or 0
+    return int(get_stats_counters().get('users', 0))
 
 
 def get_total_keys_count() -> int:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT COUNT(*) FROM vpn_keys")
-    return cursor.fetchone()[0] or 0
+    return int(get_stats_counters().get('keys', 0))
 
 
 def get_total_spent_sum() -> float:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT SUM(total_spent) FROM users")
-    return cursor.fetchone()[0] or 0.0
+    return get_stats_counters().get('total_spent', 0.0)
 
 
 def get_all_vpn_users() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+    cursor = get_read_conn().cursor()
     cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
     return [dict(row) for row in cursor.fetchall()]
 
 
 def get_daily_stats_for_charts(days: int = 30) -> Dict:
-    stats = {'users': {}, 'keys': {}}
-    cursor = get_sync_conn().cursor()
-    cursor.execute("""SELECT date(registration_date) as day, COUNT(*) FROM users 
-                      WHERE registration_date >= date('now', ?) GROUP BY day ORDER BY day""", (f'-{days} days',))
+    stats = {'days': days, 'users': {}, 'keys': {}, 'revenue': {}, 'payment_methods': {}}
+    cursor = get_read_conn().cursor()
+    cursor.execute("SELECT * FROM daily_rollups WHERE day >= date('now', ?) ORDER BY day", (f'-{days} days',))
     for row in cursor.fetchall():
-        stats['users'][row[0]] = row[1]
-    cursor.execute("""SELECT date(created_date) as day, COUNT(*) FROM vpn_keys 
-                      WHERE created_date >= date('now', ?) GROUP BY day ORDER BY day""", (f'-{days} days',))
+        stats['users'][row['day']] = row['signups']
+        stats['keys'][row['day']] = row['keys_issued']
+        stats['revenue'][row['day']] = row['revenue']
+    cursor.execute("""SELECT payment_method, SUM(payments), SUM(revenue) FROM daily_payment_methods
+                      WHERE day >= date('now', ?) GROUP BY payment_method ORDER BY 3 DESC""", (f'-{days} days',))
     for row in cursor.fetchall():
-        stats['keys'][row[0]] = row[1]
+        stats['payment_methods'][row[0]] = {'payments': row[1], 'revenue': row[2]}
     return stats
 
 
-def search_users(query: str) -> List[Dict]:
-    query = _sanitize_input(query)
+def rebuild_daily_rollups():
+    with _write_transaction() as conn:
+        cursor = conn.cursor()
+        _rebuild_daily_rollups(cursor, ("transactions", "transactions_archive"))
+        _rebuild_plan_revenue(cursor)
+    logger.info("Daily rollups rebuilt from history")
+
+
+TELEGRAM_ID_MAX_DIGITS = 16
+_users_fts_available: Optional[bool] = None
+
+
+def _has_users_fts(cursor: sqlite3.Cursor) -> bool:
+    global _users_fts_available
+    if _users_fts_available is None:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'")
+        _users_fts_available = cursor.fetchone() is not None
+    return _users_fts_available
+
+
+def _telegram_id_prefix_ranges(prefix: str) -> List[tuple]:
+    if not prefix.isdigit() or prefix.startswith("0") or len(prefix) > TELEGRAM_ID_MAX_DIGITS:
+        return []
+    base = int(prefix)
+    return [(base * 10 ** extra, (base + 1) * 10 ** extra - 1)
+            for extra in range(TELEGRAM_ID_MAX_DIGITS - len(prefix) + 1)]
+
+
+def search_users(query: str, limit: int = 50, offset: int = 0) -> List[User]:
+    query = _sanitize_input(query.strip())
     if len(query) > 100:
         raise ValueError("Search query too long")
-    cursor = get_sync_conn().cursor()
-    pattern = f"%{query}%"
-    cursor.execute("""SELECT * FROM users WHERE username LIKE ? OR CAST(telegram_id AS TEXT) LIKE ?
-                      ORDER BY registration_date DESC""", (pattern, pattern))
-    return [dict(row) for row in cursor.fetchall()]
+    if not query:
+        return []
+    cursor = get_read_conn().cursor()
+    conditions, params = [], []
+    for low, high in _telegram_id_prefix_ranges(query):
+        conditions.append("telegram_id BETWEEN ? AND ?")
+        params.extend((low, high))
+    if len(query) >= 3 and _has_users_fts(cursor):
+        conditions.append("telegram_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)")
+        params.append('"' + query.replace('"', '""') + '"')
+    elif not query.isdigit() or not conditions:
+        conditions.append("username LIKE ?")
+        params.append(f"%{query}%")
+    cursor.execute(f"""SELECT * FROM users WHERE {' OR '.join(conditions)}
+                       ORDER BY registration_date DESC LIMIT ? OFFSET ?""", (*params, limit, offset))
+    return _fetch_records(cursor, User)
+
+
+USER_SORT_COLUMNS = ("registration_date", "total_spent", "telegram_id")
+
+
+def _user_filter_conditions(filter_type: str) -> Tuple[List[str], List[Any]]:
+    conditions, params = [], []
+    if filter_type == "active":
+        conditions.append("EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = users.telegram_id AND k.expiry_ts > ?)")
+        params.append(int(time.time()))
+    elif filter_type == "nokeys":
+        conditions.append("NOT EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = users.telegram_id)")
+    elif filter_type == "banned":
+        conditions.append("is_banned = 1")
+    elif filter_type == "not_banned":
+        conditions.append("is_banned = 0")
+    return conditions, params
+
+
+def get_users_page(filter_type: str = "all", sort: str = "registration_date", descending: bool = True,
+                   limit: int = 50, offset: int = 0) -> List[User]:
+    if sort not in USER_SORT_COLUMNS:
+        raise ValueError(f"Unsupported sort column: {sort}")
+    conditions, params = _user_filter_conditions(filter_type)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    direction = "DESC" if descending else "ASC"
+    cursor = get_read_conn().cursor()
+    cursor.execute(f"SELECT * FROM users {where} ORDER BY {sort} {direction}, telegram_id {direction} LIMIT ? OFFSET ?",
+                   (*params, limit, offset))
+    return _fetch_records(cursor, User)
+
+
+def get_users_batch(filter_type: str = "all", after_id: Optional[int] = None, batch_size: int = 1000) -> List[User]:
+    conditions, params = _user_filter_conditions(filter_type)
+    if after_id is not None:
+        conditions.append("telegram_id > ?")
+        params.append(after_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor = get_read_conn().cursor()
+    cursor.execute(f"SELECT * FROM users {where} ORDER BY telegram_id LIMIT ?", (*params, batch_size))
+    return _fetch_records(cursor, User)
+
+
+def iter_users(filter_type: str = "all", batch_size: int = 1000) -> Iterator[User]:
+    after_id = None
+    while True:
+        batch = get_users_batch(filter_type, after_id, batch_size)
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        after_id = batch[-1].telegram_id
+
+
+def _key_position(key: VpnKey, expiring_between: Optional[Tuple[int, int]]) -> tuple:
+    return (key.expiry_ts, key.user_id, key.key_id) if expiring_between else (key.key_id,)
+
+
+def get_keys_batch(after: Optional[tuple] = None, batch_size: int = 1000,
+                   expiring_between: Optional[Tuple[int, int]] = None,
+                   unnotified_mark: Optional[int] = None) -> List[VpnKey]:
+    conditions, params, order = [], [], "key_id"
+    if expiring_between:
+        start_ts, end_ts = (int(ts) for ts in expiring_between)
+        order = "expiry_ts, user_id, key_id"
+        if after:
+            conditions.append("(expiry_ts, user_id, key_id) > (?, ?, ?) AND expiry_ts <= ?")
+            params.extend((*after, end_ts))
+        else:
+            conditions.append("expiry_ts > ? AND expiry_ts <= ?")
+            params.extend((start_ts, end_ts))
+    elif after:
+        conditions.append("key_id > ?")
+        params.extend(after)
+    if unnotified_mark is not None:
+        conditions.append("NOT EXISTS (SELECT 1 FROM key_notifications n WHERE n.key_id = vpn_keys.key_id AND n.mark = ?)")
+        params.append(unnotified_mark)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor = get_read_conn().cursor()
+    cursor.execute(f"SELECT * FROM vpn_keys {where} ORDER BY {order} LIMIT ?", (*params, batch_size))
+    return _fetch_records(cursor, VpnKey)
+
+
+def iter_keys(expiring_between: Optional[Tuple[int, int]] = None, batch_size: int = 1000,
+              unnotified_mark: Optional[int] = None) -> Iterator[VpnKey]:
+    after = None
+    while True:
+        batch = get_keys_batch(after, batch_size, expiring_between, unnotified_mark)
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        after = _key_position(batch[-1], expiring_between)
+
+
+def mark_keys_notified(key_ids: List[int], mark: int):
+    if not key_ids:
+        return
+    now = int(time.time())
+    with _write_transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO key_notifications (key_id, mark, sent_at) VALUES (?, ?, ?)",
+                         [(key_id, mark, now) for key_id in key_ids])
+
+
+KEY_NOTIFICATION_GRACE_HOURS = 72
+
+
+def prune_key_notifications(older_than_hours: Optional[int] = None) -> int:
+    cutoff = int(time.time()) - (older_than_hours or KEY_NOTIFICATION_GRACE_HOURS) * 3600
+    with _write_transaction() as conn:
+        cursor = conn.execute("""DELETE FROM key_notifications WHERE key_id IN
+                                 (SELECT key_id FROM vpn_keys WHERE expiry_ts <= ?)""", (cutoff,))
+        pruned = cursor.rowcount
+    if pruned:
+        logger.info(f"Pruned {pruned} notification marks of expired keys")
+    return pruned
 
 
-def get_users_with_active_keys() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_users_with_active_keys() -> List[User]:
+    cursor = get_read_conn().cursor()
     cursor.execute("""SELECT DISTINCT u.* FROM users u INNER JOIN vpn_keys k ON u.telegram_id = k.user_id
-                      WHERE k.expiry_date > datetime('now') ORDER BY u.registration_date DESC""")
-    return [dict(row) for row in cursor.fetchall()]
+                      WHERE k.expiry_ts > ? ORDER BY u.registration_date DESC""", (int(time.time()),))
+    return _fetch_records(cursor, User)
 
 
-def get_users_without_keys() -> List[Dict]:
-    cursor = get_sync_conn().cursor()
+def get_users_without_keys() -> List[User]:
+    cursor = get_read_conn().cursor()
     cursor.execute("""SELECT u.* FROM users u LEFT JOIN vpn_keys k ON u.telegram_id = k.user_id
                       WHERE k.key_id IS NULL ORDER BY u.registration_date DESC""")
-    return [dict(row) for row in cursor.fetchall()]
+    return _fetch_records(cursor, User)
 
 
 def get_banned_users_count() -> int:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
-    return cursor.fetchone()[0] or 0
+    return int(get_stats_counters().get('banned_users', 0))
 
 
 def get_active_keys_count() -> int:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT COUNT(*) FROM vpn_keys WHERE expiry_date > datetime('now')")
-    return cursor.fetchone()[0] or 0
+    return get_key_activity_counts()['active_keys']
 
 
 def get_expired_keys_count() -> int:
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT COUNT(*) FROM vpn_keys WHERE expiry_date <= datetime('now')")
-    return cursor.fetchone()[0] or 0
+    return get_key_activity_counts()['expired_keys']
 
 
 def get_transactions_stats() -> Dict:
     stats = {'total': 0, 'today': 0, 'week': 0, 'month': 0, 'total_amount': 0}
-    cursor = get_sync_conn().cursor()
-    cursor.execute("SELECT COUNT(*), COALESCE(SUM(amount_rub), 0) FROM transactions")
-    row = cursor.fetchone()
-    stats['total'] = row[0] or 0
-    stats['total_amount'] = row[1] or 0
-    cursor.execute("SELECT COUNT(*) FROM transactions WHERE date(created_date) = date('now')")
-    stats['today'] = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT COUNT(*) FROM transactions WHERE created_date >= date('now', '-7 days')")
-    stats['week'] = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT COUNT(*) FROM transactions WHERE created_date >= date('now', '-30 days')")
-    stats['month'] = cursor.fetchone()[0] or 0
+    counters = get_stats_counters()
+    stats['total'] = int(counters.get('transactions', 0) + counters.get('archived_transactions', 0))
+    stats['total_amount'] = counters.get('transactions_amount', 0) + counters.get('archived_transactions_amount', 0)
+    cursor = get_read_conn().cursor()
+    archive_newest = _archive_newest_created_date(cursor)
+    ranges = {
+        'today': ("date('now')", "date('now', '+1 day')"),
+        'week': ("date('now', '-7 days')", None),
+        'month': ("date('now', '-30 days')", None),
+    }
+    for name, (start, end) in ranges.items():
+        where = f"created_date >= {start}" + (f" AND created_date < {end}" if end else "")
+        cursor.execute(f"SELECT COUNT(*), {start} FROM transactions WHERE {where}")
+        count, range_start = cursor.fetchone()
+        if archive_newest is not None and archive_newest >= range_start:
+            cursor.execute(f"SELECT COUNT(*) FROM transactions_archive WHERE {where}")
+            count += cursor.fetchone()[0]
+        stats[name] = count or 0
     return stats
 
 
-async def async_get_user(telegram_id: int) -> Optional[Dict]:
-    async with await get_async_conn() as conn:
-        cursor = await conn.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+def _call_deferring_commit(func: Callable, args: tuple, kwargs: dict) -> tuple:
+    _write_local.pending = pending = []
+    try:
+        return func(*args, **kwargs), pending
+    finally:
+        _write_local.pending = None
 
 
-async def async_get_user_keys(user_id: int) -> List[Dict]:
-    async with await get_async_conn() as conn:
-        cursor = await conn.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
-        return [dict(row) for row in await cursor.fetchall()]
+def _run_in_db_thread(func: Callable) -> Callable:
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        result, pending = await loop.run_in_executor(
+            _db_executor, partial(_call_deferring_commit, func, args, kwargs)
+        )
+        for batch in pending:
+            await asyncio.wrap_future(batch)
+        return result
+    return wrapper
 
 
 async def async_get_setting(key: str) -> Optional[str]:
-    async with await get_async_conn() as conn:
-        cursor = await conn.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-        row = await cursor.fetchone()
-        if row is None:
-            return None
-        val = row[0]
-        return val if val else None
-
-
-async def async_get_all_plans() -> List[Dict]:
-    async with await get_async_conn() as conn:
-        cursor = await conn.execute("SELECT * FROM plans ORDER BY days")
-        return [dict(row) for row in await cursor.fetchall()]
+    return get_setting(key)
+
+
+async_get_user = _run_in_db_thread(get_user)
+async_get_all_users = _run_in_db_thread(get_all_users)
+async_register_user_if_not_exists = _run_in_db_thread(register_user_if_not_exists)
+async_ban_user = _run_in_db_thread(ban_user)
+async_unban_user = _run_in_db_thread(unban_user)
+async_set_terms_agreed = _run_in_db_thread(set_terms_agreed)
+async_set_trial_used = _run_in_db_thread(set_trial_used)
+async_reset_trial = _run_in_db_thread(reset_trial)
+async_delete_user = _run_in_db_thread(delete_user)
+async_update_user_stats = _run_in_db_thread(update_user_stats)
+async_reset_user_stats = _run_in_db_thread(reset_user_stats)
+async_add_to_referral_balance = _run_in_db_thread(add_to_referral_balance)
+async_set_referral_balance = _run_in_db_thread(set_referral_balance)
+async_set_referral_balance_all = _run_in_db_thread(set_referral_balance_all)
+async_get_referral_balance = _run_in_db_thread(get_referral_balance)
+async_get_referral_count = _run_in_db_thread(get_referral_count)
+async_get_user_keys = _run_in_db_thread(get_user_keys)
+async_get_keys_for_users = _run_in_db_thread(get_keys_for_users)
+async_get_key_by_id = _run_in_db_thread(get_key_by_id)
+async_get_all_keys = _run_in_db_thread(get_all_keys)
+async_get_keys_expiring_between = _run_in_db_thread(get_keys_expiring_between)
+async_get_users_batch = _run_in_db_thread(get_users_batch)
+async_get_keys_batch = _run_in_db_thread(get_keys_batch)
+async_mark_keys_notified = _run_in_db_thread(mark_keys_notified)
+async_prune_key_notifications = _run_in_db_thread(prune_key_notifications)
+async_get_next_expiry_after = _run_in_db_thread(get_next_expiry_after)
+async_get_user_latest_expiry = _run_in_db_thread(get_user_latest_expiry)
+async_add_new_key = _run_in_db_thread(add_new_key)
+async_delete_key_by_id = _run_in_db_thread(delete_key_by_id)
+async_delete_user_keys = _run_in_db_thread(delete_user_keys)
+async_update_key_info = _run_in_db_thread(update_key_info)
+async_update_key_expiry_days = _run_in_db_thread(update_key_expiry_days)
+async_set_key_expiry_date = _run_in_db_thread(set_key_expiry_date)
+async_get_next_key_number = _run_in_db_thread(get_next_key_number)
+async_get_all_plans = _run_in_db_thread(get_all_plans)
+async_get_plan_by_id = _run_in_db_thread(get_plan_by_id)
+async_create_plan = _run_in_db_thread(create_plan)
+async_delete_plan = _run_in_db_thread(delete_plan)
+async_log_transaction = _run_in_db_thread(log_transaction)
+async_create_pending_transaction = _run_in_db_thread(create_pending_transaction)
+async_find_and_complete_ton_transaction = _run_in_db_thread(find_and_complete_ton_transaction)
+async_create_payment_intent = _run_in_db_thread(create_payment_intent)
+async_claim_payment_intent = _run_in_db_thread(claim_payment_intent)
+async_get_payment_intent = _run_in_db_thread(get_payment_intent)
+async_transition_payment_intent = _run_in_db_thread(transition_payment_intent)
+async_get_due_payment_intents = _run_in_db_thread(get_due_payment_intents)
+async_reschedule_payment_intents = _run_in_db_thread(reschedule_payment_intents)
+async_expire_payment_intents = _run_in_db_thread(expire_payment_intents)
+async_get_transactions_page = _run_in_db_thread(get_transactions_page)
+async_archive_transactions = _run_in_db_thread(archive_transactions)
+async_get_plan_revenue = _run_in_db_thread(get_plan_revenue)
+async_backup_database = _run_in_db_thread(backup_database)
+async_get_recent_transactions = _run_in_db_thread(get_recent_transactions)
+async_get_latest_transaction = _run_in_db_thread(get_latest_transaction)
+async_add_support_thread = _run_in_db_thread(add_support_thread)
+async_get_support_thread_id = _run_in_db_thread(get_support_thread_id)
+async_get_support_ticket_status = _run_in_db_thread(get_support_ticket_status)
+async_update_support_ticket_status = _run_in_db_thread(update_support_ticket_status)
+async_get_support_ticket_priority = _run_in_db_thread(get_support_ticket_priority)
+async_update_support_ticket_priority = _run_in_db_thread(update_support_ticket_priority)
+async_delete_support_thread = _run_in_db_thread(delete_support_thread)
+async_increment_ticket_messages = _run_in_db_thread(increment_ticket_messages)
+async_add_ticket_note = _run_in_db_thread(add_ticket_note)
+async_save_support_rating = _run_in_db_thread(save_support_rating)
+async_get_user_id_by_thread = _run_in_db_thread(get_user_id_by_thread)
+async_get_stats_counters = _run_in_db_thread(get_stats_counters)
+async_get_key_activity_counts = _run_in_db_thread(get_key_activity_counts)
+async_reconcile_stats_counters = _run_in_db_thread(reconcile_stats_counters)
+async_get_user_count = _run_in_db_thread(get_user_count)
+async_get_total_keys_count = _run_in_db_thread(get_total_keys_count)
+async_get_total_spent_sum = _run_in_db_thread(get_total_spent_sum)
+async_get_all_vpn_users = _run_in_db_thread(get_all_vpn_users)
+async_get_daily_stats_for_charts = _run_in_db_thread(get_daily_stats_for_charts)
+async_rebuild_daily_rollups = _run_in_db_thread(rebuild_daily_rollups)
+async_search_users = _run_in_db_thread(search_users)
+async_get_users_page = _run_in_db_thread(get_users_page)
+async_get_users_with_active_keys = _run_in_db_thread(get_users_with_active_keys)
+async_get_users_without_keys = _run_in_db_thread(get_users_without_keys)
+async_get_banned_users_count = _run_in_db_thread(get_banned_users_count)
+async_get_active_keys_count = _run_in_db_thread(get_active_keys_count)
+async_get_expired_keys_count = _run_in_db_thread(get_expired_keys_count)
+async_get_transactions_stats = _run_in_db_thread(get_transactions_stats)
+async_update_setting = _run_in_db_thread(update_setting)
+async_update_settings = _run_in_db_thread(update_settings)
+
+
+async def async_iter_users(filter_type: str = "all", batch_size: int = 1000) -> AsyncIterator[User]:
+    after_id = None
+    while True:
+        batch = await async_get_users_batch(filter_type, after_id, batch_size)
+        for user in batch:
+            yield user
+        if len(batch) < batch_size:
+            return
+        after_id = batch[-1].telegram_id
+
+
+async def async_iter_keys(expiring_between: Optional[Tuple[int, int]] = None, batch_size: int = 1000,
+                          unnotified_mark: Optional[int] = None) -> AsyncIterator[VpnKey]:
+    after = None
+    while True:
+        batch = await async_get_keys_batch(after, batch_size, expiring_between, unnotified_mark)
+        for key in batch:
+            yield key
+        if len(batch) < batch_size:
+            return
+        after = _key_position(batch[-1], expiring_between)
@@ -1,7 +1,16 @@
 import asyncio
+import heapq
+import itertools
 import logging
+import os
+import random
+import threading
+import time
 from datetime import datetime, timedelta
+from functools import partial
+from typing import Awaitable, Callable, Optional
 
+import aiohttp
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import Bot
 
@@ -9,8 +18,17 @@ from shop_bot.bot_controller import BotController
 from shop_bot.data_manager import database
 
 CHECK_INTERVAL_SECONDS = 300
+PAYMENT_POLL_INTERVAL_SECONDS = 60
+PLATEGA_POLL_CONCURRENCY = int(os.environ.get("PLATEGA_POLL_CONCURRENCY", "10"))
+PLATEGA_REQUEST_TIMEOUT_SECONDS = int(os.environ.get("PLATEGA_REQUEST_TIMEOUT_SECONDS", "15"))
+PLATEGA_SWEEP_TIMEOUT_SECONDS = int(os.environ.get("PLATEGA_SWEEP_TIMEOUT_SECONDS", "90"))
+CRYPTOBOT_INVOICES_PER_REQUEST = 100
+STARTUP_DELAY_SECONDS = 10
+STATS_RECONCILE_INTERVAL_SECONDS = 3600
+ARCHIVE_INTERVAL_SECONDS = 86400
+BACKUP_INTERVAL_SECONDS = int(os.environ.get("DB_BACKUP_INTERVAL_HOURS", "24")) * 3600
 NOTIFY_BEFORE_HOURS = {72, 48, 24, 1}
-notified_users = {}
+NOTIFY_MARK_BATCH_SIZE = 20
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +49,7 @@ def format_time_left(hours: int) -> str:
         return f"{hours} часов"
 
 
-async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, time_left_hours: int, expiry_date: datetime):
+async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, time_left_hours: int, expiry_date: datetime) -> bool:
     try:
         time_text = format_time_left(time_left_hours)
         expiry_str = expiry_date.strftime('%d.%m.%Y в %H:%M')
@@ -50,143 +68,321 @@ async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, ti
 
         await bot.send_message(chat_id=user_id, text=message, reply_markup=builder.as_markup(), parse_mode='Markdown')
         logger.info(f"Notification sent to {user_id} for key {key_id} ({time_left_hours}h left)")
+        return True
 
     except Exception as e:
         logger.error(f"Notification error for {user_id}: {e}")
+        return False
 
 
-def _cleanup_notified_users(all_db_keys: list[dict]):
-    if not notified_users:
-        return
-
-    logger.info("Scheduler: Cleaning notification cache...")
-    active_key_ids = {key['key_id'] for key in all_db_keys}
-    cleaned_users = 0
-    cleaned_keys = 0
+def _notification_window(now_ts: int, hours_mark: int) -> tuple[int, int]:
+    return now_ts + (hours_mark - 1) * 3600, now_ts + hours_mark * 3600
 
-    for user_id in list(notified_users.keys()):
-        for key_id in list(notified_users[user_id].keys()):
-            if key_id not in active_key_ids:
-                del notified_users[user_id][key_id]
-                cleaned_keys += 1
-        if not notified_users[user_id]:
-            del notified_users[user_id]
-            cleaned_users += 1
 
-    if cleaned_users or cleaned_keys:
-        logger.info(f"Scheduler: Cleaned {cleaned_users} users, {cleaned_keys} keys")
+async def _seconds_until_next_notification() -> Optional[float]:
+    now_ts = int(time.time())
+    due = []
+    for hours_mark in NOTIFY_BEFORE_HOURS:
+        expiry_ts = await database.async_get_next_expiry_after(now_ts + hours_mark * 3600)
+        if expiry_ts is not None:
+            due.append(expiry_ts - hours_mark * 3600 - now_ts)
+    return max(min(due), 1) if due else None
 
 
 async def check_expiring_subscriptions(bot: Bot):
     logger.info("Scheduler: Checking expiring subscriptions...")
-    current_time = datetime.now()
-    all_keys = database.get_all_keys()
+    now_ts = int(datetime.now().timestamp())
 
-    _cleanup_notified_users(all_keys)
-
-    for key in all_keys:
+    for hours_mark in sorted(NOTIFY_BEFORE_HOURS, reverse=True):
+        notified_key_ids = []
         try:
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            time_left = expiry_date - current_time
-
-            if time_left.total_seconds() < 0:
-                continue
-
-            total_hours_left = int(time_left.total_seconds() / 3600)
-            user_id = key['user_id']
-            key_id = key['key_id']
+            async for key in database.async_iter_keys(_notification_window(now_ts, hours_mark), unnotified_mark=hours_mark):
+                try:
+                    if await send_subscription_notification(bot, key['user_id'], key['key_id'], hours_mark, datetime.fromtimestamp(key['expiry_ts'])):
+                        notified_key_ids.append(key['key_id'])
+                except Exception as e:
+                    logger.error(f"Expiry processing error for key {key.get('key_id')}: {e}")
+                if len(notified_key_ids) >= NOTIFY_MARK_BATCH_SIZE:
+                    await database.async_mark_keys_notified(notified_key_ids, hours_mark)
+                    notified_key_ids = []
+        finally:
+            await database.async_mark_keys_notified(notified_key_ids, hours_mark)
 
-            for hours_mark in NOTIFY_BEFORE_HOURS:
-                if hours_mark - 1 < total_hours_left <= hours_mark:
-                    notified_users.setdefault(user_id, {}).setdefault(key_id, set())
-
-                    if hours_mark not in notified_users[user_id][key_id]:
-                        await send_subscription_notification(bot, user_id, key_id, hours_mark, expiry_date)
-                        notified_users[user_id][key_id].add(hours_mark)
-                    break
-
-        except Exception as e:
-            logger.error(f"Expiry processing error for key {key.get('key_id')}: {e}")
+    return await _seconds_until_next_notification()
 
 
 async def check_pending_platega_payments(bot: Bot):
     from shop_bot.bot.handlers import check_platega_payment_status, process_successful_payment
-    from shop_bot.data_manager.database import get_all_pending_platega_transactions, delete_pending_platega_transaction
 
-    pending = get_all_pending_platega_transactions()
+    pending = await database.async_get_due_payment_intents("platega")
     if not pending:
         return
 
     logger.info(f"Scheduler: Checking {len(pending)} pending Platega payments...")
 
-    for tx in pending:
+    semaphore = asyncio.Semaphore(PLATEGA_POLL_CONCURRENCY)
+
+    async def fetch_status(intent) -> dict | None:
+        async with semaphore:
+            return await check_platega_payment_status(intent.external_id, session)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PLATEGA_REQUEST_TIMEOUT_SECONDS)) as session:
+        tasks = {asyncio.create_task(fetch_status(intent)): intent for intent in pending}
+        _, timed_out = await asyncio.wait(tasks, timeout=PLATEGA_SWEEP_TIMEOUT_SECONDS)
+        for task in timed_out:
+            task.cancel()
+        await asyncio.gather(*timed_out, return_exceptions=True)
+
+    if timed_out:
+        logger.warning(f"Scheduler: Platega sweep timed out, {len(timed_out)} checks deferred")
+
+    unresolved = []
+    for task, intent in tasks.items():
+        if task in timed_out:
+            unresolved.append(intent.intent_id)
+            continue
         try:
-            result = await check_platega_payment_status(tx['transaction_id'])
+            result = task.result()
             if result and result.get('status') == 'CONFIRMED':
-                delete_pending_platega_transaction(tx['transaction_id'])
-                await process_successful_payment(bot, tx['metadata'])
-                logger.info(f"Platega payment confirmed via polling: {tx['transaction_id']}")
+                metadata = await database.async_transition_payment_intent("platega", intent.external_id, "paid")
+                if metadata:
+                    await process_successful_payment(bot, metadata)
+                    logger.info(f"Platega payment confirmed via polling: {intent.external_id}")
             elif result and result.get('status') in ['CANCELED', 'EXPIRED']:
-                delete_pending_platega_transaction(tx['transaction_id'])
-                logger.info(f"Platega payment {result.get('status')}: {tx['transaction_id']}")
+                state = 'canceled' if result.get('status') == 'CANCELED' else 'expired'
+                await database.async_transition_payment_intent("platega", intent.external_id, state)
+            else:
+                unresolved.append(intent.intent_id)
         except Exception as e:
-            logger.error(f"Platega check error for {tx['transaction_id']}: {e}")
+            unresolved.append(intent.intent_id)
+            logger.error(f"Platega check error for {intent.external_id}: {e}")
+
+    await database.async_reschedule_payment_intents(unresolved)
 
 
 async def check_pending_cryptobot_payments(bot: Bot):
     from shop_bot.bot.handlers import process_successful_payment
-    from shop_bot.data_manager.database import get_all_pending_cryptobot_invoices, delete_pending_cryptobot_invoice, get_setting
     from aiosend import CryptoPay
 
-    cryptobot_token = get_setting('cryptobot_token')
+    cryptobot_token = database.get_setting('cryptobot_token')
     if not cryptobot_token:
         return
 
-    pending = get_all_pending_cryptobot_invoices()
+    pending = await database.async_get_due_payment_intents("cryptobot")
     if not pending:
         return
 
     logger.info(f"Scheduler: Checking {len(pending)} pending CryptoBot invoices...")
 
+    valid = []
+    for intent in pending:
+        if str(intent.external_id).isdigit():
+            valid.append(intent)
+        else:
+            logger.warning(f"CryptoBot intent {intent.intent_id} has invalid invoice id {intent.external_id!r}, marking it failed")
+            await database.async_transition_payment_intent("cryptobot", intent.external_id, "failed")
+
+    unresolved = []
     try:
         crypto = CryptoPay(cryptobot_token)
-        for inv in pending:
+        for start in range(0, len(valid), CRYPTOBOT_INVOICES_PER_REQUEST):
+            chunk = valid[start:start + CRYPTOBOT_INVOICES_PER_REQUEST]
             try:
-                invoices = await crypto.get_invoices(invoice_ids=[int(inv['invoice_id'])])
-                if invoices and len(invoices) > 0:
-                    invoice = invoices[0]
-                    if invoice.status == 'paid':
-                        delete_pending_cryptobot_invoice(inv['invoice_id'])
-                        await process_successful_payment(bot, inv['metadata'])
-                        logger.info(f"CryptoBot invoice paid via polling: {inv['invoice_id']}")
-                    elif invoice.status in ['expired', 'cancelled']:
-                        delete_pending_cryptobot_invoice(inv['invoice_id'])
-                        logger.info(f"CryptoBot invoice {invoice.status}: {inv['invoice_id']}")
+                invoices = await crypto.get_invoices(invoice_ids=[int(intent.external_id) for intent in chunk],
+                                                     count=len(chunk))
             except Exception as e:
-                logger.error(f"CryptoBot check error for {inv['invoice_id']}: {e}")
+                unresolved.extend(intent.intent_id for intent in chunk)
+                logger.error(f"CryptoBot invoices request failed for {len(chunk)} invoices: {e}")
+                continue
+
+            invoices_by_id = {str(invoice.invoice_id): invoice for invoice in invoices}
+            for intent in chunk:
+                try:
+                    invoice = invoices_by_id.get(intent.external_id)
+                    if invoice and invoice.status == 'paid':
+                        metadata = await database.async_transition_payment_intent("cryptobot", intent.external_id, "paid")
+                        if metadata:
+                            await process_successful_payment(bot, metadata)
+                            logger.info(f"CryptoBot invoice paid via polling: {intent.external_id}")
+                    elif invoice and invoice.status in ['expired', 'cancelled']:
+                        state = 'expired' if invoice.status == 'expired' else 'canceled'
+                        await database.async_transition_payment_intent("cryptobot", intent.external_id, state)
+                    else:
+                        unresolved.append(intent.intent_id)
+                except Exception as e:
+                    unresolved.append(intent.intent_id)
+                    logger.error(f"CryptoBot check error for {intent.external_id}: {e}")
     except Exception as e:
         logger.error(f"CryptoBot polling error: {e}")
 
+    await database.async_reschedule_payment_intents(unresolved)
+
+
+class Job:
+    def __init__(self, name: str, func: Callable[..., Awaitable[Optional[float]]], interval: float, timeout: float,
+                 jitter: float = 0.0, requires_bot: bool = False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.requires_bot = requires_bot
+        self.next_run: Optional[float] = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self.last_run_at: Optional[datetime] = None
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def metrics(self) -> dict:
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "timeout": self.timeout,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "skipped": self.skipped,
+            "last_run_at": self.last_run_at.isoformat(timespec="seconds") if self.last_run_at else None,
+            "next_run_in": round(max(self.next_run - time.monotonic(), 0), 1) if self.next_run is not None else None,
+            "last_duration_ms": round(self.last_duration * 1000, 1),
+            "max_duration_ms": round(self.max_duration * 1000, 1),
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+        }
+
+
+class JobScheduler:
+    def __init__(self):
+        self._jobs: dict[str, Job] = {}
+        self._heap: list[tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        self._tasks: set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock = threading.Lock()
+
+    def add_job(self, job: Job, delay: float = 0.0):
+        with self._lock:
+            self._jobs[job.name] = job
+        self.schedule(job, delay)
+
+    def schedule(self, job: Job, delay: float):
+        due = time.monotonic() + max(delay, 0.0)
+        with self._lock:
+            if job.next_run is not None and job.next_run <= due:
+                return
+            job.next_run = due
+        heapq.heappush(self._heap, (due, next(self._sequence), job.name))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def get_metrics(self) -> list[dict]:
+        with self._lock:
+            return [job.metrics() for job in sorted(self._jobs.values(), key=lambda job: job.name)]
+
+    def _next_interval(self, job: Job) -> float:
+        return job.interval + (random.uniform(0, job.jitter) if job.jitter else 0.0)
+
+    async def run(self, bot_controller: BotController):
+        self._wakeup = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, name = heapq.heappop(self._heap)
+                job = self._jobs[name]
+                if due == job.next_run:
+                    self._dispatch(job, due, bot_controller)
+            self._wakeup.clear()
+            delay = self._heap[0][0] - time.monotonic() if self._heap else CHECK_INTERVAL_SECONDS
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(delay, 0.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, job: Job, due: float, bot_controller: BotController):
+        with self._lock:
+            job.next_run = None
+        self.schedule(job, self._next_interval(job))
+        if job.running:
+            with self._lock:
+                job.skipped += 1
+            logger.warning(f"Scheduler: job {job.name} is still running, skipping this run")
+            return
+        args = ()
+        if job.requires_bot:
+            bot = bot_controller.get_bot_instance() if bot_controller.get_status().get("shop_bot_running") else None
+            if not bot:
+                return
+            args = (bot,)
+        task = asyncio.create_task(self._run_job(job, due, args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_job(self, job: Job, due: float, args: tuple):
+        started = time.monotonic()
+        with self._lock:
+            job.running = True
+            job.last_lag = max(started - due, 0.0)
+            job.max_lag = max(job.max_lag, job.last_lag)
+            job.last_run_at = datetime.now()
+        next_delay = None
+        timed_out = failed = False
+        try:
+            next_delay = await asyncio.wait_for(job.func(*args), job.timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            logger.error(f"Scheduler: job {job.name} timed out after {job.timeout}s")
+        except Exception as e:
+            failed = True
+            logger.error(f"Scheduler: job {job.name} failed: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                job.running = False
+                job.runs += 1
+                job.timeouts += timed_out
+                job.failures += failed
+                job.last_duration = time.monotonic() - started
+                job.max_duration = max(job.max_duration, job.last_duration)
+        if next_delay is not None:
+            self.schedule(job, next_delay)
 
-async def periodic_subscription_check(bot_controller: BotController):
-    logger.info("Scheduler started.")
-    await asyncio.sleep(10)
 
-    while True:
-        try:
-            if bot_controller.get_status().get("shop_bot_running"):
-                bot = bot_controller.get_bot_instance()
-                if bot:
-                    await check_expiring_subscriptions(bot)
-                    await check_pending_platega_payments(bot)
-                    await check_pending_cryptobot_payments(bot)
-                else:
-                    logger.warning("Scheduler: Bot instance not available.")
-            else:
-                logger.info("Scheduler: Bot stopped, skipping checks.")
+def _maintenance(func: Callable[[], Awaitable]) -> Callable[[], Awaitable[None]]:
+    async def run():
+        await func()
+    return run
 
-        except Exception as e:
-            logger.error(f"Scheduler error: {e}", exc_info=True)
 
-        logger.info(f"Scheduler: Next check in {CHECK_INTERVAL_SECONDS}s.")
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+job_scheduler = JobScheduler()
+
+
+async def periodic_subscription_check(bot_controller: BotController):
+    logger.info("Scheduler started.")
+    jobs = [
+        Job("expiry_notifications", check_expiring_subscriptions, CHECK_INTERVAL_SECONDS, timeout=600, requires_bot=True),
+        Job("platega_polling", check_pending_platega_payments, PAYMENT_POLL_INTERVAL_SECONDS, timeout=120,
+            jitter=10, requires_bot=True),
+        Job("cryptobot_polling", check_pending_cryptobot_payments, PAYMENT_POLL_INTERVAL_SECONDS, timeout=120,
+            jitter=10, requires_bot=True),
+        Job("stats_reconcile", _maintenance(database.async_reconcile_stats_counters),
+            STATS_RECONCILE_INTERVAL_SECONDS, timeout=600, jitter=60),
+        Job("payment_intents_expiry", _maintenance(database.async_expire_payment_intents),
+            STATS_RECONCILE_INTERVAL_SECONDS, timeout=300, jitter=60),
+        Job("notification_ledger_prune",
+            _maintenance(partial(database.async_prune_key_notifications, max(NOTIFY_BEFORE_HOURS))),
+            STATS_RECONCILE_INTERVAL_SECONDS, timeout=300, jitter=60),
+        Job("transactions_archive", _maintenance(database.async_archive_transactions),
+            ARCHIVE_INTERVAL_SECONDS, timeout=1800, jitter=300),
+    ]
+    if BACKUP_INTERVAL_SECONDS:
+        jobs.append(Job("database_backup", _maintenance(database.async_backup_database),
+                        BACKUP_INTERVAL_SECONDS, timeout=3600, jitter=300))
+    for job in jobs:
+        job_scheduler.add_job(job, STARTUP_DELAY_SECONDS)
+    await job_scheduler.run(bot_controller)
@@ -1,4 +1,6 @@
 import os
+import io
+import csv
 import logging
 import asyncio
 import json
@@ -15,8 +17,7 @@ from collections import deque, defaultdict
 from hmac import compare_digest
 from datetime import datetime, timedelta
 from functools import wraps
-from math import ceil
-from flask import Flask, request, render_template, redirect, url_for, flash, session, current_app, jsonify, abort
+from flask import Flask, Response, request, render_template, redirect, url_for, flash, session, current_app, jsonify, abort, stream_with_context, send_file
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -176,16 +177,19 @@ GITHUB_REPO = "mwdevru/shopbot-beliyspisok"
 from shop_bot.modules import mwshark_api
 from shop_bot.bot import handlers
 from shop_bot.data_manager.database import (
-    get_all_settings, update_setting, get_all_plans,
+    get_all_settings, update_settings, get_all_plans,
     create_plan, delete_plan, get_plan_by_id, get_user_count,
-    get_total_keys_count, get_total_spent_sum, get_daily_stats_for_charts,
-    get_recent_transactions, get_paginated_transactions, get_all_users, get_user_keys,
+    get_stats_counters, get_key_activity_counts, get_daily_stats_for_charts,
+    get_recent_transactions, get_transactions_page, async_iter_users, iter_keys, get_user_keys,
     ban_user, unban_user, delete_user_keys, get_setting, find_and_complete_ton_transaction,
     get_user, update_key_expiry_days, set_key_expiry_date, get_key_by_id, add_new_key,
-    search_users, get_users_with_active_keys, get_users_without_keys, get_banned_users_count,
-    get_active_keys_count, get_expired_keys_count, get_transactions_stats, delete_key_by_id,
-    reset_trial, delete_user, reset_user_stats, set_referral_balance
+    search_users, get_users_page, get_keys_for_users, USER_SORT_COLUMNS,
+    get_transactions_stats, delete_key_by_id, iter_export_rows,
+    reset_trial, delete_user, reset_user_stats, set_referral_balance,
+    backup_database, list_backups, get_last_backup, get_plan_revenue,
+    transition_payment_intent, claim_payment_intent, get_payment_intent_stats
 )
+from shop_bot.data_manager.scheduler import job_scheduler
 
 _bot_controller = None
 
@@ -199,7 +203,7 @@ ALL_SETTINGS_KEYS = [
     "referral_discount", "force_subscription", "trial_enabled", "trial_duration_days",
     "enable_referrals", "minimum_withdrawal", "support_group_id", "support_bot_token",
     "mwshark_api_key", "platega_merchant_id", "platega_secret_key", "platega_payment_method",
-    "setup_completed"
+    "setup_completed", "transactions_archive_days"
 ]
 
 REQUIRED_SETUP_FIELDS = {
@@ -307,9 +311,18 @@ def create_webhook_app(bot_controller_instance):
         return {
             'current_year': datetime.utcnow().year,
             'now': datetime.now().isoformat(),
+            'now_ts': int(time.time()),
             'app_version': CURRENT_VERSION
         }
 
+    def get_transactions_page_from_request(per_page):
+        try:
+            return get_transactions_page(
+                before=request.args.get('before'), after=request.args.get('after'), per_page=per_page
+            )
+        except ValueError:
+            abort(400)
+
     def login_required(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
@@ -387,6 +400,11 @@ def create_webhook_app(bot_controller_instance):
         session_manager.add_session(user, current_session, session.get('login_ip', ''))
         return jsonify({'success': True, 'message': 'Все сессии завершены'})
 
+    @flask_app.route('/api/scheduler')
+    @login_required
+    def scheduler_api():
+        return jsonify({'success': True, 'jobs': job_scheduler.get_metrics()})
+
     @flask_app.route('/setup', methods=['GET', 'POST'])
     @login_required
     def setup_page():
@@ -416,11 +434,9 @@ def create_webhook_app(bot_controller_instance):
                 flash(f"Заполни обязательные поля: {', '.join(missing_labels)}", 'danger')
                 prefill.update(form_values)
             else:
-                for key, value in form_values.items():
-                    if key == "panel_password" and not value:
-                        continue
-                    update_setting(key, value)
-                update_setting("setup_completed", "true")
+                updates = {key: value for key, value in form_values.items() if key != "panel_password" or value}
+                updates["setup_completed"] = "true"
+                update_settings(updates)
                 flash("Мастер настройки завершен. Можно запускать ботов.", "success")
                 return redirect(url_for('dashboard_page'))
 
@@ -447,19 +463,17 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/dashboard')
     @login_required
     def dashboard_page():
+        counters = get_stats_counters()
         stats = {
-            "user_count": get_user_count(),
-            "total_keys": get_total_keys_count(),
-            "total_spent": get_total_spent_sum(),
+            "user_count": int(counters.get('users', 0)),
+            "total_keys": int(counters.get('keys', 0)),
+            "total_spent": counters.get('total_spent', 0.0),
             "plans_count": len(get_all_plans())
         }
 
-        page = request.args.get('page', 1, type=int)
-        per_page = 8
-
-        transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
-        total_pages = ceil(total_transactions / per_page)
-        chart_data = get_daily_stats_for_charts(days=30)
+        transactions_page = get_transactions_page_from_request(per_page=8)
+        chart_days = min(max(request.args.get('chart_days', 30, type=int), 7), 365)
+        chart_data = get_daily_stats_for_charts(days=chart_days)
         common_data = get_common_template_data()
 
         api_balance = None
@@ -474,8 +488,9 @@ def create_webhook_app(bot_controller_instance):
                 logger.error(f"Failed to get API balance: {e}")
 
         return render_template(
-            'dashboard.html', stats=stats, chart_data=chart_data, transactions=transactions,
-            current_page=page, total_pages=total_pages, api_balance=api_balance, **common_data
+            'dashboard.html', stats=stats, chart_data=chart_data, transactions=transactions_page['transactions'],
+            prev_cursor=transactions_page['prev_cursor'], next_cursor=transactions_page['next_cursor'],
+            total_transactions=transactions_page['total'], api_balance=api_balance, **common_data
         )
 
 
@@ -484,28 +499,35 @@ def create_webhook_app(bot_controller_instance):
     def users_page():
         search = request.args.get('search', '').strip()
         filter_type = request.args.get('filter', 'all')
-        
+        sort = request.args.get('sort', 'registration_date')
+        if sort not in USER_SORT_COLUMNS:
+            sort = 'registration_date'
+        descending = request.args.get('order', 'desc') != 'asc'
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = 50
+        offset = (page - 1) * per_page
+
         if search:
-            users = search_users(search)
-        elif filter_type == 'active':
-            users = get_users_with_active_keys()
-        elif filter_type == 'nokeys':
-            users = get_users_without_keys()
+            users = search_users(search, limit=per_page + 1, offset=offset)
         else:
-            users = get_all_users()
-        
-        for user in users:
-            user['user_keys'] = get_user_keys(user['telegram_id'])
+            users = get_users_page(filter_type, sort=sort, descending=descending, limit=per_page + 1, offset=offset)
+        has_next = len(users) > per_page
+        users = users[:per_page]
+        keys_by_user = get_keys_for_users([user['telegram_id'] for user in users])
         
+        counters = get_stats_counters()
+        key_activity = get_key_activity_counts()
         stats = {
-            'total': get_user_count(),
-            'banned': get_banned_users_count(),
-            'with_keys': len(get_users_with_active_keys()),
-            'active_keys': get_active_keys_count(),
-            'expired_keys': get_expired_keys_count()
+            'total': int(counters.get('users', 0)),
+            'banned': int(counters.get('banned_users', 0)),
+            'with_keys': key_activity['users_with_active_keys'],
+            'active_keys': key_activity['active_keys'],
+            'expired_keys': key_activity['expired_keys']
         }
         
-        return render_template('users.html', users=users, stats=stats, search=search, filter_type=filter_type, **get_common_template_data())
+        return render_template('users.html', users=users, keys_by_user=keys_by_user, stats=stats, search=search,
+                               filter_type=filter_type, sort=sort, order='desc' if descending else 'asc',
+                               page=page, has_next=has_next, **get_common_template_data())
 
     @flask_app.route('/settings', methods=['GET', 'POST'])
     @login_required
@@ -516,30 +538,55 @@ def create_webhook_app(bot_controller_instance):
             "support_user", "channel_url", "telegram_bot_token",
             "telegram_bot_username", "admin_telegram_id", "referral_percentage",
             "referral_discount", "trial_duration_days", "minimum_withdrawal",
-            "support_group_id", "support_bot_token", "mwshark_api_key"
+            "support_group_id", "support_bot_token", "mwshark_api_key", "transactions_archive_days"
         ]
         if request.method == 'POST':
+            updates = {}
             if 'panel_password' in request.form and request.form.get('panel_password'):
-                update_setting('panel_password', request.form.get('panel_password'))
+                updates['panel_password'] = request.form.get('panel_password')
 
             for checkbox_key in ['force_subscription', 'trial_enabled', 'enable_referrals']:
                 values = request.form.getlist(checkbox_key)
                 value = values[-1] if values else 'false'
-                update_setting(checkbox_key, 'true' if value == 'true' else 'false')
+                updates[checkbox_key] = 'true' if value == 'true' else 'false'
 
             for key in settings_keys:
                 if key in request.form:
-                    update_setting(key, request.form.get(key, ''))
+                    updates[key] = request.form.get(key, '')
+
+            update_settings(updates)
 
             flash('Настройки успешно сохранены!', 'success')
             return redirect(url_for('settings_page'))
 
-        return render_template('settings.html', settings=get_all_settings(), **get_common_template_data())
+        return render_template('settings.html', settings=get_all_settings(), backups=list_backups(),
+                               last_backup=get_last_backup(), **get_common_template_data())
+
+    @flask_app.route('/backups/create', methods=['POST'])
+    @login_required
+    def create_backup_route():
+        try:
+            result = backup_database()
+            flash(f"Резервная копия {result['file']} создана за {result['duration']:.1f} с.", 'success')
+        except Exception as e:
+            logger.error(f"Manual backup failed: {e}", exc_info=True)
+            flash(f"Ошибка резервного копирования: {e}", 'danger')
+        return redirect(url_for('settings_page'))
+
+    @flask_app.route('/backups/latest')
+    @login_required
+    def download_latest_backup():
+        backups = list_backups()
+        if not backups:
+            abort(404)
+        return send_file(backups[0]['path'], mimetype='application/gzip', as_attachment=True,
+                         download_name=backups[0]['file'])
 
     @flask_app.route('/plans')
     @login_required
     def plans_page():
-        return render_template('plans.html', plans=get_all_plans(), **get_common_template_data())
+        return render_template('plans.html', plans=get_all_plans(), plan_revenue=get_plan_revenue(),
+                               **get_common_template_data())
 
     @flask_app.route('/payments', methods=['GET', 'POST'])
     @login_required
@@ -550,13 +597,15 @@ def create_webhook_app(bot_controller_instance):
                 'cryptobot_token', 'heleket_merchant_id', 'heleket_api_key', 'domain',
                 'platega_merchant_id', 'platega_secret_key', 'platega_payment_method'
             ]
+            updates = {}
             for checkbox_key in ['sbp_enabled']:
                 values = request.form.getlist(checkbox_key)
                 value = values[-1] if values else 'false'
-                update_setting(checkbox_key, 'true' if value == 'true' else 'false')
+                updates[checkbox_key] = 'true' if value == 'true' else 'false'
             for key in payment_keys:
                 if key in request.form:
-                    update_setting(key, request.form.get(key, ''))
+                    updates[key] = request.form.get(key, '')
+            update_settings(updates)
             flash('Настройки платежей сохранены!', 'success')
             return redirect(url_for('payments_page'))
         return render_template('payments.html', settings=get_all_settings(), **get_common_template_data())
@@ -831,20 +880,22 @@ def create_webhook_app(bot_controller_instance):
     @login_required
     def branding_page():
         if request.method == 'POST':
+            updates = {}
             for checkbox_key in ['branding_enabled']:
                 values = request.form.getlist(checkbox_key)
                 value = values[-1] if values else 'false'
-                update_setting(checkbox_key, 'true' if value == 'true' else 'false')
+                updates[checkbox_key] = 'true' if value == 'true' else 'false'
             
             for key in ['branding_name', 'branding_description', 'branding_website', 'branding_telegram']:
                 if key in request.form:
-                    update_setting(key, request.form.get(key, ''))
+                    updates[key] = request.form.get(key, '')
+
+            update_settings(updates)
             
             flash('Настройки брендинга сохранены!', 'success')
             return redirect(url_for('branding_page'))
         
-        from shop_bot.data_manager.database import get_all_keys
-        active_subscriptions = [k for k in get_all_keys() if k.get('subscription_uuid')]
+        active_subscriptions = [k for k in iter_keys() if k.get('subscription_uuid')]
         
         return render_template('branding.html', settings=get_all_settings(), active_subscriptions=active_subscriptions, **get_common_template_data())
 
@@ -923,22 +974,49 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/transactions')
     @login_required
     def transactions_page():
-        page = request.args.get('page', 1, type=int)
-        per_page = 20
-        transactions, total = get_paginated_transactions(page=page, per_page=per_page)
-        total_pages = ceil(total / per_page)
+        transactions_page = get_transactions_page_from_request(per_page=20)
         stats = get_transactions_stats()
-        return render_template('transactions.html', transactions=transactions, stats=stats,
-                               current_page=page, total_pages=total_pages, **get_common_template_data())
+        return render_template('transactions.html', transactions=transactions_page['transactions'], stats=stats,
+                               prev_cursor=transactions_page['prev_cursor'], next_cursor=transactions_page['next_cursor'],
+                               intent_stats=get_payment_intent_stats(), **get_common_template_data())
 
-    @flask_app.route('/export/users')
+    @flask_app.route('/export/<kind>')
     @login_required
-    def export_users():
-        users = get_all_users()
-        output = "telegram_id,username,total_spent,total_months,is_banned,registration_date\n"
-        for u in users:
-            output += f"{u['telegram_id']},{u.get('username','')},{u.get('total_spent',0)},{u.get('total_months',0)},{u.get('is_banned',0)},{u.get('registration_date','')}\n"
-        return output, 200, {'Content-Type': 'text/csv', 'Content-Disposition': 'attachment; filename=users.csv'}
+    def export_data(kind):
+        export_format = request.args.get('format', 'csv')
+        if export_format not in ('csv', 'jsonl'):
+            abort(400)
+        date_from = request.args.get('from') or None
+        date_to = request.args.get('to') or None
+        try:
+            for value in (date_from, date_to):
+                if value:
+                    datetime.strptime(value, '%Y-%m-%d')
+            columns, rows = iter_export_rows(kind, date_from, date_to, request.args.get('status') or None)
+        except ValueError:
+            abort(400)
+
+        def generate_csv():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                if buffer.tell() > 65536:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        def generate_jsonl():
+            for row in rows:
+                yield json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n"
+
+        generator = generate_csv() if export_format == 'csv' else generate_jsonl()
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        filename = f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+        return Response(stream_with_context(generator), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
 
     @flask_app.route('/broadcast', methods=['GET', 'POST'])
     @login_required
@@ -956,15 +1034,12 @@ def create_webhook_app(bot_controller_instance):
                 flash('Бот не запущен.', 'danger')
                 return redirect(url_for('broadcast_page'))
             
-            users = get_all_users()
             sent = 0
             failed = 0
             
             async def send_broadcast():
                 nonlocal sent, failed
-                for user in users:
-                    if user.get('is_banned'):
-                        continue
+                async for user in async_iter_users("not_banned"):
                     try:
                         await bot.send_message(user['telegram_id'], message_text, parse_mode='HTML')
                         sent += 1
@@ -1013,15 +1088,15 @@ def create_webhook_app(bot_controller_instance):
             flash('Пользователь не найден.', 'danger')
             return redirect(url_for('users_page'))
         
-        user['user_keys'] = get_user_keys(user_id)
+        user_keys = get_user_keys(user_id)
         
         api_subscription = None
         api_key = get_setting("mwshark_api_key")
-        if api_key and user['user_keys']:
+        if api_key and user_keys:
             try:
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
-                    first_key = user['user_keys'][0]
+                    first_key = user_keys[0]
                     uuid = first_key.get('subscription_uuid')
                     if uuid:
                         future = asyncio.run_coroutine_threadsafe(
@@ -1034,25 +1109,32 @@ def create_webhook_app(bot_controller_instance):
                 logger.error(f"Get subscription error: {e}")
         
         plans = get_all_plans()
-        return render_template('user_detail.html', user=user, api_subscription=api_subscription, plans=plans, **get_common_template_data())
+        return render_template('user_detail.html', user=user, user_keys=user_keys, api_subscription=api_subscription, plans=plans, **get_common_template_data())
 
 
+    def get_payment_dispatcher():
+        bot = _bot_controller.get_bot_instance()
+        loop = current_app.config.get('EVENT_LOOP')
+        payment_processor = handlers.process_successful_payment
+        if bot is None or payment_processor is None or not loop or not loop.is_running():
+            return None
+        return lambda metadata: asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
+
     @flask_app.route('/yookassa-webhook', methods=['POST'])
     def yookassa_webhook_handler():
         try:
             event_json = request.json
             if event_json.get("event") == "payment.succeeded":
-                metadata = event_json.get("object", {}).get("metadata", {})
-
-                bot = _bot_controller.get_bot_instance()
-                payment_processor = handlers.process_successful_payment
-
-                if metadata and bot is not None and payment_processor is not None:
-                    loop = current_app.config.get('EVENT_LOOP')
-                    if loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-                    else:
-                        logger.error("YooKassa webhook: Event loop not available!")
+                dispatch = get_payment_dispatcher()
+                if dispatch is None:
+                    logger.error("YooKassa webhook: Bot or event loop not running, asking for a retry")
+                    return 'Service Unavailable', 503
+                payment_object = event_json.get("object", {})
+                metadata = claim_payment_intent("yookassa", payment_object.get("id"), payment_object.get("metadata", {}))
+                if metadata:
+                    dispatch(metadata)
+            elif event_json.get("event") == "payment.canceled":
+                transition_payment_intent("yookassa", event_json.get("object", {}).get("id"), "canceled")
             return 'OK', 200
         except Exception as e:
             logger.error(f"YooKassa webhook error: {e}", exc_info=True)
@@ -1103,15 +1185,13 @@ def create_webhook_app(bot_controller_instance):
                     "customer_email": parts[6] if parts[6] != 'None' else None,
                     "payment_method": parts[7]
                 }
-
-                bot = _bot_controller.get_bot_instance()
-                loop = current_app.config.get('EVENT_LOOP')
-                payment_processor = handlers.process_successful_payment
-
-                if bot and loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-                else:
-                    logger.error("CryptoBot Webhook: Bot or event loop not running.")
+                dispatch = get_payment_dispatcher()
+                if dispatch is None:
+                    logger.error("CryptoBot Webhook: Bot or event loop not running, asking for a retry")
+                    return 'Service Unavailable', 503
+                metadata = claim_payment_intent("cryptobot", payload_data.get('invoice_id'), metadata)
+                if metadata:
+                    dispatch(metadata)
 
             return 'OK', 200
 
@@ -1146,14 +1226,13 @@ def create_webhook_app(bot_controller_instance):
                 if not metadata_str:
                     return 'Error', 400
 
-                metadata = json.loads(metadata_str)
-
-                bot = _bot_controller.get_bot_instance()
-                loop = current_app.config.get('EVENT_LOOP')
-                payment_processor = handlers.process_successful_payment
-
-                if bot and loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
+                dispatch = get_payment_dispatcher()
+                if dispatch is None:
+                    logger.error("Heleket webhook: Bot or event loop not running, asking for a retry")
+                    return 'Service Unavailable', 503
+                metadata = claim_payment_intent("heleket", data.get('order_id'), json.loads(metadata_str))
+                if metadata:
+                    dispatch(metadata)
 
             return 'OK', 200
         except Exception as e:
@@ -1167,6 +1246,10 @@ def create_webhook_app(bot_controller_instance):
             logger.info(f"TonAPI webhook: {data}")
 
             if 'tx_id' in data:
+                dispatch = get_payment_dispatcher()
+                if dispatch is None:
+                    logger.error("TonAPI webhook: Bot or event loop not running, asking for a retry")
+                    return 'Service Unavailable', 503
                 for tx in data.get('in_progress_txs', []) + data.get('txs', []):
                     in_msg = tx.get('in_msg')
                     if in_msg and in_msg.get('decoded_comment'):
@@ -1178,12 +1261,7 @@ def create_webhook_app(bot_controller_instance):
 
                         if metadata:
                             logger.info(f"TON Payment successful: {payment_id}")
-                            bot = _bot_controller.get_bot_instance()
-                            loop = current_app.config.get('EVENT_LOOP')
-                            payment_processor = handlers.process_successful_payment
-
-                            if bot and loop and loop.is_running():
-                                asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
+                            dispatch(metadata)
 
             return 'OK', 200
         except Exception as e:
@@ -1222,17 +1300,14 @@ def create_webhook_app(bot_controller_instance):
             transaction_id = data.get('id') or data.get('transactionId')
 
             if status == 'CONFIRMED' and transaction_id:
-                from shop_bot.data_manager.database import get_pending_platega_transaction, delete_pending_platega_transaction
-                metadata = get_pending_platega_transaction(transaction_id)
+                dispatch = get_payment_dispatcher()
+                if dispatch is None:
+                    logger.error("Platega webhook: Bot or event loop not running, asking for a retry")
+                    return 'Service Unavailable', 503
+                metadata = claim_payment_intent("platega", transaction_id)
 
                 if metadata:
-                    delete_pending_platega_transaction(transaction_id)
-                    bot = _bot_controller.get_bot_instance()
-                    loop = current_app.config.get('EVENT_LOOP')
-                    payment_processor = handlers.process_successful_payment
-
-                    if bot and loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
+                    dispatch(metadata)
                     logger.info(f"Platega payment confirmed: {transaction_id}")
 
             return 'OK', 200
@@ -39,7 +39,7 @@ y:{grid:{color:'#2a2a2a'},ticks:{color:'#888',precision:0},beginAtZero:true}
 function prepareData(data,color){
 const labels=[],values=[];
 const today=new Date();
-for(let i=29;i>=0;i--){
+for(let i=(CHART_DATA.days||30)-1;i>=0;i--){
 const d=new Date(today);d.setDate(today.getDate()-i);
 const ds=d.toISOString().split('T')[0];
 labels.push(`${d.getDate()}.${d.getMonth()+1}`);
@@ -50,6 +50,8 @@ return{labels,datasets:[{data:values,borderColor:color,backgroundColor:color+'33
 new Chart(usersCanvas.getContext('2d'),{type:'line',data:prepareData(CHART_DATA.users,'#6366f1'),options:chartOpts});
 const keysCanvas=document.getElementById('newKeysChart');
 if(keysCanvas){new Chart(keysCanvas.getContext('2d'),{type:'line',data:prepareData(CHART_DATA.keys,'#22c55e'),options:chartOpts});}
+const revenueCanvas=document.getElementById('revenueChart');
+if(revenueCanvas&&CHART_DATA.revenue){new Chart(revenueCanvas.getContext('2d'),{type:'line',data:prepareData(CHART_DATA.revenue,'#f59e0b'),options:chartOpts});}
 }
 document.querySelectorAll('.clickable-row').forEach(row=>{
 row.addEventListener('click',function(e){
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from shop_bot.data_manager import database as database_module
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    database_module.close_connection()
+    monkeypatch.setattr(database_module, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(database_module, "DB_FILE", tmp_path / "data.db")
+    monkeypatch.setattr(database_module, "BACKUP_DIR", tmp_path / "backups")
+    monkeypatch.setattr(database_module, "OLD_DB_FILE", tmp_path / "users.db")
+    monkeypatch.setattr(database_module, "_db_executor", ThreadPoolExecutor(max_workers=2, thread_name_prefix="db-test"))
+    monkeypatch.setattr(database_module, "_users_fts_available", None)
+    database_module.invalidate_settings_cache()
+    yield database_module
+    database_module._db_executor.shutdown(wait=True)
+    database_module.close_connection()
+    database_module.invalidate_settings_cache()
+
+
+@pytest.fixture
+def db(database):
+    database.initialize_db()
+    return database
+
+
+@pytest.fixture
+def statements(db):
+    issued = []
+    conn = db.get_read_conn()
+    conn.set_trace_callback(issued.append)
+    yield issued
+    conn.set_trace_callback(None)
@@ -0,0 +1,103 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def _rollups(db) -> tuple:
+    cursor = db.get_read_conn().cursor()
+    days = {row[0]: (row[1], row[2], row[3], pytest.approx(row[4])) for row in
+            cursor.execute("SELECT day, signups, keys_issued, payments, revenue FROM daily_rollups")
+            if any(row[1:])}
+    methods = {(row[0], row[1]): (row[2], pytest.approx(row[3])) for row in
+               cursor.execute("SELECT day, payment_method, payments, revenue FROM daily_payment_methods")
+               if any(row[2:])}
+    plans = {(row[0], row[1], row[2]): (row[3], pytest.approx(row[4])) for row in
+             cursor.execute("SELECT day, plan_id, plan_name, payments, revenue FROM daily_plan_revenue")
+             if any(row[3:])}
+    return days, methods, plans
+
+
+def _assert_rollups_match_history(db):
+    maintained = _rollups(db)
+    db.rebuild_daily_rollups()
+    assert maintained == _rollups(db)
+
+
+@pytest.fixture
+def populated(db):
+    for user_id in range(1, 5):
+        db.register_user_if_not_exists(user_id, f"user{user_id}", None)
+        db.add_new_key(user_id, f"https://example.com/sub/{user_id}", 2_000_000_000_000)
+        plan_id = 1 + user_id % 2
+        for n, method in enumerate(("YooKassa", "CryptoBot")):
+            metadata = json.dumps({"plan_id": plan_id, "plan_name": f"Plan {plan_id}"} if n == 0 else {})
+            db.log_transaction(f"user{user_id}", None, f"pay-{user_id}-{n}", user_id, "paid",
+                               100.0 * user_id + n, None, None, method, metadata)
+    db.create_pending_transaction("ton-1", 1, 300.0, {"plan_id": 1})
+    with db._write_transaction() as conn:
+        conn.execute("UPDATE transactions SET created_date = ? WHERE user_id IN (1, 2)",
+                     (datetime.now() - timedelta(days=400),))
+    return db
+
+
+def test_rollups_follow_inserts(populated):
+    _assert_rollups_match_history(populated)
+
+
+def test_rollups_follow_updates(populated):
+    db = populated
+    with db._write_transaction() as conn:
+        conn.execute("UPDATE transactions SET status = 'paid' WHERE payment_id = 'ton-1'")
+        conn.execute("UPDATE transactions SET status = 'refunded' WHERE payment_id = 'pay-3-0'")
+        conn.execute("UPDATE transactions SET amount_rub = 999 WHERE payment_id = 'pay-4-1'")
+        conn.execute("UPDATE transactions SET payment_method = 'Heleket' WHERE payment_id = 'pay-4-0'")
+        conn.execute("""UPDATE transactions SET metadata = '{"plan_id": 3, "plan_name": "Plan 3"}'
+                        WHERE payment_id = 'pay-4-1'""")
+        conn.execute("UPDATE transactions SET created_date = ? WHERE payment_id = 'pay-3-1'",
+                     (datetime.now() - timedelta(days=3),))
+    _assert_rollups_match_history(db)
+
+
+def test_rollups_follow_deletes(populated):
+    db = populated
+    db.delete_key_by_id(db.get_user_keys(3)[0].key_id)
+    db.delete_user(4)
+    _assert_rollups_match_history(db)
+
+
+def test_rollups_survive_archiving(populated):
+    db = populated
+    before = _rollups(db)
+    assert db.archive_transactions(older_than_days=365) == 5
+    assert _rollups(db) == before
+    _assert_rollups_match_history(db)
+    db.delete_user(1)
+    _assert_rollups_match_history(db)
+
+
+def _plan_revenue_from_history(db, date_from: str = None) -> dict:
+    cursor = db.get_read_conn().cursor()
+    cursor.execute("""SELECT plan_id, COUNT(*), SUM(amount_rub) FROM (
+                          SELECT plan_id, amount_rub, status, created_date FROM transactions
+                          UNION ALL SELECT plan_id, amount_rub, status, created_date FROM transactions_archive)
+                      WHERE status = 'paid' AND created_date >= date(?) GROUP BY plan_id""", (date_from or "0001-01-01",))
+    return {row[0]: (row[1], pytest.approx(row[2])) for row in cursor.fetchall()}
+
+
+def test_plan_revenue_is_served_from_rollups(populated, statements):
+    db = populated
+    db.archive_transactions(older_than_days=365)
+    db.delete_user(3)
+
+    statements.clear()
+    revenue = db.get_plan_revenue()
+    issued = list(statements)
+    assert {row["plan_id"]: (row["payments"], row["revenue"]) for row in revenue} == _plan_revenue_from_history(db)
+    assert {row["plan_name"] for row in revenue} == {"Plan 1", "Plan 2", "N/A"}
+    assert issued and not any("transactions" in sql for sql in issued)
+
+    since = str((datetime.now() - timedelta(days=30)).date())
+    recent = db.get_plan_revenue(date_from=since, date_to=str(datetime.now().date()))
+    assert {row["plan_id"]: (row["payments"], row["revenue"]) for row in recent} == \
+        _plan_revenue_from_history(db, since)
@@ -0,0 +1,92 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+
+def _committed_users(db) -> int:
+    conn = sqlite3.connect(str(db.DB_FILE))
+    try:
+        return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_uncontended_write_commits_immediately(db, monkeypatch):
+    monkeypatch.setattr(db._group_commit, "window", 60)
+    db.register_user_if_not_exists(1, "alice", None)
+    assert not db.get_sync_conn().in_transaction
+    assert _committed_users(db) == 1
+
+
+def test_concurrent_writers_are_all_committed(db):
+    def writer(offset: int):
+        for i in range(200):
+            db.register_user_if_not_exists(offset + i, f"user{offset + i}", None)
+
+    threads = [threading.Thread(target=writer, args=(n * 1000,)) for n in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert _committed_users(db) == 1200
+    assert db._group_commit._arriving == 0
+    assert not db.get_sync_conn().in_transaction
+
+
+def test_async_writes_wait_for_their_batch(db):
+    async def register():
+        await asyncio.gather(*(db.async_register_user_if_not_exists(i, f"user{i}", None) for i in range(1, 101)))
+
+    asyncio.run(register())
+    assert _committed_users(db) == 100
+
+
+def test_failed_operation_rolls_back_only_its_savepoint(db):
+    with db._write_transaction() as conn:
+        conn.execute("INSERT INTO users (telegram_id, username) VALUES (1, 'kept')")
+        with pytest.raises(RuntimeError):
+            with db._write_transaction() as nested:
+                nested.execute("INSERT INTO users (telegram_id, username) VALUES (2, 'dropped')")
+                raise RuntimeError("abort nested write")
+    assert [user.telegram_id for user in db.get_all_users()] == [1]
+
+
+def _insert_orphan(db):
+    with db._write_transaction() as conn:
+        conn.execute("INSERT INTO children (parent_id) VALUES (42)")
+
+
+def test_failed_commit_fails_the_whole_batch(db, monkeypatch):
+    conn = db.get_sync_conn()
+    conn.execute("PRAGMA foreign_keys = ON")
+    with db._write_transaction() as write:
+        write.execute("CREATE TABLE parents (id INTEGER PRIMARY KEY)")
+        write.execute("""CREATE TABLE children (id INTEGER PRIMARY KEY,
+                         parent_id INTEGER REFERENCES parents(id) DEFERRABLE INITIALLY DEFERRED)""")
+
+    monkeypatch.setattr(db._group_commit, "window", 60)
+    monkeypatch.setattr(db._group_commit, "_arriving", 1)
+    _, first = db._call_deferring_commit(db.register_user_if_not_exists, (1, "alice", None), {})
+    _, second = db._call_deferring_commit(_insert_orphan, (db,), {})
+    assert not first[0].done()
+
+    db._group_commit.flush()
+
+    for batch in (*first, *second):
+        with pytest.raises(sqlite3.IntegrityError):
+            batch.result()
+    assert not conn.in_transaction
+    assert _committed_users(db) == 0
+
+
+def test_settings_update_is_visible_after_async_commit(db):
+    asyncio.run(db.async_update_settings({"about_text": "updated"}))
+    assert db.get_setting("about_text") == "updated"
+    conn = sqlite3.connect(str(db.DB_FILE))
+    try:
+        assert conn.execute("SELECT value FROM bot_settings WHERE key = 'about_text'").fetchone()[0] == "updated"
+    finally:
+        conn.close()
@@ -0,0 +1,117 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
+    total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
+    agreed_to_terms BOOLEAN DEFAULT 0, registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_banned BOOLEAN DEFAULT 0, referred_by INTEGER,
+    referral_balance REAL DEFAULT 0, referral_balance_all REAL DEFAULT 0);
+CREATE TABLE vpn_keys (
+    key_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+    subscription_link TEXT, expiry_date TIMESTAMP, created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    subscription_uuid TEXT);
+CREATE TABLE transactions (
+    transaction_id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT,
+    payment_id TEXT UNIQUE, user_id INTEGER NOT NULL, status TEXT NOT NULL,
+    amount_rub REAL NOT NULL, amount_currency REAL, currency_name TEXT,
+    payment_method TEXT, metadata TEXT, created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE bot_settings (key TEXT PRIMARY KEY, value TEXT NOT NULL DEFAULT '');
+CREATE TABLE support_threads (
+    user_id INTEGER PRIMARY KEY, thread_id INTEGER NOT NULL,
+    category TEXT, status TEXT DEFAULT 'open', priority TEXT DEFAULT 'normal',
+    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE plans (
+    plan_id INTEGER PRIMARY KEY AUTOINCREMENT, plan_name TEXT NOT NULL,
+    days INTEGER NOT NULL, price REAL NOT NULL);
+CREATE TABLE platega_pending (
+    transaction_id TEXT PRIMARY KEY, metadata TEXT NOT NULL,
+    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE cryptobot_pending (
+    invoice_id TEXT PRIMARY KEY, metadata TEXT NOT NULL,
+    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+"""
+
+EXPIRY = datetime(2030, 1, 1, 12, 0)
+
+
+@pytest.fixture
+def baseline_db(database):
+    conn = sqlite3.connect(str(database.DB_FILE))
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO users (telegram_id, username, total_spent, is_banned) VALUES (?, ?, ?, ?)",
+                     [(1, "alice", 150.0, 0), (2, "bob", 0, 1)])
+    conn.executemany("INSERT INTO vpn_keys (user_id, subscription_link, expiry_date) VALUES (?, ?, ?)",
+                     [(1, "https://example.com/sub/1", EXPIRY.isoformat(sep=" ")),
+                      (2, "https://example.com/sub/2", "not a date")])
+    conn.executemany("""INSERT INTO transactions (payment_id, user_id, status, amount_rub, payment_method,
+                        metadata, created_date) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                     [("yk-1", 1, "paid", 150.0, "YooKassa", '{"plan_id": 1}', "2024-05-01 10:00:00"),
+                      ("ton-1", 1, "pending", 200.0, "TON Connect", '{"user_id": 1}', "2024-05-02 10:00:00")])
+    conn.execute("INSERT INTO platega_pending (transaction_id, metadata) VALUES ('pl-1', '{\"user_id\": 1}')")
+    conn.execute("INSERT INTO cryptobot_pending (invoice_id, metadata) VALUES ('cb-1', '{\"user_id\": 2}')")
+    conn.commit()
+    conn.close()
+    return database
+
+
+def _schema_objects(conn, kind: str) -> set:
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = ? AND name NOT LIKE 'sqlite_%'", (kind,))
+    return {row[0] for row in rows}
+
+
+def test_baseline_database_migrates_to_latest_schema(baseline_db, tmp_path):
+    db = baseline_db
+    db.initialize_db()
+    conn = db.get_read_conn()
+    assert db._get_schema_version(conn) == db.SCHEMA_VERSION
+
+    fresh = sqlite3.connect(str(tmp_path / "fresh.db"))
+    try:
+        fresh.execute("PRAGMA journal_mode=WAL")
+        for migration in db.MIGRATIONS:
+            migration(fresh.cursor())
+        for kind in ("table", "index", "trigger"):
+            assert _schema_objects(conn, kind) == _schema_objects(fresh, kind)
+    finally:
+        fresh.close()
+
+
+def test_baseline_data_is_carried_over(baseline_db):
+    db = baseline_db
+    db.initialize_db()
+
+    valid, garbage = db.get_all_keys()
+    assert valid.expiry_ts == int(EXPIRY.timestamp())
+    assert garbage.expiry_ts == 0
+
+    intents = {(intent.provider, intent.external_id): intent for intent in
+               (db.get_payment_intent(*pair) for pair in (("platega", "pl-1"), ("cryptobot", "cb-1"), ("ton", "ton-1")))}
+    assert all(intent is not None and intent.state == "pending" for intent in intents.values())
+    assert intents["cryptobot", "cb-1"].user_id == 2
+    assert intents["ton", "ton-1"].amount_rub == 200.0
+
+    tables = _schema_objects(db.get_read_conn(), "table")
+    assert "platega_pending" not in tables and "cryptobot_pending" not in tables
+
+    assert db.reconcile_stats_counters() == {}
+    assert [user.telegram_id for user in db.search_users("alic")] == [1]
+
+
+def test_second_initialize_is_a_no_op(baseline_db, monkeypatch):
+    db = baseline_db
+    db.initialize_db()
+    monkeypatch.setattr(db, "_apply_migrations", lambda: pytest.fail("migrations re-applied"))
+    db.initialize_db()
+    assert db._get_schema_version(db.get_read_conn()) == db.SCHEMA_VERSION
+
+
+def test_newer_schema_version_is_rejected(database):
+    conn = sqlite3.connect(str(database.DB_FILE))
+    conn.execute(f"PRAGMA user_version = {database.SCHEMA_VERSION + 1}")
+    conn.close()
+    with pytest.raises(RuntimeError):
+        database.initialize_db()
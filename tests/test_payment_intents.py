@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+METADATA = {"user_id": 7, "plan_id": 2, "price": 199.0}
+
+
+def _backdate_intents(db, seconds: int):
+    with db._write_transaction() as conn:
+        conn.execute("UPDATE payment_intents SET created_at = created_at - ?", (seconds,))
+
+
+def test_create_is_an_upsert_while_pending(db):
+    first = db.create_payment_intent("platega", "tx-1", METADATA, 7, 199.0, poll=True)
+    second = db.create_payment_intent("platega", "tx-1", {**METADATA, "price": 249.0}, 7, 249.0, poll=True)
+    assert first == second
+    intent = db.get_payment_intent("platega", "tx-1")
+    assert (intent.state, intent.amount_rub, intent.attempts) == ("pending", 249.0, 0)
+
+
+def test_pending_intent_is_claimed_once(db):
+    db.create_payment_intent("platega", "tx-1", METADATA, 7, 199.0)
+    assert db.claim_payment_intent("platega", "tx-1") == METADATA
+    assert db.claim_payment_intent("platega", "tx-1") is None
+    assert db.get_payment_intent("platega", "tx-1").state == "paid"
+
+
+def test_claims_race_to_a_single_winner(db):
+    db.create_payment_intent("cryptobot", "inv-1", METADATA, 7, 199.0)
+
+    async def claim_concurrently():
+        return await asyncio.gather(*(db.async_claim_payment_intent("cryptobot", "inv-1") for _ in range(8)))
+
+    results = asyncio.run(claim_concurrently())
+    assert results.count(METADATA) == 1
+    assert results.count(None) == 7
+
+
+@pytest.mark.parametrize("state", ["expired", "canceled", "failed"])
+def test_late_payment_is_processed_after_terminal_state(db, state):
+    db.create_payment_intent("heleket", "order-1", METADATA, 7, 199.0)
+    assert db.transition_payment_intent("heleket", "order-1", state) == METADATA
+    assert db.claim_payment_intent("heleket", "order-1") == METADATA
+    assert db.get_payment_intent("heleket", "order-1").state == "paid"
+    assert db.claim_payment_intent("heleket", "order-1") is None
+
+
+def test_payment_without_intent_uses_fallback_once(db):
+    assert db.claim_payment_intent("yookassa", "yk-1") is None
+    assert db.claim_payment_intent("yookassa", "yk-1", METADATA) == METADATA
+    intent = db.get_payment_intent("yookassa", "yk-1")
+    assert (intent.state, intent.user_id, intent.amount_rub) == ("paid", 7, 199.0)
+    assert db.claim_payment_intent("yookassa", "yk-1", METADATA) is None
+    assert db.claim_payment_intent("yookassa", None, METADATA) == METADATA
+
+
+def test_create_after_claim_keeps_paid_state(db):
+    assert db.claim_payment_intent("heleket", "order-1", METADATA) == METADATA
+    assert db.create_payment_intent("heleket", "order-1", METADATA, 7, 199.0) is None
+    assert db.get_payment_intent("heleket", "order-1").state == "paid"
+
+
+def test_transition_rejects_unknown_state(db):
+    with pytest.raises(ValueError):
+        db.transition_payment_intent("platega", "tx-1", "refunded")
+
+
+def test_polling_backs_off_and_stale_intents_expire(db):
+    intent_id = db.create_payment_intent("platega", "tx-1", METADATA, 7, 199.0, poll=True)
+    assert [intent.intent_id for intent in db.get_due_payment_intents("platega")] == [intent_id]
+    delays = []
+    for _ in range(3):
+        db.reschedule_payment_intents([intent_id])
+        intent = db.get_payment_intent("platega", "tx-1")
+        delays.append(intent.next_check_at - intent.updated_at)
+    assert delays == [db.PAYMENT_POLL_BASE_SECONDS * 2 ** n for n in range(3)]
+    assert db.get_due_payment_intents("platega") == []
+
+    _backdate_intents(db, (db.PENDING_TRANSACTION_TTL_HOURS + 1) * 3600)
+    assert db.expire_payment_intents() == 1
+    assert db.get_payment_intent("platega", "tx-1").state == "expired"
+    assert db.get_payment_intent_stats() == {"platega": {"expired": 1}}
+
+
+def test_ton_payment_completes_after_expiry(db):
+    db.create_pending_transaction("ton-1", 7, 199.0, METADATA)
+    _backdate_intents(db, (db.PENDING_TRANSACTION_TTL_HOURS + 1) * 3600)
+    assert db.expire_payment_intents() == 1
+    assert db.find_and_complete_ton_transaction("ton-1", 2.5) == METADATA
+    assert db.find_and_complete_ton_transaction("ton-1", 2.5) is None
+    cursor = db.get_read_conn().cursor()
+    row = cursor.execute("SELECT status, amount_currency FROM transactions WHERE payment_id = 'ton-1'").fetchone()
+    assert tuple(row) == ("paid", 2.5)
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+
+def _plan(db, sql: str) -> list:
+    return [row[3] for row in db.get_read_conn().execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()]
+
+
+def _issued_plans(db, statements, call) -> list:
+    statements.clear()
+    call()
+    assert statements, "the call issued no SQL"
+    return [detail for sql in statements for detail in _plan(db, sql)]
+
+
+@pytest.mark.parametrize("call, index", [
+    (lambda db: db.get_user_keys(1), "idx_vpn_keys_user_id"),
+    (lambda db: db.get_referral_count(1), "idx_users_referred_by"),
+    (lambda db: db.get_user_id_by_thread(10), "idx_support_threads_thread_id"),
+    (lambda db: db.get_latest_transaction(1), "idx_transactions_user_created"),
+    (lambda db: db.get_keys_expiring_between(time.time(), time.time() + 3600), "idx_vpn_keys_expiry_user"),
+    (lambda db: db.get_keys_batch(expiring_between=(time.time(), time.time() + 3600)), "idx_vpn_keys_expiry_user"),
+    (lambda db: db.get_due_payment_intents("platega"), "idx_payment_intents_state_check"),
+    (lambda db: db.get_transactions_page(per_page=15), "idx_transactions_created_date"),
+])
+def test_hot_lookups_use_their_index(db, statements, call, index):
+    plans = _issued_plans(db, statements, lambda: call(db))
+    assert any(index in detail for detail in plans), plans
+
+
+@pytest.mark.parametrize("call", [
+    lambda db: db.get_user(1),
+    lambda db: db.get_user_keys(1),
+    lambda db: db.get_key_by_id(1),
+    lambda db: db.get_referral_count(1),
+    lambda db: db.get_user_id_by_thread(10),
+    lambda db: db.get_latest_transaction(1),
+    lambda db: db.get_payment_intent("yookassa", "p-1"),
+    lambda db: db.get_keys_expiring_between(time.time(), time.time() + 3600),
+])
+def test_point_lookups_never_scan_a_table(db, statements, call):
+    plans = _issued_plans(db, statements, lambda: call(db))
+    full_scans = [detail for detail in plans if detail.startswith("SCAN ") and " USING " not in detail]
+    assert not full_scans, plans
+
+
+def test_customer_email_lookup_uses_generated_column_index(db):
+    plans = _plan(db, "SELECT * FROM transactions WHERE customer_email = 'a@b.c'")
+    assert any("idx_transactions_customer_email" in detail for detail in plans), plans
@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+import pytest
+
+from shop_bot.data_manager import scheduler
+
+
+class FakeBot:
+    def __init__(self, fail_for: tuple = ()):
+        self.fail_for = fail_for
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.fail_for:
+            raise RuntimeError("chat not found")
+        self.sent.append((time.monotonic(), chat_id, text))
+
+
+class FakeController:
+    def __init__(self, bot=None):
+        self.bot = bot
+
+    def get_status(self):
+        return {"shop_bot_running": self.bot is not None}
+
+    def get_bot_instance(self):
+        return self.bot
+
+
+def _run(job_scheduler: scheduler.JobScheduler, seconds: float, controller: FakeController = None) -> dict:
+    async def run():
+        task = asyncio.create_task(job_scheduler.run(controller or FakeController()))
+        await asyncio.sleep(seconds)
+        task.cancel()
+        return job_scheduler.get_metrics()
+    return {metrics["name"]: metrics for metrics in asyncio.run(run())}
+
+
+async def _sleep_briefly():
+    await asyncio.sleep(0.6)
+
+
+def test_slow_job_is_timed_out():
+    job_scheduler = scheduler.JobScheduler()
+    job_scheduler.add_job(scheduler.Job("slow", _sleep_briefly, 0.3, timeout=0.15))
+    metrics = _run(job_scheduler, 1.0)["slow"]
+    assert metrics["timeouts"] >= 2
+    assert metrics["runs"] == metrics["timeouts"]
+    assert metrics["skipped"] == 0
+
+
+def test_overlapping_run_is_skipped():
+    job_scheduler = scheduler.JobScheduler()
+    job_scheduler.add_job(scheduler.Job("overlap", _sleep_briefly, 0.2, timeout=5))
+    metrics = _run(job_scheduler, 1.0)["overlap"]
+    assert metrics["runs"] == 1
+    assert metrics["skipped"] >= 2
+    assert metrics["timeouts"] == 0
+
+
+def test_failures_and_metrics_are_reported():
+    async def broken():
+        raise ValueError("boom")
+
+    job_scheduler = scheduler.JobScheduler()
+    job_scheduler.add_job(scheduler.Job("broken", broken, 0.2, timeout=1))
+    job_scheduler.add_job(scheduler.Job("needs_bot", _sleep_briefly, 0.2, timeout=1, requires_bot=True))
+    metrics = _run(job_scheduler, 0.5)
+    assert metrics["broken"]["failures"] == metrics["broken"]["runs"] >= 2
+    assert metrics["needs_bot"]["runs"] == 0
+    assert set(metrics["broken"]) >= {"interval", "timeout", "running", "last_run_at", "next_run_in",
+                                      "last_duration_ms", "max_duration_ms", "last_lag_ms", "max_lag_ms"}
+
+
+def test_notification_is_sent_when_key_enters_window(db):
+    db.register_user_if_not_exists(1, "alice", None)
+    db.add_new_key(1, "https://example.com/sub/1", int((time.time() + 24 * 3600 + 2) * 1000))
+    bot = FakeBot()
+    job_scheduler = scheduler.JobScheduler()
+    job_scheduler.add_job(scheduler.Job("expiry_notifications", scheduler.check_expiring_subscriptions,
+                                        300, timeout=10, requires_bot=True))
+    started = time.monotonic()
+    metrics = _run(job_scheduler, 3.5, FakeController(bot))["expiry_notifications"]
+    assert len(bot.sent) == 1
+    assert 1 <= bot.sent[0][0] - started <= 3.5
+    assert metrics["runs"] == 2
+
+
+def test_failed_sends_are_left_for_the_next_run(db):
+    expiry_ms = int((time.time() + 23.5 * 3600) * 1000)
+    for user_id in (1, 2, 3):
+        db.register_user_if_not_exists(user_id, f"user{user_id}", None)
+        db.add_new_key(user_id, f"https://example.com/sub/{user_id}", expiry_ms)
+
+    bot = FakeBot(fail_for=(2,))
+    asyncio.run(scheduler.check_expiring_subscriptions(bot))
+    assert sorted(chat_id for _, chat_id, _ in bot.sent) == [1, 3]
+
+    bot.fail_for = ()
+    asyncio.run(scheduler.check_expiring_subscriptions(bot))
+    assert sorted(chat_id for _, chat_id, _ in bot.sent) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_marks_are_flushed_in_batches(db, monkeypatch, batch_size):
+    monkeypatch.setattr(scheduler, "NOTIFY_MARK_BATCH_SIZE", batch_size)
+    expiry_ms = int((time.time() + 47.5 * 3600) * 1000)
+    for user_id in range(1, 6):
+        db.register_user_if_not_exists(user_id, f"user{user_id}", None)
+        db.add_new_key(user_id, f"https://example.com/sub/{user_id}", expiry_ms)
+
+    bot = FakeBot()
+    asyncio.run(scheduler.check_expiring_subscriptions(bot))
+    asyncio.run(scheduler.check_expiring_subscriptions(bot))
+    assert sorted(chat_id for _, chat_id, _ in bot.sent) == [1, 2, 3, 4, 5]
+
+
+class FakeInvoice:
+    def __init__(self, invoice_id: int, status: str):
+        self.invoice_id = invoice_id
+        self.status = status
+
+
+def test_invalid_cryptobot_invoice_id_does_not_block_its_chunk(db, monkeypatch):
+    import aiosend
+    from shop_bot.bot import handlers
+
+    statuses = {101: "paid", 102: "active", 103: "expired"}
+    requested = []
+
+    class FakeCryptoPay:
+        def __init__(self, token):
+            pass
+
+        async def get_invoices(self, invoice_ids, count):
+            requested.append(invoice_ids)
+            return [FakeInvoice(invoice_id, statuses[invoice_id]) for invoice_id in invoice_ids]
+
+    processed = []
+
+    async def process_successful_payment(bot, metadata):
+        processed.append(metadata)
+
+    monkeypatch.setattr(aiosend, "CryptoPay", FakeCryptoPay)
+    monkeypatch.setattr(handlers, "process_successful_payment", process_successful_payment)
+    db.update_settings({"cryptobot_token": "token"})
+    for external_id in ("101", "broken", "102", "", "103"):
+        db.create_payment_intent("cryptobot", external_id, {"invoice": external_id}, 1, 100.0, poll=True)
+
+    asyncio.run(scheduler.check_pending_cryptobot_payments(FakeBot()))
+
+    assert requested == [[101, 102, 103]]
+    assert processed == [{"invoice": "101"}]
+    states = {external_id: db.get_payment_intent("cryptobot", external_id).state
+              for external_id in ("101", "broken", "102", "", "103")}
+    assert states == {"101": "paid", "broken": "failed", "102": "pending", "": "failed", "103": "expired"}
+    assert db.get_payment_intent("cryptobot", "102").attempts == 1
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def _assert_counters_consistent(db):
+    cursor = db.get_read_conn().cursor()
+    actual = {name: cursor.execute(query).fetchone()[0] for name, query in db.STATS_COUNTER_QUERIES.items()}
+    stored = db.get_stats_counters()
+    assert {name: stored.get(name) for name in actual} == pytest.approx(actual)
+    assert db.reconcile_stats_counters() == {}
+
+
+def _log_paid(db, user_id: int, payment_id: str, amount: float):
+    db.log_transaction(f"user{user_id}", None, payment_id, user_id, "paid", amount, None, None, "YooKassa", "{}")
+
+
+def _backdate(db, days: int):
+    with db._write_transaction() as conn:
+        conn.execute("UPDATE transactions SET created_date = ?", (datetime.now() - timedelta(days=days),))
+
+
+@pytest.fixture
+def populated(db):
+    for user_id in range(1, 6):
+        db.register_user_if_not_exists(user_id, f"user{user_id}", None)
+        db.add_new_key(user_id, f"https://example.com/sub/{user_id}", 2_000_000_000_000)
+        _log_paid(db, user_id, f"pay-{user_id}", 100.0 * user_id)
+    return db
+
+
+def test_counters_follow_inserts(populated):
+    _assert_counters_consistent(populated)
+    assert populated.get_user_count() == 5
+    assert populated.get_total_keys_count() == 5
+
+
+def test_counters_follow_updates(populated):
+    db = populated
+    db.ban_user(2)
+    db.ban_user(3)
+    db.unban_user(3)
+    db.update_user_stats(1, 250.0, 3)
+    db.reset_user_stats(4)
+    with db._write_transaction() as conn:
+        conn.execute("UPDATE transactions SET amount_rub = amount_rub * 2 WHERE payment_id = 'pay-5'")
+    _assert_counters_consistent(db)
+    assert db.get_stats_counters()["banned_users"] == 1
+
+
+def test_counters_follow_deletes(populated):
+    db = populated
+    db.delete_key_by_id(db.get_user_keys(1)[0].key_id)
+    db.delete_user(2)
+    db.delete_user_keys(3)
+    _assert_counters_consistent(db)
+    assert db.get_user_count() == 4
+    assert db.get_total_keys_count() == 2
+
+
+def test_counters_follow_archiving(populated):
+    db = populated
+    _backdate(db, days=400)
+    assert db.archive_transactions(older_than_days=365, batch_size=2) == 5
+    _assert_counters_consistent(db)
+    assert db.get_stats_counters()["archived_transactions_amount"] == pytest.approx(1500.0)
+    db.delete_user(1)
+    _assert_counters_consistent(db)
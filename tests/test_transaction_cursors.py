@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+TRANSACTIONS = 47
+PER_PAGE = 7
+
+
+@pytest.fixture
+def history(db):
+    now = datetime.now().replace(microsecond=0)
+    for n in range(TRANSACTIONS):
+        db.log_transaction(f"user{n}", None, f"pay-{n}", n, "paid", 10.0 + n, None, None, "YooKassa", "{}")
+    with db._write_transaction() as conn:
+        conn.execute("UPDATE transactions SET created_date = ? || '.000000' WHERE transaction_id % 5 = 0",
+                     (str(now - timedelta(days=40)),))
+        conn.execute("""UPDATE transactions SET created_date = datetime(?, '-' || (transaction_id * 3) || ' days')
+                        WHERE transaction_id % 5 != 0""", (str(now),))
+    db.create_pending_transaction("ton-late", 1, 50.0, {"user_id": 1})
+    with db._write_transaction() as conn:
+        conn.execute("UPDATE transactions SET created_date = ? WHERE payment_id = 'ton-late'",
+                     (now - timedelta(days=50),))
+    assert db.archive_transactions(older_than_days=30) > 0
+    return db
+
+
+def _expected_order(db) -> list:
+    cursor = db.get_read_conn().cursor()
+    cursor.execute("""SELECT transaction_id FROM (SELECT transaction_id, created_date FROM transactions
+                      UNION ALL SELECT transaction_id, created_date FROM transactions_archive)
+                      ORDER BY created_date DESC, transaction_id DESC""")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _ids(page: dict) -> list:
+    return [tx.transaction_id for tx in page["transactions"]]
+
+
+def test_pages_cover_hot_and_archived_rows_in_both_directions(history):
+    db = history
+    expected = _expected_order(db)
+    assert db.get_transactions_total() == len(expected) == TRANSACTIONS + 1
+
+    pages = [db.get_transactions_page(per_page=PER_PAGE)]
+    assert pages[0]["prev_cursor"] is None
+    while pages[-1]["next_cursor"]:
+        pages.append(db.get_transactions_page(before=pages[-1]["next_cursor"], per_page=PER_PAGE))
+    assert [tx_id for page in pages for tx_id in _ids(page)] == expected
+
+    backwards = [pages[-1]]
+    while backwards[-1]["prev_cursor"]:
+        backwards.append(db.get_transactions_page(after=backwards[-1]["prev_cursor"], per_page=PER_PAGE))
+    assert [_ids(page) for page in reversed(backwards)] == [_ids(page) for page in pages]
+
+
+def test_export_streams_hot_and_archived_rows(history):
+    db = history
+    columns, rows = db.iter_export_rows("transactions", batch_size=5)
+    position = columns.index("transaction_id")
+    exported = [row[position] for row in rows]
+    assert exported == sorted(_expected_order(db))
+
+
+def test_late_ton_payment_restores_archived_row(history):
+    db = history
+    assert db.find_and_complete_ton_transaction("ton-late", 1.5) == {"user_id": 1}
+    cursor = db.get_read_conn().cursor()
+    assert cursor.execute("SELECT COUNT(*) FROM transactions_archive WHERE payment_id = 'ton-late'").fetchone()[0] == 0
+    assert cursor.execute("SELECT status FROM transactions WHERE payment_id = 'ton-late'").fetchone()[0] == "paid"
+    assert db.find_and_complete_ton_transaction("ton-late", 1.5) is None
+    assert db.reconcile_stats_counters() == {}
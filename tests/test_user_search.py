@@ -0,0 +1,44 @@
+import pytest
+
+USERS = [(123456789, "alice"), (987654321, "bob_01"), (555000111, "carol0123"), (42, "dave")]
+
+
+@pytest.fixture
+def users(db):
+    for telegram_id, username in USERS:
+        db.register_user_if_not_exists(telegram_id, username, None)
+    return db
+
+
+def _search(db, query: str) -> list:
+    return sorted(user.telegram_id for user in db.search_users(query))
+
+
+@pytest.fixture(params=[True, False], ids=["fts", "like"])
+def search_db(request, users, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(users, "_has_users_fts", lambda cursor: False)
+    return users
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("0", [555000111, 987654321]),
+    ("01", [555000111, 987654321]),
+    ("0123", [555000111]),
+    ("1" * 17, []),
+    ("12345678901234567890", []),
+    ("4", [42]),
+    ("12345", [123456789]),
+    ("al", [123456789]),
+    ("b", [987654321]),
+    ("arol", [555000111]),
+    ("nobody", []),
+])
+def test_search_handles_any_query(search_db, query, expected):
+    assert _search(search_db, query) == expected
+
+
+def test_blank_and_oversized_queries(users):
+    assert users.search_users("   ") == []
+    with pytest.raises(ValueError):
+        users.search_users("x" * 101)
@@ -0,0 +1,34 @@
+import sqlite3
+import time
+
+import pytest
+
+
+def test_expiry_is_required(db):
+    db.register_user_if_not_exists(1, "alice", None)
+    key_id = db.add_new_key(1, "https://example.com/sub/1", 2_000_000_000_000)
+    with pytest.raises(sqlite3.IntegrityError, match="expiry_ts may not be NULL"):
+        with db._write_transaction() as conn:
+            conn.execute("INSERT INTO vpn_keys (user_id, subscription_link) VALUES (1, 'https://example.com/sub/2')")
+    with pytest.raises(sqlite3.IntegrityError, match="expiry_ts may not be NULL"):
+        with db._write_transaction() as conn:
+            conn.execute("UPDATE vpn_keys SET expiry_ts = NULL WHERE key_id = ?", (key_id,))
+    assert [key.expiry_ts for key in db.get_user_keys(1)] == [2_000_000_000]
+
+
+def test_prune_keeps_marks_of_recently_expired_keys(db):
+    db.register_user_if_not_exists(1, "alice", None)
+    now = time.time()
+    just_expired = db.add_new_key(1, "https://example.com/sub/1", int((now - 60) * 1000))
+    long_expired = db.add_new_key(1, "https://example.com/sub/2", int((now - 80 * 3600) * 1000))
+    active = db.add_new_key(1, "https://example.com/sub/3", int((now + 3600) * 1000))
+    for key_id in (just_expired, long_expired, active):
+        db.mark_keys_notified([key_id], 1)
+
+    assert db.prune_key_notifications(older_than_hours=72) == 1
+    cursor = db.get_read_conn().cursor()
+    marked = {row[0] for row in cursor.execute("SELECT key_id FROM key_notifications")}
+    assert marked == {just_expired, active}
+
+    assert db.prune_key_notifications(older_than_hours=72) == 0
+    assert db.prune_key_notifications() == 0
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+import pytest
+
+from shop_bot.bot import handlers
+from shop_bot.webhook_server.app import create_webhook_app
+
+METADATA = {"user_id": 7, "plan_id": 2, "price": 199.0}
+PLATEGA_IP = "159.89.29.214"
+
+
+class FakeController:
+    def __init__(self):
+        self.bot = None
+
+    def get_status(self):
+        return {"shop_bot_running": self.bot is not None}
+
+    def get_bot_instance(self):
+        return self.bot
+
+
+@pytest.fixture
+def event_loop_thread():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def webhook(db, monkeypatch, event_loop_thread):
+    processed = []
+
+    async def process_successful_payment(bot, metadata):
+        processed.append(metadata)
+
+    monkeypatch.setattr(handlers, "process_successful_payment", process_successful_payment)
+    db.update_settings({"platega_merchant_id": "merchant", "platega_secret_key": "secret"})
+    controller = FakeController()
+    app = create_webhook_app(controller)
+    app.config["TESTING"] = True
+    app.config["EVENT_LOOP"] = event_loop_thread
+    return app.test_client(), controller, processed
+
+
+def _post_yookassa(client, payment_id: str):
+    return client.post("/yookassa-webhook", json={"event": "payment.succeeded",
+                                                  "object": {"id": payment_id, "metadata": METADATA}})
+
+
+def _post_platega(client, transaction_id: str):
+    return client.post("/platega-webhook", json={"status": "CONFIRMED", "id": transaction_id},
+                       headers={"X-Forwarded-For": PLATEGA_IP, "X-MerchantId": "merchant", "X-Secret": "secret"})
+
+
+def _drain(client):
+    loop = client.application.config["EVENT_LOOP"]
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(timeout=2)
+
+
+@pytest.mark.parametrize("provider, post", [("yookassa", _post_yookassa), ("platega", _post_platega)])
+def test_payment_is_not_claimed_while_bot_is_unavailable(db, webhook, provider, post):
+    client, controller, processed = webhook
+    db.create_payment_intent(provider, "pay-1", METADATA, 7, 199.0)
+
+    assert post(client, "pay-1").status_code == 503
+    assert db.get_payment_intent(provider, "pay-1").state == "pending"
+
+    controller.bot = object()
+    assert post(client, "pay-1").status_code == 200
+    _drain(client)
+    assert processed == [METADATA]
+    assert db.get_payment_intent(provider, "pay-1").state == "paid"
+
+    assert post(client, "pay-1").status_code == 200
+    _drain(client)
+    assert processed == [METADATA]
+
+
+def test_payment_is_not_claimed_without_a_running_loop(db, webhook):
+    client, controller, processed = webhook
+    controller.bot = object()
+    client.application.config["EVENT_LOOP"] = None
+
+    assert _post_yookassa(client, "pay-1").status_code == 503
+    assert db.get_payment_intent("yookassa", "pay-1") is None
+    assert processed == []